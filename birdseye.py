@@ -5,14 +5,16 @@ from OpenGL.GLU import *
 try:
     import Image
     import ImageFont
-    import ImageDraw
 except ImportError:
-    from PIL import Image, ImageDraw, ImageFont
+    from PIL import Image, ImageFont
 import time
 import math
 from nav.tracker import Tracker, live_stream, dead_reckoning_stream, tracklog_stream
 from mapcache import maptile
 from nav import texture
+from nav.prefetch import Prefetcher
+from nav import overlay
+from nav.render import FrameScheduler
 from util import geodesy
 from datetime import datetime
 from optparse import OptionParser
@@ -21,9 +23,9 @@ import logging
 import settings
 from gps.gpslistener import GPSSubscription
 from contextlib import contextmanager
-import threading
 import Queue
 import util.util as u
+from util import metrics
 
 SCREEN_WIDTH, SCREEN_HEIGHT = settings.SCREEN_DIM
 
@@ -33,18 +35,27 @@ window = 0
 
 zoom = None
 
-# hack
-def round_up_even(k):
-    return max(int(2. * math.floor(.5 * (k + 1))), 6)
-
 texture_manager = None
-texwidth = round_up_even(SCREEN_WIDTH // 256 + 2)
-texheight = round_up_even(SCREEN_HEIGHT // 256 + 2)
+prefetcher = None
+scheduler = None
+texwidth, texheight = texture.atlas_size((SCREEN_WIDTH, SCREEN_HEIGHT))
+
+debug_overlay = settings.DEBUG_OVERLAY
+debug_lines = (0., []) # (time refreshed, lines of metrics summary)
+DEBUG_REFRESH = .5 # seconds
 
 curstexid = None
 markertexids = None
 texttexid = None
-glyphtable = None
+hud = None # overlay.TextBatch
+
+# fixed geometry (overlay.DisplayList)
+mapquad = overlay.quad([(0., 0.), (texwidth, 0.), (texwidth, texheight), (0., texheight)],
+                       [(0., 0.), (1., 0.), (1., -1.), (0., -1.)]) # offset by the texture matrix
+markerquad = overlay.quad([(-.125, .125), (.125, .125), (.125, -.125), (-.125, -.125)],
+                          [(0., 1.), (1., 1.), (1., 0.), (0., 0.)])
+cursorquad = overlay.quad([(.125, -.125), (-.125, -.125), (-.125, .125), (.125, .125)],
+                          [(0., 1.), (1., 1.), (1., 0.), (0., 0.)])
 
 gps = None
 
@@ -101,6 +112,18 @@ def LoadTexture(id, image, alpha=False):
     glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
 
+def InitAtlasTexture(id, width, height):
+    """allocate the (uninitialized) texture for a width x height tile atlas; it wraps
+    in both directions"""
+    glBindTexture(GL_TEXTURE_2D, id)
+    glPixelStorei(GL_UNPACK_ALIGNMENT,1)
+    glTexImage2D(GL_TEXTURE_2D, 0, 4, 256 * width, 256 * height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
+
 def LoadStaticTextures ():
     global curstexid
     global markertexids
@@ -116,71 +139,61 @@ def LoadStaticTextures ():
 
     #text
     global texttexid
-    global glyphtable
-    fontdir = '/usr/share/fonts/truetype/freefont/'
-    font = ImageFont.truetype(fontdir + 'FreeSansBold.ttf', 30)
+    global hud
+    font = ImageFont.truetype(overlay.FONT, overlay.FONT_SIZE)
 
     texttexid = glGenTextures(1)
-    glyphtable = {}
-    xc = 0
-    timg = Image.new('RGBA', (1024, 1024))
-    draw = ImageDraw.Draw(timg)
-    for text in u'0123456789.:+-hmJanFebMrApyulgSOctNovDTWdifEk \xb0?':
-        sz = font.getsize(text)
-        draw.text((xc, 0), text, font=font)
-        glyphtable[text] = (xc, sz[0], sz[1])
-        xc += sz[0]
+    timg, glyphs = overlay.render_glyphs(font, dim=1024)
     LoadTexture(texttexid, timg, True)
+    hud = overlay.TextBatch(texttexid, glyphs, 1024)
 
-class TextureThread(threading.Thread):
-    def __init__(self, tex_id):
-        threading.Thread.__init__(self)
-        self.up = True
-        self.lock = threading.Lock()
-        self.in_ = Queue.Queue()
-        self.out = Queue.Queue()
+class TextureThread(texture.AtlasLoader):
+    """the map texture: a toroidal atlas of tiles kept loaded for the current view
+    (see texture.AtlasLoader), uploaded to gl"""
 
+    def __init__(self, tex_id):
+        texture.AtlasLoader.__init__(self, texwidth, texheight, settings.TEXTURE_DECODE_WORKERS)
         self.tex_id = tex_id
-        self.curview = None
 
-    def terminate(self):
-        self.up = False
-
-    def set(self, view, zoom, tile):
-        self.in_.put((view, zoom, tile))
-            
-    def run(self):
-        while self.up:
-            try:
-                newview = self.in_.get(True, 0.05)
-            except Queue.Empty:
-                newview = None
-            
-            if newview and newview != self.curview:
-                view, zoom, tile = newview
-                xmin = tile[0] - texwidth / 2
-                ymin = tile[1] - texheight / 2
+    def uploader(self, uploads, view=None):
+        """return a callback for the gl thread to upload [(slot, tile key, pixels), ...]
+        (skipping slots reassigned since), then mark 'view' as drawn"""
+        def update_texture():
+            glBindTexture(GL_TEXTURE_2D, self.tex_id)
+            glPixelStorei(GL_UNPACK_ALIGNMENT,1)
+            for (sx, sy), key, pixels in uploads:
+                if self.atlas.holds((sx, sy), key):
+                    glTexSubImage2D(GL_TEXTURE_2D, 0, 256 * sx, 256 * (texheight - 1 - sy), 256, 256,
+                                    GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+                    metrics.incr('texture.uploads')
+            self.mark_drawn(view)
+        return update_texture
 
-                tex_image = texture.get_texture_image(view, zoom, xmin, ymin, texwidth, texheight)
-
-                def update_texture():
-                    LoadTexture(self.tex_id, tex_image)
-                    glTexEnvi(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
+    def translate(self, tile, tilef):
+        tile = self.drawn_tile() or tile
+        glTranslatef(tile[0] - tilef[0], tile[1] - tilef[1], 0.)
 
-                with self.lock:
-                    self.curview = newview
-                    self.out.put(update_texture)
 
-    def translate(self, tile, tilef):
-        with self.lock:
-            if self.curview:
-                tile = self.curview[2]
-            glTranslatef(tile[0] - tilef[0], tile[1] - tilef[1], 0.)
+def Idle():
+    """request a redraw when the frame scheduler says something visible has changed;
+    otherwise sleep"""
+    now = time.time()
+    k = gps.get_loc()
+    center = maptile.xy_to_tilef(maptile.mercator_to_xy(maptile.ll_to_mercator(k['p'][:2])), zoom)
+    state = (view, zoom, k['v'][:2] if k['v'] else None, k['dt'] < 5., int(now), not texture_manager.out.empty(),
+             debug_overlay)
 
+    scheduler.report(now)
+    if scheduler.should_draw(now, (256. * center[0], 256. * center[1]), state):
+        glutPostRedisplay()
+    else:
+        time.sleep(scheduler.idle_time(now))
 
 def DrawGLScene():
+ frame_start = time.time()
  try:
-    k = gps.get_loc()
+    with metrics.timer('frame.get_loc'):
+        k = gps.get_loc()
     pos = k['p'][:2]
     v = k['v'][:2]
     age = k['dt']
@@ -195,11 +208,19 @@ def DrawGLScene():
     pf = maptile.xy_to_tilef(maptile.mercator_to_xy(maptile.ll_to_mercator(pos)), zoom)
 
     texture_manager.set(view, zoom, tile)
+    prefetcher.set_view(view, zoom)
     try:
-        tex_update = texture_manager.out.get(False)
-        tex_update()
+        # apply all pending updates, so the texture matches a single view
+        with metrics.timer('frame.tex_updates'):
+            while True:
+                tex_update = texture_manager.out.get(False)
+                tex_update()
     except Queue.Empty:
         pass
+    map_start = time.time()
+
+    # phase of the continuous animations; frozen in low-power mode
+    anim = clock() if scheduler.animating() else 0.
 
     glClear(GL_COLOR_BUFFER_BIT)
     glMatrixMode(GL_MODELVIEW)
@@ -219,17 +240,18 @@ def DrawGLScene():
             glBindTexture(GL_TEXTURE_2D, texture_manager.tex_id)     # 2d texture (x and y size)
             glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
 
-            glBegin(GL_QUADS)
+            u0, v0 = texture_manager.texcoords()
+            glMatrixMode(GL_TEXTURE)
+            glLoadIdentity()
+            glTranslatef(u0, v0, 0.)
+            glMatrixMode(GL_MODELVIEW)
+
             glColor3f(.8,.7,.4)
-            glTexCoord2f(0.0, 1.0) 
-            glVertex3f(0.0, 0.0, 0.0)
-            glTexCoord2f(1.0, 1.0) 
-            glVertex3f(texwidth, 0.0, 0.0)
-            glTexCoord2f(1.0, 0.0) 
-            glVertex3f(texwidth, texheight, 0.0)
-            glTexCoord2f(0.0, 0.0) 
-            glVertex3f(0.0, texheight, 0.0)
-            glEnd()
+            mapquad.draw()
+
+            glMatrixMode(GL_TEXTURE)
+            glLoadIdentity()
+            glMatrixMode(GL_MODELVIEW)
             
             glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_MODULATE)
 
@@ -246,19 +268,10 @@ def DrawGLScene():
                     glBindTexture(GL_TEXTURE_2D, markertexids[i])
 
                     with gltransform():
-                        glRotatef(clock() * rotspeed[i], 0, 0, 1)
+                        glRotatef(anim * rotspeed[i], 0, 0, 1)
 
-                        glBegin(GL_QUADS)
                         glColor4f(0., 0, 1, .55)
-                        glTexCoord2f(0.0, 1.0) 
-                        glVertex3f(-0.125, 0.125, 0.0)
-                        glTexCoord2f(1.0, 1.0) 
-                        glVertex3f(0.125, 0.125, 0.0)
-                        glTexCoord2f(1.0, 0.0) 
-                        glVertex3f(0.125, -0.125, 0.0)
-                        glTexCoord2f(0.0, 0.0) 
-                        glVertex3f(-0.125, -0.125, 0.0)
-                        glEnd()
+                        markerquad.draw()
 
             #line to dest
             glDisable(GL_TEXTURE_2D)
@@ -284,12 +297,7 @@ def DrawGLScene():
                         filt2[i + 1] = True
             pts = [pt for (i, pt) in enumerate(pts) if filt2[i]]
 
-            glLineWidth(2.5)
-            glBegin(GL_LINE_STRIP)
-            glColor4f(0, 0, 1, .3)
-            for pt in pts:
-                glVertex3f(pt[0], pt[1], 0.0)
-            glEnd()
+            overlay.draw_line(pts, (0, 0, 1, .3), 2.5)
 
             glEnable(GL_TEXTURE_2D)
 
@@ -300,20 +308,13 @@ def DrawGLScene():
 
             glBindTexture(GL_TEXTURE_2D, curstexid)
 
-            glBegin(GL_QUADS)
             if age < 5.:
-                glColor4f(1., 0., 0., cursalpha(clock()))
+                glColor4f(1., 0., 0., cursalpha(anim))
             else:
-                glColor4f(.3, .3, .3, cursalpha(clock()))
-            glTexCoord2f(0.0, 1.0) 
-            glVertex3f(0.125, -0.125, 0.0)
-            glTexCoord2f(1.0, 1.0) 
-            glVertex3f(-0.125, -0.125, 0.0)
-            glTexCoord2f(1.0, 0.0) 
-            glVertex3f(-0.125, 0.125, 0.0)
-            glTexCoord2f(0.0, 0.0) 
-            glVertex3f(0.125, 0.125, 0.0)
-            glEnd()
+                glColor4f(.3, .3, .3, cursalpha(anim))
+            cursorquad.draw()
+
+    metrics.record('frame.map', time.time() - map_start)
 
     #clock
     inst = datetime.now()
@@ -321,7 +322,9 @@ def DrawGLScene():
     diff = inst - uinst
     offset = int(round((86400*diff.days + diff.seconds + 1.0e-6*diff.microseconds) / 60, 0))
 
-    timestr = '%02d:%02d:%02d.%02d' % (inst.hour, inst.minute, inst.second, inst.microsecond / 10000) 
+    timestr = '%02d:%02d:%02d' % (inst.hour, inst.minute, inst.second)
+    if scheduler.animating():
+        timestr += '.%02d' % (inst.microsecond / 10000)
     offsetstr = '+' if offset >= 0 else '-'
     if offset < 0:
         offset = -offset
@@ -333,23 +336,10 @@ def DrawGLScene():
     month = inst.strftime('%B')
     datestr = '%04d-%s-%02d %s' % (inst.year, month[0:3], inst.day, weekday[0:3])
 
-    glBindTexture(GL_TEXTURE_2D, texttexid)
-
-    with gltransform():
-        glTranslatef(1.35, -1.17, 0)
-
-        with gltransform():
-            glScalef(.5, .5, 1.)
-            writeText(datestr)
-
-        with gltransform():
-            glTranslatef(.48, 0, 0)
-            glScalef(.4, .5, 1.)
-            writeText(offsetstr)
-
-        with gltransform():
-            glTranslatef(0, .05, 0)
-            writeText(timestr)
+    # all text is queued and drawn in one batch at the end
+    hud.add(datestr, (1.35, -1.17), (.5, .5))
+    hud.add(offsetstr, (1.83, -1.17), (.4, .5))
+    hud.add(timestr, (1.35, -1.12))
 
     #distance
     if destpos != None:
@@ -358,35 +348,26 @@ def DrawGLScene():
 
         diststr = '%.3f' % (dist / unit)
 
-        glBindTexture(GL_TEXTURE_2D, texttexid)
-
-        with gltransform():
-            glTranslatef(-1.99, -1.17, 0)
-
-            writeText(diststr)
+        hud.add(diststr, (-1.99, -1.17))
 
         #eta
-        with gltransform():
-            glTranslatef(-1.99, -1.06, 0)
-            glScalef(.7, .7, 1)
-
-            if v != None and v[0] != None and v[1] != None:
-                velo = v[0] if v[0] > 0 else 0.001
-                deviation = v[1] - bear
-                vmg = velo * math.cos(math.radians(deviation))
-                eta = int(dist / vmg)
-
-                if eta > 100 * 3600.:
-                    etastr = '-----'
-                else:
-                    (etah, etam, etas) = (eta / 3600, (eta / 60) % 60, eta % 60)
-                    etastr = '%d %d %d' % (etah, etam, etas)
-            else:
+        if v != None and v[0] != None and v[1] != None:
+            velo = v[0] if v[0] > 0 else 0.001
+            deviation = v[1] - bear
+            vmg = velo * math.cos(math.radians(deviation))
+            eta = int(dist / vmg)
+
+            if eta > 100 * 3600.:
                 etastr = '-----'
+            else:
+                (etah, etam, etas) = (eta / 3600, (eta / 60) % 60, eta % 60)
+                etastr = '%d %d %d' % (etah, etam, etas)
+        else:
+            etastr = '-----'
 
 
 
-#            writeText(etastr)
+#        hud.add(etastr, (-1.99, -1.06), (.7, .7))
 
     #scale bar
     global scales
@@ -415,90 +396,48 @@ def DrawGLScene():
     length = scale[0] / meters_per_pixel
     lab = scale[1]
 
-    with gltransform():
-        glTranslatef(1.95, (287+0)/256., 0)    
-
-        glDisable(GL_TEXTURE_2D)
-        glLineWidth(6)
-        glBegin(GL_LINE_STRIP)
-        color = (.2, .2, .2, .7) if low_contrast_mode(view) else (.9, .9, .9, .7)
-        glColor4f(*color)
-        glVertex3f(0, 0, 0.0)
-        glVertex3f(-length / 256., 0, 0.0)
-        glEnd()
+    low_contrast = low_contrast_mode(view)
 
-        with gltransform():
-            glTranslatef(0, -.08, 0)
-            glScalef(.5, .5, 1)
-            glTranslatef(-textLen(lab)/256., 0, 0)
-
-            glEnable(GL_TEXTURE_2D)
-            glBindTexture(GL_TEXTURE_2D, texttexid)
-
-            writeText(lab)
+    barx, bary = 1.95, (287+0)/256.
+    glDisable(GL_TEXTURE_2D)
+    overlay.draw_line([(barx, bary), (barx - length / 256., bary)],
+                      (.2, .2, .2, .7) if low_contrast else (.9, .9, .9, .7), 6)
+    hud.add(lab, (barx - .5 * hud.width(lab), bary - .08), (.5, .5))
 
     #position
-    tw = textLen(u'W999.99999\xb0')/256. + .02
+    tw = hud.width(u'W999.99999\xb0') + .02
     slat = u'%08.5f\xb0' % abs(pos_center[0])
     slon = u'%09.5f\xb0' % abs(pos_center[1])
 
-    with gltransform():
-        glTranslatef(-1.99, 1.015, 0)
-        glScalef(.7, .7, 0)
+    posx, posy = -1.99, 1.015
+    hud.add('N' if pos_center[0] >= 0 else 'S', (posx, posy), (.7, .7))
+    hud.add(slat, (posx + .7 * (tw - hud.width(slat)), posy), (.7, .7))
+    hud.add('E' if pos_center[1] >= 0 else 'W', (posx, posy + .07), (.7, .7))
+    hud.add(slon, (posx + .7 * (tw - hud.width(slon)), posy + .07), (.7, .7))
 
-        writeText('N' if pos_center[0] >= 0 else 'S')
-        with gltransform():
-            glTranslatef(tw - textLen(slat)/256., 0, 0)
-            writeText(slat)
+    if debug_overlay:
+        global debug_lines
+        if frame_start - debug_lines[0] > DEBUG_REFRESH:
+            debug_lines = (frame_start, ['timers (p50 p90 p99)'] + metrics.summary())
+        for i, line in enumerate(debug_lines[1]):
+            hud.add(line, (-1.99, -.95 + .05 * i), (.35, .35))
 
-        glTranslatef(0, .1, 0)
-        writeText('E' if pos_center[1] >= 0 else 'W')
-        glTranslatef(tw - textLen(slon)/256., 0, 0)
-        writeText(slon)
+    with metrics.timer('frame.text'):
+        hud.draw((.3, .3, .3, 1.) if low_contrast else (.8, .8, .8, 1.))
 
-    glutSwapBuffers()
+    with metrics.timer('frame.swap'):
+        glutSwapBuffers()
+    frame_end = time.time()
+    metrics.record('frame', frame_end - frame_start)
+    scheduler.drawn(frame_start, frame_end)
 
  except:
     logging.exception('')
     sys.exit()
 
-def textLen (str):
-    return sum([glyphtable[c if c in glyphtable else '?'][1] for c in str])
-
 def low_contrast_mode(view):
     return any(k in view for k in ('map', 'terr', 'topo'))
 
-def writeText (str):
-    xc = 0
-    for c in str:
-        (xo, sx, sy) = glyphtable[c if c in glyphtable else '?']
-
-        tx0 = xo / 1024.
-        tx1 = (xo + sx) / 1024.
-        ty0 = 1.
-        ty1 = 1 - (sy / 1024.)
-
-        cx0 = xc / 256.
-        cx1 = (xc + sx) / 256.
-        cy0 = 0.
-        cy1 = sy / 256.
-
-        glBegin(GL_QUADS)
-        color = (.3, .3, .3, 1.) if low_contrast_mode(view) else (.8, .8, .8, 1.)
-        glColor4f(*color)
-        glTexCoord2f(tx0, ty0) 
-        glVertex3f(cx0, cy0, 0.0)
-        glTexCoord2f(tx1, ty0) 
-        glVertex3f(cx1, cy0, 0.0)
-        glTexCoord2f(tx1, ty1) 
-        glVertex3f(cx1, cy1, 0.0)
-        glTexCoord2f(tx0, ty1) 
-        glVertex3f(cx0, cy1, 0.0)
-        glEnd()
-
-        xc += sx
-
-
 def cursalpha (phase):
     period = 1.2
     min = .2
@@ -519,6 +458,7 @@ def clock():
 def keyPressed(*args):
     global zoom
     global view
+    global debug_overlay
 
     if args[0] == 'z':
         zoom += 1
@@ -527,8 +467,13 @@ def keyPressed(*args):
             zoom -= 1
     elif args[0] == 'v':
         view = layers[(layers.index(view) + 1) % len(layers)]
+    elif args[0] == 'p':
+        scheduler.toggle_low_power()
+    elif args[0] == 'd':
+        debug_overlay = not debug_overlay
     elif args[0] == ESCAPE:
         texture_manager.terminate()
+        prefetcher.terminate()
         sys.exit()
     elif args[0] == 'm':
         k = gps.get_loc()
@@ -556,16 +501,28 @@ def main():
         #os.popen('wmctrl -r %s -b toggle,fullscreen' % windowname)
 
     glutDisplayFunc(DrawGLScene)
-    glutIdleFunc(DrawGLScene)
+    glutIdleFunc(Idle)
     glutReshapeFunc(ReSizeGLScene)
     glutKeyboardFunc(keyPressed)
 
     InitGL(SCREEN_WIDTH, SCREEN_HEIGHT)
 
+    global scheduler
+    scheduler = FrameScheduler()
+    metrics.gauge('display.fps', lambda: scheduler.stats()['fps'])
+    metrics.gauge('display.cpu', lambda: scheduler.stats()['cpu'])
+    if settings.METRICS_LOG_INTERVAL:
+        metrics.Dumper(settings.METRICS_LOG_INTERVAL).start()
+
     global texture_manager
     texture_manager = TextureThread(glGenTextures(1))
+    InitAtlasTexture(texture_manager.tex_id, texwidth, texheight)
     texture_manager.start()
 
+    global prefetcher
+    prefetcher = Prefetcher(gps, texwidth, texheight)
+    prefetcher.start()
+
     # todo: make layer selection specific to what's available in surrounding area
     global layers
     global view
@@ -6,10 +6,12 @@ from mapcache import mapdownload
 import settings
 import curses
 from mapcache import maptile as mt
-import math
+from mapcache import tilepack
+from mapcache import pyramid
 import time
 import logging
 import util.util as u
+from optparse import OptionParser
 
 from sqlalchemy.exc import InvalidRequestError
 
@@ -116,17 +118,21 @@ def db_validate(args):
             sess.commit()
         region = args['region']
 
+    args['boundary'] = region.boundary
     args['region'] = region.merc_poly()
 
 
 ## DOWNLOADER INTERFACE
 
-def download(poly, layers):
-    curses.wrapper(download_curses, poly, layers)
+def download(poly, layers, stream=False, job_id=None):
+    if stream:
+        curses.wrapper(download_curses_stream, poly, layers, job_id)
+    else:
+        curses.wrapper(download_curses, poly, layers)
 
 def download_curses(w, polygon, layers):
     te = mapdownload.TileEnumerator(polygon, layers)
-    monitor(w, 0, te, 'Enumerating', 15, 3)
+    monitor(w, 0, te, 'Enumerating', 15)
 
     print_tile_counts(w, mapdownload.tile_counts(te.tiles), 'Tiles in region', 4, 2)
 
@@ -138,6 +144,20 @@ def download_curses(w, polygon, layers):
     td = mapdownload.TileDownloader(tc.tiles, mt.dbsess())
     monitor(w, 2, td, 'Downloading', 15, erry=3)
 
+    wait_for_exit()
+
+def download_curses_stream(w, polygon, layers, job_id=None):
+    journal = mapdownload.JobJournal(mt.dbsess(), job_id) if job_id is not None else None
+    ts = mapdownload.TileStreamer(polygon, layers, mt.dbsess(), mt.dbsess(), journal=journal)
+    monitor(w, 0, ts, 'Downloading', 15, erry=1)
+
+    region_counts, download_counts = ts.tile_counts(max(L['zoom'] for L in layers))
+    print_tile_counts(w, region_counts, 'Tiles in region', 3, 2)
+    print_tile_counts(w, download_counts, 'Tiles downloaded', 3, 19)
+
+    wait_for_exit()
+
+def wait_for_exit():
     try:
         while True:
             time.sleep(.01)
@@ -146,17 +166,19 @@ def download_curses(w, polygon, layers):
 
 
 
-
-def monitor(w, y, thread, caption, width, sf=0, erry=None):
+def monitor(w, y, thread, caption, width, erry=None):
     thread.start()
     thread.start_at = time.time()
     while thread.isAlive():
-        update_status(w, thread, False, y, caption, width, sf, erry)
+        update_status(w, thread, y, caption, width, erry)
         time.sleep(.01)
-    update_status(w, thread, True, y, caption, width, sf, erry)
+    update_status(w, thread, y, caption, width, erry)
 
-def update_status(w, thread, done, y, caption, width, sf, erry):
-    println(w, status(caption, thread.status(), thread.start_at, width, sf if not done else 0), y)
+def update_status(w, thread, y, caption, width, erry):
+    line = status(caption, thread.status(), thread.start_at, width)
+    if hasattr(thread, 'status_detail'):
+        line += '   ' + thread.status_detail()
+    println(w, line, y)
  
     if erry != None:
         err = thread.last_error
@@ -168,27 +190,19 @@ def println(w, str, y, x=0):
     w.clrtoeol()
     w.refresh()
 
-def status(caption, (k, n, e), start_at, width=None, est_sigfig=0):
+def status(caption, (k, n, e), start_at, width=None):
     width = width if width else len(caption)
 
     ratio = float(k) / n if n > 0 else 1.
     overflow = ratio > 1.
     ratio = min(ratio, 1.)
 
-    if est_sigfig > 0:
-        digits = int(math.ceil(math.log10(n)))
-        trunc = max(digits - est_sigfig, 0)
-        n = int(round(n, -trunc))
-        max_str = '%d (est)' % n
-    else:
-        max_str = '%d' % n
-
     elapsed = u.format_interval(time.time() - start_at, colons=True, max_unit='h')
 
     pad = len(str(n))
     errstr = '   [Errors: %4d]' % e if e > 0 else ''
-    return '%s %s%6.2f%% [%*d/%s] [%s] %s' % ((caption + ':').ljust(width + 1), '+' if overflow else ' ',
-            100. * ratio, pad, k, max_str, elapsed, errstr)
+    return '%s %s%6.2f%% [%*d/%d] [%s] %s' % ((caption + ':').ljust(width + 1), '+' if overflow else ' ',
+            100. * ratio, pad, k, n, elapsed, errstr)
 
 def print_tile_counts(w, counts, header, y, x, width=None, zheader='Zoom'):
     if not width:
@@ -205,6 +219,24 @@ def print_tile_counts(w, counts, header, y, x, width=None, zheader='Zoom'):
 
 
 
+def print_plan(poly, layers):
+    for layer, counts, size in mapdownload.plan(poly, layers, mt.dbsess()):
+        print '%s: %d tiles, %s' % (layer, sum(counts), 'expected size %s' % format_bytes(size) if size is not None else 'size unknown')
+        for z, count in enumerate(counts):
+            if count:
+                print '  %4d %*d' % (z, len(str(sum(counts))), count)
+
+def format_bytes(n):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (n, unit)
+
+
+
 def fatal(msg):
     sys.stderr.write(msg + '\n')
     sys.exit()
@@ -214,8 +246,63 @@ if __name__ == "__main__":
 
     u.setup()
 
+    parser = OptionParser(usage='%prog [options] [profile]')
+    parser.add_option('--upgrade-db', dest='upgrade_db', action='store_true',
+                      help='migrate the tile database to the current schema and exit')
+    parser.add_option('--migrate-pack', dest='migrate_pack', action='store_true',
+                      help='copy all tiles stored as blobs or files into the tile pack and exit')
+    parser.add_option('--remove-migrated', dest='remove_migrated', action='store_true',
+                      help='with --migrate-pack, delete the original blobs/files once copied')
+    parser.add_option('--pyramid', dest='pyramid', action='append', metavar='LAYER',
+                      help='generate the missing lower-zoom tiles of LAYER by downsampling the tiles '
+                      'below them, and exit; may be given more than once')
+    parser.add_option('--plan', dest='plan', action='store_true',
+                      help='print the number of tiles in the region and the expected download size '
+                      'for each layer, and exit')
+    parser.add_option('--stream', dest='stream', action='store_true',
+                      help='enumerate, cull, and download tiles in a single streaming pass, instead of '
+                      'enumerating the whole region up front; for very large regions. the download is '
+                      'recorded as a job that can be resumed with --resume')
+    parser.add_option('--resume', dest='resume', type='int', metavar='JOB',
+                      help='resume an interrupted streaming download job')
+
+    (options, args) = parser.parse_args()
+
+    if options.upgrade_db:
+        if mt.upgrade_schema():
+            print 'tile database upgraded'
+        else:
+            print 'tile database is up to date'
+        sys.exit()
+
+    if options.migrate_pack:
+        def progress(n):
+            sys.stdout.write('\r%d tiles migrated' % n)
+            sys.stdout.flush()
+        tilepack.migrate(mt.dbsess(), options.remove_migrated, progress)
+        print
+        sys.exit()
+
+    if options.pyramid:
+        for layer in options.pyramid:
+            def progress(z, n):
+                sys.stdout.write('\r%s: z%d, %d tiles generated' % (layer, z, n))
+                sys.stdout.flush()
+            pyramid.build(mt.dbsess(), layer, onprogress=progress)
+            print
+        sys.exit()
+
+    if options.resume is not None:
+        job = mt.dbsess().query(mt.DownloadJob).get(options.resume)
+        if not job:
+            fatal('no download job %d' % options.resume)
+        if job.completed_on:
+            fatal('download job %d already completed' % job.id)
+        download(job.region().merc_poly(), job.layer_specs(), True, job.id)
+        sys.exit()
+
     try:
-        specfile = open(sys.argv[1])
+        specfile = open(args[0])
     except IndexError:
         specfile = sys.stdin
 
@@ -225,7 +312,20 @@ if __name__ == "__main__":
     except RuntimeError, e:
         fatal(str(e))
 
-    download(args['region'], args['layers'])
+    if options.plan:
+        print_plan(args['region'], args['layers'])
+        sys.exit()
+
+    job_id = None
+    if options.stream:
+        sess = mt.dbsess()
+        job = mt.DownloadJob(args['boundary'], args['layers'])
+        sess.add(job)
+        sess.commit()
+        job_id = job.id
+        print 'download job %d; if interrupted, resume with --resume %d' % (job_id, job_id)
+
+    download(args['region'], args['layers'], options.stream, job_id)
 
 
 
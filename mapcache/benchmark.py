@@ -0,0 +1,83 @@
+"""compare the recursive and scanline region tessellation engines, or time tile url
+formatting for each url template directive
+
+usage: python -m mapcache.benchmark [max zoom offset] [--no-check]
+       python -m mapcache.benchmark --urls [zoom]
+"""
+
+import sys
+import time
+import numpy as np
+from mapcache import maptile as mt
+from mapcache import mapdownload as md
+
+# (name, boundary as (lat, lon) points or None for the whole world, max zoom)
+REGIONS = [
+    ('world', None, 10),
+    ('massachusetts', [(42.87, -73.50), (42.75, -70.90), (42.30, -70.60), (41.55, -70.00),
+                       (41.30, -70.80), (42.00, -71.40), (42.00, -73.48)], 16),
+    ('i-95 corridor', [(25.77, -80.19), (25.78, -80.17), (42.37, -71.05), (42.36, -71.07)], 16),
+    ('bering strait', [(67.00, 168.00), (67.00, -165.00), (63.00, -165.00), (63.00, 168.00)], 14),
+    ('alps', [(45.8, 6.0), (46.5, 7.0), (47.3, 9.5), (47.7, 13.0), (46.9, 15.8), (46.3, 14.0),
+              (45.9, 11.0), (45.6, 8.5), (44.2, 7.0), (43.8, 7.5), (45.0, 5.8)], 15),
+]
+
+# (directive, url template exercising it)
+URL_TEMPLATES = [
+    ('{z}/{x}/{y}', 'http://tile.example.com/{z}/{x}/{y}.png'),
+    ('{-y}', 'http://tile.example.com/{z}/{x}/{-y}.png'),
+    ('{type}', 'http://tile.example.com/tile.{type}'),
+    ('{s:abc}', 'http://{s:abc}.tile.example.com/{z}/{x}/{y}.png'),
+    ('{s:0-7}', 'http://t{s:0-7}.tile.example.com/{z}/{x}/{y}.png'),
+    ('{qt}', 'http://tile.example.com/a{qt}.jpeg'),
+    ('{qt:ABCD}', 'http://tile.example.com/{qt:ABCD}.jpeg'),
+]
+URL_SAMPLE_SIZE = 100000 # tiles
+
+def timed(f):
+    start = time.time()
+    result = f()
+    return result, time.time() - start
+
+def run(name, boundary, max_zoom, check=True):
+    region = mt.Region.world() if boundary is None else mt.Region(name, boundary)
+    poly = region.merc_poly()
+
+    rec = mt.RegionTessellation(poly, max_zoom)
+    scan = mt.ScanlineTessellation(poly, max_zoom)
+
+    # time each engine producing tiles in its native form
+    count, t_rec = timed(lambda: sum(1 for t in rec))
+    _, t_scan = timed(lambda: [scan.zoom_tiles(z) for z in range(max_zoom + 1)])
+
+    match = 'ok'
+    if check:
+        diff = set(rec) ^ set(scan)
+        if diff:
+            match = 'MISMATCH (%d tiles)' % len(diff)
+
+    print '%-16s z%-3d %10d tiles   recursive %8.2fs   scanline %8.2fs   %6.1fx   %s' % (
+        name, max_zoom, count, t_rec, t_scan, t_rec / max(t_scan, 1e-6), match)
+
+def run_urls(name, template, z):
+    urlgen = md.precompile_tile_url(template, 'png')
+    xs = np.random.randint(0, 2**z, URL_SAMPLE_SIZE)
+    ys = np.random.randint(0, 2**z, URL_SAMPLE_SIZE)
+    tiles = zip(xs.tolist(), ys.tolist())
+
+    _, t_single = timed(lambda: [urlgen(z, x, y) for x, y in tiles])
+    _, t_batch = timed(lambda: urlgen.urls(z, xs, ys))
+
+    print '%-12s z%-3d   per tile %6.2fus   batch %6.2fus' % (
+        name, z, 1e6 * t_single / len(tiles), 1e6 * t_batch / len(tiles))
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if '--urls' in sys.argv:
+        for name, template in URL_TEMPLATES:
+            run_urls(name, template, int(args[0]) if args else 18)
+        sys.exit()
+
+    offset = int(args[0]) if args else 0
+    for name, boundary, max_zoom in REGIONS:
+        run(name, boundary, max_zoom + offset, '--no-check' not in sys.argv)
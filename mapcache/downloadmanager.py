@@ -4,25 +4,182 @@ from Queue import *
 import threading
 import socket
 import logging
+import collections
+import time
 import settings
 
+from tornado.ioloop import IOLoop
+from tornado.httpclient import HTTPRequest
+try:
+    # pools keep-alive connections
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as HTTPClient
+    ASYNC_KEEPALIVE = True
+except ImportError:
+    # opens a new connection per request
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as HTTPClient
+    ASYNC_KEEPALIVE = False
+
 REQUESTS_PER_CONN = 50
+DEFAULT_TERMINAL_STATUSES = [httplib.OK, httplib.NOT_FOUND, httplib.FORBIDDEN, httplib.FOUND]
+
+# responses telling us to slow down (as do timeouts/connection errors)
+THROTTLE_STATUSES = [429, httplib.SERVICE_UNAVAILABLE]
+INITIAL_WINDOW = 4 # concurrent requests per host
+MIN_RATE = 1. # requests/sec
+RATE_STEP = 10. # requests/sec added per second of healthy responses (roughly)
+BURST = .1 # seconds of requests allowed in a burst
+MIN_BACKOFF = 1. # seconds
+DECREASE_INTERVAL = 1. # seconds; cut limits at most this often
+MAX_BACKOFF = 300. # seconds
+LATENCY_TOLERANCE = 2. # latency is healthy if within this multiple of the best seen
+LATENCY_SMOOTHING = .1
+
+class HostLimiter(object):
+    """adaptive limits on requests to a single host: a token bucket limits the request
+    rate, and a window limits concurrent requests. both grow additively while the
+    host responds with healthy latency, and are halved (multiplicatively decreased)
+    when the host throttles us (429/503) or times out. if throttling persists (or the
+    host sends Retry-After), we also pause requests entirely, with exponential
+    backoff. thread-safe
+    """
+
+    def __init__(self, rate=settings.TILE_DL_HOST_RATE, max_rate=settings.TILE_DL_HOST_MAX_RATE,
+                 max_concurrency=settings.TILE_DL_HOST_CONCURRENCY, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.max_rate = max_rate
+        self.max_window = max_concurrency
+        self.rate = float(min(rate, max_rate))
+        self.window = float(min(INITIAL_WINDOW, max_concurrency))
+
+        self.tokens = 1.
+        self.last_refill = self.clock()
+        self.active = 0
+
+        self.resume_at = 0.
+        self.backoff = MIN_BACKOFF
+        self.last_decrease = 0.
+        self.strikes = 0 # consecutive throttled requests
+
+        self.latency = None # smoothed
+        self.best_latency = None
+
+    def acquire(self):
+        """try to start a request. return 0 if allowed (the request must then be
+        followed by release()); otherwise the seconds to wait before trying again, or
+        None if at the concurrency limit (try again once a request is released)"""
+        with self.lock:
+            now = self.clock()
+            if now < self.resume_at:
+                return self.resume_at - now
+            if self.active >= int(self.window):
+                return None
+
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, max(self.rate * BURST, 1.))
+            self.last_refill = now
+            if self.tokens < 1.:
+                return (1. - self.tokens) / self.rate
+
+            self.tokens -= 1.
+            self.active += 1
+            return 0
+
+    def release(self, status, latency, retry_after=None):
+        """record the outcome of a request
+
+        status -- http status; None for connection error/timeout
+        latency -- request time (seconds)
+        retry_after -- server-requested delay (seconds), if any
+        """
+        with self.lock:
+            self.active -= 1
+            now = self.clock()
+
+            if status is None or status in THROTTLE_STATUSES:
+                self.decrease(now, retry_after)
+            elif status < 500:
+                self.strikes = 0
+                self.backoff = MIN_BACKOFF
+                self.latency = latency if self.latency is None else (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+                self.best_latency = min(self.best_latency, self.latency) if self.best_latency is not None else self.latency
+                if self.latency <= LATENCY_TOLERANCE * self.best_latency:
+                    self.window = min(self.window + 1. / self.window, self.max_window)
+                    self.rate = min(self.rate + RATE_STEP / self.rate, self.max_rate)
+
+    def decrease(self, now, retry_after):
+        self.strikes += 1
+
+        # all requests in flight when the host got overloaded will likely fail
+        # together; only cut back once for them
+        if now - self.last_decrease > max(self.latency or 0., DECREASE_INTERVAL):
+            self.window = max(self.window / 2., 1.)
+            self.rate = max(self.rate / 2., MIN_RATE)
+            self.last_decrease = now
+            logging.info('backing off host: %d concurrent, %.1f req/s' % (int(self.window), self.rate))
+
+            if self.strikes > 1:
+                retry_after = max(retry_after or 0., self.backoff)
+                self.backoff = min(2 * self.backoff, MAX_BACKOFF)
+
+        if retry_after:
+            self.resume_at = max(self.resume_at, now + retry_after)
+
+    def status(self):
+        return '%d conc, %.0f/s' % (int(self.window), self.rate)
+
+class HostLimiters(object):
+    """the limiter for each host. hosts may be grouped (e.g., the shard hosts of a
+    layer: a.tiles.com, b.tiles.com, ...) to share one limiter. thread-safe"""
+
+    def __init__(self, host_groups=None):
+        """
+        host_groups -- mapping of host => group name; may be updated after creation.
+          hosts not present are their own group
+        """
+        self.host_groups = host_groups if host_groups is not None else {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def group(self, host):
+        return self.host_groups.get(host, host)
+
+    def get(self, host):
+        with self.lock:
+            group = self.group(host)
+            if group not in self.limiters:
+                self.limiters[group] = HostLimiter()
+            return self.limiters[group]
+
+    def status(self):
+        with self.lock:
+            return ' '.join('[%s: %s]' % (group, lim.status()) for group, lim in sorted(self.limiters.iteritems()))
+
+def parse_retry_after(value):
+    """seconds to wait from a Retry-After header; None if absent or an http-date"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 class DownloadManager(object):
     """a frontend for many downloading worker threads. this class is not actually
     a thread! it just mimics one (to manage the worker threads)
     """
 
-    def __init__(self, terminal_statuses=None, num_workers=10, num_retries=5, limit=1):
+    def __init__(self, terminal_statuses=None, num_workers=10, num_retries=5, limit=1, host_groups=None):
         """
         limit -- maximum buffer for processing; this prevents worker threads downloading
           items faster than they can be processed and filling up all memory
+        host_groups -- see HostLimiters
         """
-        terminal_statuses = terminal_statuses or [httplib.OK, httplib.NOT_FOUND, httplib.FORBIDDEN, httplib.FOUND]
+        terminal_statuses = terminal_statuses or DEFAULT_TERMINAL_STATUSES
 
         self.qin = Queue(limit)
         self.qout = Queue(limit)
-        self.workers = [DownloadWorker(self.qin, self.qout, terminal_statuses, num_retries) for i in range(num_workers)]
+        self.limiters = HostLimiters(host_groups)
+        self.workers = [DownloadWorker(self.qin, self.qout, terminal_statuses, num_retries, self.limiters) for i in range(num_workers)]
  
     def start(self):
         """start all workers"""
@@ -53,14 +210,158 @@ class DownloadManager(object):
         except Empty:
             return None
 
+class AsyncDownloadManager(object):
+    """a drop-in replacement for DownloadManager that runs all downloads from a single
+    event loop thread with tornado's non-blocking http client, so hundreds of requests
+    can be in flight at once. requests are also limited per host (see HostLimiter).
+    like DownloadManager, this class mimics a thread
+    """
+
+    def __init__(self, terminal_statuses=None, num_retries=5, limit=1, host_groups=None,
+                 max_in_flight=settings.TILE_DL_CONCURRENCY, timeout=settings.TILE_DL_TIMEOUT):
+        """
+        limit -- maximum buffer for processing; no new downloads are started while
+          this many downloaded items are awaiting fetch()
+        host_groups -- see HostLimiters
+        max_in_flight -- maximum concurrent requests overall
+        timeout -- request timeout (seconds)
+        """
+        self.terminal_statuses = terminal_statuses or DEFAULT_TERMINAL_STATUSES
+        self.num_retries = num_retries
+        self.limit = limit
+        self.limiters = HostLimiters(host_groups)
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.useragent = settings.TILE_DL_UA
+
+        self.qin = Queue(limit)
+        self.qout = Queue()
+
+        self.ioloop = IOLoop(make_current=False)
+        self.thread = threading.Thread(target=self.run)
+        self.client = None
+
+        # below are only touched from the event loop thread
+        self.waiting = collections.defaultdict(collections.deque) # host group => [(item, attempt #)] not yet started
+        self.wakeups = set() # host groups with a dispatch() scheduled
+        self.num_admitted = 0 # items taken in but not yet output
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        self.ioloop.make_current()
+        self.client = HTTPClient(force_instance=True, max_clients=self.max_in_flight)
+        try:
+            self.ioloop.start()
+        except:
+            logging.exception('unexpected exception in download event loop')
+        finally:
+            self.client.close()
+            self.ioloop.close()
+
+    def terminate(self):
+        if not self.qin.empty():
+            logging.warning('shutting down downloaders before queue empty')
+        self.ioloop.add_callback(self.ioloop.stop)
+
+    def join(self):
+        self.thread.join()
+
+    def enqueue(self, item):
+        """add a item to download"""
+        self.qin.put(item)
+        self.ioloop.add_callback(self.admit)
+
+    def fetch(self):
+        """retrieve a downloaded item for processing"""
+        try:
+            item = self.qout.get(True, 0.05)
+        except Empty:
+            return None
+        # room in the output buffer may let more downloads start
+        self.ioloop.add_callback(self.admit)
+        return item
+
+    def admit(self):
+        """take in new items while under the concurrency and output buffer limits"""
+        while self.num_admitted < self.max_in_flight and self.qout.qsize() < self.limit:
+            try:
+                item = self.qin.get_nowait()
+            except Empty:
+                break
+
+            group = self.limiters.group(urlparse(item[1]).netloc)
+            self.waiting[group].append((item, 0))
+            self.num_admitted += 1
+            self.dispatch(group)
+
+    def dispatch(self, group):
+        """start requests to the host group while its limiter allows"""
+        waiting = self.waiting[group]
+        while waiting:
+            limiter = self.limiters.get(group)
+            delay = limiter.acquire()
+            if delay is None:
+                # at the concurrency limit; we'll be called again when a request finishes
+                break
+            elif delay > 0:
+                if group not in self.wakeups:
+                    self.wakeups.add(group)
+                    self.ioloop.add_timeout(time.time() + delay, lambda: self.wakeup(group))
+                break
+
+            item, attempt = waiting.popleft()
+            self.download(group, limiter, item, attempt)
+
+    def wakeup(self, group):
+        self.wakeups.discard(group)
+        self.dispatch(group)
+
+    def download(self, group, limiter, item, attempt):
+        key, url = item
+        request = HTTPRequest(url, headers={'User-Agent': self.useragent, 'Accept': '*/*'},
+                              follow_redirects=False, request_timeout=self.timeout)
+        start = time.time()
+        future = self.client.fetch(request, raise_error=False)
+        self.ioloop.add_future(future, lambda f: self.on_response(group, limiter, item, attempt, start, f))
+
+    def on_response(self, group, limiter, item, attempt, start, future):
+        retry_after = None
+        try:
+            resp = future.result()
+        except Exception, e:
+            # newer tornados raise connection errors and timeouts even with raise_error=False
+            resp = None
+            status, data = None, '%s: %s' % (type(e), e)
+        if resp is not None:
+            if resp.code == 599:
+                # connection error or timeout
+                status, data = None, '%s: %s' % (type(resp.error), resp.error)
+            else:
+                status, data = resp.code, resp.body
+            retry_after = parse_retry_after(resp.headers.get('Retry-After') if resp.headers else None)
+        limiter.release(status, time.time() - start, retry_after)
+
+        if status not in self.terminal_statuses and attempt + 1 < self.num_retries:
+            self.waiting[group].appendleft((item, attempt + 1))
+        else:
+            key, _ = item
+            self.qout.put((key, status, data))
+            self.num_admitted -= 1
+
+        self.dispatch(group)
+        self.admit()
+
 class DownloadWorker(threading.Thread):
     """a downloading worker thread"""
 
-    def __init__(self, qin, qout, terminal_statuses, num_retries):
+    def __init__(self, qin, qout, terminal_statuses, num_retries, limiters):
         """
         terminal_statuses -- consider the download 'complete' if any of these statuses
           received, else, do a retry
         num_retries -- number of retries before giving up
+        limiters -- HostLimiters shared among all workers
         """
         threading.Thread.__init__(self)
         self.up = True
@@ -72,6 +373,7 @@ class DownloadWorker(threading.Thread):
         self.qout = qout
         self.terminal_statuses = terminal_statuses
         self.num_retries = num_retries
+        self.limiters = limiters
 
         # mapping of open connection to each host
         self.connections = {}
@@ -97,11 +399,22 @@ class DownloadWorker(threading.Thread):
         secure = (up.scheme == 'https')
         headers = {'User-Agent': self.useragent}
 
+        limiter = self.limiters.get(host)
         for t in range(self.num_retries):
+            while True:
+                delay = limiter.acquire()
+                if delay == 0:
+                    break
+                elif not self.up:
+                    return
+                time.sleep(min(delay, 1.) if delay is not None else 0.01)
+
+            start = time.time()
             try:
                 status, data = self.get_connection(host, secure).download(url, headers)
             except Exception, e:
                 status, data = None, '%s: %s' % (type(e), e)
+            limiter.release(status, time.time() - start)
 
             if status in self.terminal_statuses:
                 break
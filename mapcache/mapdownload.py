@@ -1,24 +1,59 @@
 import threading
+import multiprocessing
+import itertools
 import math
 import time
 from datetime import datetime, timedelta
 import random
 import os
 import httplib
+from urlparse import urlparse
 import Queue
 import hashlib
 import maptile as mt
-from downloadmanager import DownloadManager
+from downloadmanager import DownloadManager, AsyncDownloadManager, ASYNC_KEEPALIVE
+import tileset
+from tileset import TileSet
 import settings
 import util.util as u
 import re
 import collections
 import logging
+import numpy as np
 
-from sqlalchemy.sql.expression import tuple_, or_, and_
+from sqlalchemy import Table, MetaData, Column, Integer
+from sqlalchemy.sql.expression import tuple_, or_, and_, select, false
 
 HASH_LENGTH = 8 # bytes
 CULL_RESOLUTION = 100 # tiles
+CULL_WINDOW_SIZE = 50000 # max tiles checked against the db per query
+CULL_WINDOW_SPARSENESS = 4 # max ratio of a culling window's bounding box area to its # tiles
+# check zoom levels with at least this many tiles by joining against a temporary
+# table of the tiles on the db server, instead of by range scans (None to never)
+CULL_TEMP_TABLE_MIN = None
+CULL_TEMP_TABLE_BATCH = 10000 # rows per insert when loading the temporary table
+COMMIT_BATCH_SIZE = 200 # tiles
+COMMIT_BATCH_INTERVAL = 0.5 # seconds
+STREAM_CHUNK_SIZE = 5000 # tiles
+URL_FORMAT_CACHE_SIZE = 1000 # compiled url templates kept per layer, for layers whose template varies by tile
+ENUMERATE_SPLIT_ZOOM = 4 # enumeration is parallelized across the subtrees at this zoom level
+SIZE_SAMPLE_PROBES = 10
+SIZE_SAMPLE_PROBE_SIZE = 20 # tiles
+
+# shard host => name of its group of shard hosts, for all tile url templates seen
+# so far; shards of the same server share rate limits when downloading
+SHARD_HOST_GROUPS = {}
+
+def download_manager(**kw):
+    """create a download manager using the configured download engine"""
+    kw.setdefault('host_groups', SHARD_HOST_GROUPS)
+    use_async = settings.TILE_DL_ASYNC
+    if use_async and not ASYNC_KEEPALIVE:
+        # without pycurl every tile would need a new connection; the threaded
+        # engine at least keeps one open per worker
+        logging.warning('pycurl not installed; using threaded downloads instead of TILE_DL_ASYNC')
+        use_async = False
+    return (AsyncDownloadManager if use_async else DownloadManager)(**kw)
 
 def null_digest():
     """special digest for tiles with no data (e.g., missing tiles)"""
@@ -28,24 +63,48 @@ def tile_url((zoom, x, y), layer):
     """download url for a tile and layer"""
     L = settings.LAYERS[layer]
     if '_tileurl' not in L:
+        urlgen = tile_url_format(layer)
+        if urlgen is None:
+            return 'http://-fail.blog' # trigger 'domain not known' error
+        L['_tileurl'] = urlgen.url if isinstance(urlgen, TileUrlFormat) else urlgen
+    return L['_tileurl'](zoom, x, y)
+
+def tile_urls(layer, z, xs, ys):
+    """download urls for arrays of tile x/y coordinates at zoom level 'z' for a layer,
+    as a list"""
+    urlgen = tile_url_format(layer)
+    if isinstance(urlgen, TileUrlFormat):
+        return urlgen.urls(z, xs, ys)
+    return [tile_url((z, x, y), layer) for x, y in zip(np.asarray(xs).tolist(), np.asarray(ys).tolist())]
+
+def tile_url_format(layer):
+    """the compiled url format for a layer: a TileUrlFormat, or a function (z, x, y)
+    => url for layers whose url template varies by tile. None if initializing the
+    layer's url failed"""
+    L = settings.LAYERS[layer]
+    if '_tileurlformat' not in L:
         urlgen = L['tile_url']
         if hasattr(urlgen, '__call__'):
             urlgen = init_tile_url(layer, urlgen)
             if urlgen is None:
-                # init failure; don't set _tile_url so init will be attempted
+                # init failure; don't set _tileurlformat so init will be attempted
                 # again on next call (not useful for bulk download but yes for
                 # on-the-fly tile service)
-                return 'http://-fail.blog' # trigger 'domain not known' error
+                return None
 
         if hasattr(urlgen, '__call__'):
+            compiled = {} # template => TileUrlFormat
             def format_url(z, x, y):
                 template = urlgen(z, x, y)
-                compiled = precompile_tile_url(template, L.get('file_type'))
-                return compiled(z, x, y)
-            L['_tileurl'] = format_url
+                if template not in compiled:
+                    if len(compiled) > URL_FORMAT_CACHE_SIZE:
+                        compiled.clear()
+                    compiled[template] = precompile_tile_url(template, L.get('file_type'))
+                return compiled[template].url(z, x, y)
+            L['_tileurlformat'] = format_url
         else:
-            L['_tileurl'] = precompile_tile_url(urlgen, L.get('file_type'))
-    return L['_tileurl'](zoom, x, y)
+            L['_tileurlformat'] = precompile_tile_url(urlgen, L.get('file_type'))
+    return L['_tileurlformat']
 
 def init_tile_url(layer, urlinit):
     try:
@@ -53,69 +112,186 @@ def init_tile_url(layer, urlinit):
     except:
         logging.exception('error initializing url format for layer [%s]' % layer)
 
+class TileUrlFormat(object):
+    """a tile url template compiled into a formatter specialized for the directives it
+    contains. the directives' values are computed inline and fed positionally to a
+    single format string, with no per-call dict of fields
+
+    directives:
+      {z}, {x}, {y} -- tile coordinates
+      {-y} -- y counted from the bottom (tms)
+      {type} -- the layer's file type
+      {s:abc}, {s:1-4} -- shard (server) name, by letter or number range; picked per tile
+      {qt}, {qt:ABCD} -- quadtree index, optionally with a custom digit alphabet
+    """
+
+    DIRECTIVE = re.compile(r'\{(?P<name>z|x|y|-y|s(?=:)|qt)(:(?P<spec>[^\}]+))?\}')
+
+    def __init__(self, template, file_type=None):
+        self.template = template
+
+        # protect '%' in original string as we convert to format string
+        template = '%%'.join(template.split('%')).replace('{type}', file_type or '')
+
+        self.fields = [] # (directive name, shards or quadindex alphabet)
+        env = {}
+        exprs = []
+        def compile_directive(match):
+            name, spec = match.group('name'), match.group('spec')
+            i = len(self.fields)
+            if name == 's':
+                shards = self.parse_shards(match.group(0), spec, template)
+                env['shards%d' % i] = shards
+                exprs.append('shards%d[(x + y) %% %d]' % (i, len(shards)))
+                self.fields.append((name, shards))
+                return '%s'
+            elif name == 'qt':
+                env['qt%d' % i] = u.quadindex_formatter(spec)
+                exprs.append('qt%d(z, x, y)' % i)
+                self.fields.append((name, spec))
+                return '%s'
+            else:
+                exprs.append({'-y': '((1 << z) - 1 - y)'}.get(name, name))
+                self.fields.append((name, None))
+                return '%d'
+        env['fmt'] = self.fmtstr = self.DIRECTIVE.sub(compile_directive, template)
+
+        self.url = eval('lambda z, x, y: fmt %% (%s)' % ''.join(e + ', ' for e in exprs), env)
+
+    def parse_shards(self, tag, spec, template):
+        if '-' in spec:
+            min, max = (int(k) for k in spec.split('-'))
+            shards = [str(k) for k in range(min, max + 1)]
+        else:
+            shards = list(spec)
+
+        # shards of the same server share rate limits when downloading
+        template = template.replace('%%', '%')
+        group = urlparse(template).netloc
+        for shard in shards:
+            SHARD_HOST_GROUPS[urlparse(template.replace(tag, shard)).netloc] = group
+        return shards
+
+    def __call__(self, z, x, y):
+        return self.url(z, x, y)
+
+    def urls(self, z, xs, ys):
+        """format urls for arrays of tile x/y coordinates at zoom level 'z'; return a
+        list"""
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+
+        def column(name, spec):
+            if name == 'z':
+                return itertools.repeat(z)
+            elif name == 'x':
+                return xs.tolist()
+            elif name == 'y':
+                return ys.tolist()
+            elif name == '-y':
+                return ((1 << z) - 1 - ys).tolist()
+            elif name == 's':
+                return np.array(spec, dtype=object)[(xs + ys) % len(spec)].tolist()
+            elif name == 'qt':
+                return tileset.quadindices(z, xs, ys, spec)
+
+        if not self.fields:
+            return [self.fmtstr % ()] * len(xs)
+        fmtstr = self.fmtstr
+        return [fmtstr % f for f in itertools.izip(*(column(*field) for field in self.fields))]
+
 def precompile_tile_url(template, file_type):
     """precompile the tile url format into a form that can be templated efficiently"""
-    replacements = {
-        '{z}': '%(z)d',
-        '{x}': '%(x)d',
-        '{y}': '%(y)d',
-        '{-y}': '%(inv_y)d',
-        '{type}': file_type or '',
-    }
-
-    # protect '%' in original string as we convert to format string
-    template = '%%'.join(template.split('%'))
-
-    shards = []
-    shard_match = re.search(r'\{s:(?P<spec>[^\}]+)\}', template)
-    if shard_match:
-        shard_tag = shard_match.group(0)
-        shard_spec = shard_match.group('spec')
-
-        if '-' in shard_spec:
-            min, max = (int(k) for k in shard_spec.split('-'))
-            shards = range(min, max + 1)
-        else:
-            shards = list(shard_spec)
-        replacements[shard_tag] = '%(shard)s'
-
-    make_qt = None
-    qt_match = re.search(r'\{qt(:(?P<spec>[^\}]+))?\}', template)
-    if qt_match:
-        qt_tag = qt_match.group(0)
-        qt_spec = qt_match.group('spec')
-
-        make_qt = lambda z, x, y: u.to_quadindex(z, x, y, qt_spec)
-        replacements[qt_tag] = '%(qt)s'
-
-    fmtstr = reduce(lambda s, (old, new): new.join(s.split(old)), replacements.iteritems(), template)
-    def _url(z, x, y):
-        if shards:
-            shard = shards[(x + y) % len(shards)]
-        if make_qt:
-            qt = make_qt(z, x, y)
-        inv_y = 2**z - 1 - y
-        return fmtstr % locals()
-    return _url
-
-def query_tiles(sess, layer, chunk, refresh_cutoff, refresh_cutoff_missing):
-    """see existing_tiles; query the set of tiles 'chunk' to see which already exist.
-    'cutoff's are timestamps instead of intervals now"""
-    q = sess.query(mt.Tile).filter_by(layer=layer).filter(tuple_(mt.Tile.z, mt.Tile.x, mt.Tile.y).in_(list(chunk)))
-    def cutoff_criteria():
-        if refresh_cutoff is not None:
-            yield and_(mt.Tile.uuid != null_digest(), mt.Tile.fetched_on > refresh_cutoff)
-        if refresh_cutoff_missing is not None:
-            yield and_(mt.Tile.uuid == null_digest(), mt.Tile.fetched_on > refresh_cutoff_missing)
-    coc = list(cutoff_criteria())
-    if coc:
-        q = q.filter(or_(*coc))
-    return set((layer, t.z, t.x, t.y) for t in q)
-
-def find_existing_tiles(sess, tiles, layer, refresh_window=None, refresh_window_missing=None, chunk_size=CULL_RESOLUTION):
-    """generator that returns which tiles in the set 'tiles' already exist. if a
+    return TileUrlFormat(template, file_type)
+
+def cull_windows(keys, window_size=CULL_WINDOW_SIZE, sparseness=CULL_WINDOW_SPARSENESS):
+    """split a sorted array of packed tile keys (for a single layer and zoom level)
+    into windows to query the db with; yield (index of first key, index past last key,
+    (xmin, xmax, ymin, ymax)) for each. a window is a run of whole columns (columns
+    with more than 'window_size' tiles are split) whose bounding box is at most
+    'sparseness' times larger than the # of tiles in it, so a range scan over the
+    bounding box doesn't drag in too many tiles outside the region"""
+    if not len(keys):
+        return
+
+    xs, ys = tileset.unpack(keys)
+    col_start = np.concatenate([[0], np.flatnonzero(np.diff(xs)) + 1])
+    is_col_start = np.zeros(len(keys), dtype=bool)
+    is_col_start[col_start] = True
+    col_ix = np.cumsum(is_col_start) - 1
+    pos = np.arange(len(keys)) - col_start[col_ix]
+    seg_start = np.flatnonzero(pos % window_size == 0)
+    seg_end = np.concatenate([seg_start[1:], [len(keys)]])
+
+    seg_x = xs[seg_start].tolist()
+    seg_ymin = ys[seg_start].tolist()
+    seg_ymax = ys[seg_end - 1].tolist()
+    seg_start = seg_start.tolist()
+    seg_end = seg_end.tolist()
+
+    window = None
+    for i in range(len(seg_start)):
+        if window:
+            first, last, (xmin, xmax, ymin, ymax) = window
+            bbox = (xmin, seg_x[i], min(ymin, seg_ymin[i]), max(ymax, seg_ymax[i]))
+            size = seg_end[i] - first
+            area = (bbox[1] - bbox[0] + 1) * (bbox[3] - bbox[2] + 1)
+            if size <= window_size and area <= sparseness * size:
+                window = (first, seg_end[i], bbox)
+                continue
+            yield window
+        window = (seg_start[i], seg_end[i], (seg_x[i], seg_x[i], seg_ymin[i], seg_ymax[i]))
+    yield window
+
+def packed_keys(result):
+    """array of packed keys from a query result of (x, y) rows"""
+    xy = np.fromiter(itertools.chain.from_iterable(result), dtype=np.int64).reshape(-1, 2)
+    return tileset.pack(xy[:, 0], xy[:, 1])
+
+def query_window(sess, layer, z, (xmin, xmax, ymin, ymax), criteria):
+    """range scan for the tiles that exist within a bounding box; return a sorted
+    array of packed keys"""
+    T = mt.Tile.__table__
+    q = select([T.c.x, T.c.y]).where(and_(T.c.layer == layer, T.c.z == z,
+                                          T.c.x.between(xmin, xmax), T.c.y.between(ymin, ymax),
+                                          T.c.synthetic == false()))
+    if criteria:
+        q = q.where(or_(*criteria))
+    return packed_keys(sess.execute(q.order_by(T.c.x, T.c.y)))
+
+def query_joined(sess, layer, z, keys, criteria):
+    """find which of the tiles in 'keys' exist by loading them into a temporary table
+    on the db server and joining against it; return a sorted array of packed keys"""
+    T = mt.Tile.__table__
+    cands = Table('cull_candidates', MetaData(), Column('x', Integer), Column('y', Integer),
+                  prefixes=['TEMPORARY'])
+    conn = sess.connection()
+    cands.create(conn)
+    try:
+        xs, ys = tileset.unpack(keys)
+        for chunk in u.chunker(zip(xs.tolist(), ys.tolist()), CULL_TEMP_TABLE_BATCH):
+            conn.execute(cands.insert(), [{'x': x, 'y': y} for x, y in chunk])
+        q = select([T.c.x, T.c.y]).where(and_(T.c.layer == layer, T.c.z == z,
+                                              T.c.x == cands.c.x, T.c.y == cands.c.y,
+                                              T.c.synthetic == false()))
+        if criteria:
+            q = q.where(or_(*criteria))
+        keys = packed_keys(conn.execute(q))
+    finally:
+        cands.drop(conn)
+    return np.unique(keys)
+
+def find_existing_tiles(sess, tiles, layer, refresh_window=None, refresh_window_missing=None):
+    """generator that returns which tiles for 'layer' in 'tiles' (a TileSet) already
+    exist, as (zoom, sorted array of packed keys, # tiles queried). if a
     'refresh_window' is defined, only tiles fetched within that days (e.g., 7 days)
-    are considered to exist.
+    are considered to exist. synthetic tiles (see mapcache.pyramid) never count as
+    existing, so real tiles are downloaded in their place
+
+    tiles are checked a window at a time: each window's bounding box is range-scanned
+    (along the primary key) and the existing tiles intersected with the window
+    locally. zoom levels with at least CULL_TEMP_TABLE_MIN tiles are instead checked
+    with a join against a server-side temporary table
 
     refresh_window -- lookback window for tiles with actual data
     refresh_window_missing -- lookback window for tiles that were missing in the map layer
@@ -127,45 +303,174 @@ def find_existing_tiles(sess, tiles, layer, refresh_window=None, refresh_window_
     refresh_cutoff = cutoff(refresh_window)
     refresh_cutoff_missing = cutoff(refresh_window_missing)
 
-    for chunk in u.chunker(tiles, chunk_size):
-        yield (query_tiles(sess, layer, chunk, refresh_cutoff, refresh_cutoff_missing), len(chunk))
+    T = mt.Tile.__table__
+    def cutoff_criteria():
+        if refresh_cutoff is not None:
+            yield and_(T.c.uuid != null_digest(), T.c.fetched_on > refresh_cutoff)
+        if refresh_cutoff_missing is not None:
+            yield and_(T.c.uuid == null_digest(), T.c.fetched_on > refresh_cutoff_missing)
+    criteria = list(cutoff_criteria())
+
+    for z in tiles.zooms(layer):
+        keys = tiles.get_keys(layer, z)
+        if CULL_TEMP_TABLE_MIN is not None and len(keys) >= CULL_TEMP_TABLE_MIN:
+            yield (z, query_joined(sess, layer, z, keys, criteria), len(keys))
+            continue
+
+        for first, last, bbox in cull_windows(keys):
+            window = keys[first:last]
+            found = query_window(sess, layer, z, bbox, criteria)
+            yield (z, np.intersect1d(window, found, assume_unique=True), len(window))
+
+class TileGrid(object):
+    """spatial index of the tiles at a single zoom level (across layers), bucketed
+    into square cells. cells are only expanded into python sets of tiles once visited"""
+
+    def __init__(self, tiles, cell_size):
+        """tiles -- TileSet of tiles at a single zoom level"""
+        self.cell_size = cell_size
+
+        self.layers = tiles.layers()
+        layer_ix, xs, ys = [], [], []
+        for i, layer in enumerate(self.layers):
+            z = tiles.zooms(layer)[0]
+            x, y = tileset.unpack(tiles.get_keys(layer, z))
+            layer_ix.append(np.zeros(len(x), dtype=np.int64) + i)
+            xs.append(x)
+            ys.append(y)
+        self.z = z if self.layers else None
+        self.layer_ix = np.concatenate(layer_ix) if layer_ix else np.zeros(0, dtype=np.int64)
+        self.xs = np.concatenate(xs) if xs else np.zeros(0, dtype=np.int64)
+        self.ys = np.concatenate(ys) if ys else np.zeros(0, dtype=np.int64)
+
+        cells = tileset.pack(self.xs // cell_size, self.ys // cell_size)
+        order = np.argsort(cells, kind='mergesort')
+        self.layer_ix, self.xs, self.ys, cells = [a[order] for a in (self.layer_ix, self.xs, self.ys, cells)]
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(cells)) + 1, [len(cells)]])
+        cxs, cys = tileset.unpack(cells[bounds[:-1]])
+
+        self.unexpanded = dict(((cx, cy), (start, end)) for cx, cy, start, end in
+                               zip(cxs.tolist(), cys.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()))
+        self.expanded = {} # cell => set of tiles
+        self.count = len(self.xs)
+
+    def __len__(self):
+        return self.count
+
+    def num_cells(self):
+        return len(self.unexpanded) + len(self.expanded)
+
+    def cells(self):
+        return self.unexpanded.keys() + self.expanded.keys()
+
+    def cell(self, (x, y)):
+        return (x // self.cell_size, y // self.cell_size)
+
+    def cell_tiles(self, cell):
+        """set of remaining tiles in a cell, or None if the cell is empty"""
+        if cell in self.unexpanded:
+            start, end = self.unexpanded.pop(cell)
+            self.expanded[cell] = set((self.layers[i], self.z, x, y) for i, x, y in
+                                      zip(self.layer_ix[start:end].tolist(), self.xs[start:end].tolist(), self.ys[start:end].tolist()))
+        return self.expanded.get(cell)
+
+    def tile_at(self, i):
+        """the i'th tile, in no particular order; only valid before any are removed"""
+        return (self.layers[self.layer_ix[i]], self.z, int(self.xs[i]), int(self.ys[i]))
+
+    def pop_box(self, xmin, ymin, xmax, ymax):
+        """remove and return the tiles within the box (inclusive)"""
+        popped = []
+        for cx in range(xmin // self.cell_size, xmax // self.cell_size + 1):
+            for cy in range(ymin // self.cell_size, ymax // self.cell_size + 1):
+                tiles = self.cell_tiles((cx, cy))
+                if not tiles:
+                    continue
+                box = [t for t in tiles if t[2] >= xmin and t[2] <= xmax and t[3] >= ymin and t[3] <= ymax]
+                tiles.difference_update(box)
+                if not tiles:
+                    del self.expanded[(cx, cy)]
+                popped.extend(box)
+        self.count -= len(popped)
+        return popped
+
+    def ring(self, (cx, cy), r):
+        """cells at chebyshev distance 'r' from a cell"""
+        if r == 0:
+            return [(cx, cy)]
+        return ([(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)] +
+                [(cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r)])
+
+    def rings(self, cell):
+        """yield (r, cells at chebyshev distance 'r' from 'cell') moving outward. once
+        the rings outgrow the # of non-empty cells left, only the non-empty cells are
+        yielded, grouped by distance"""
+        r = 0
+        while True:
+            ring = self.ring(cell, r)
+            if len(ring) > self.num_cells():
+                break
+            yield (r, ring)
+            r += 1
+
+        dist = lambda (cx, cy): max(abs(cx - cell[0]), abs(cy - cell[1]))
+        by_dist = u.map_reduce(self.cells(), lambda c: [(dist(c), c)])
+        for d in sorted(by_dist.keys()):
+            if d >= r:
+                yield (d, by_dist[d])
+
+    def nearest(self, xy):
+        """the remaining tiles tied for closest (by manhattan distance) to a point"""
+        best, closest = None, []
+        for r, cells in self.rings(self.cell(xy)):
+            # tiles 'r' cells away are at least this far
+            if best is not None and best < (r - 1) * self.cell_size + 1:
+                break
+            for cell in cells:
+                for t in (self.cell_tiles(cell) or []):
+                    d = u.manhattan_dist(xy, t[2:])
+                    if best is None or d < best:
+                        best, closest = d, []
+                    if d == best:
+                        closest.append(t)
+        return closest
 
 def random_walk_level(tiles, window=10):
-    """iterate through the tiles for a given zoom level in a random-walky
-    fashion, to make it less obvious that tiles are being ripped by a
-    script"""
+    """iterate through the tiles for a given zoom level (a TileSet) in a random-walky
+    fashion, to make it less obvious that tiles are being ripped by a script
+
+    tiles are indexed in a grid of window-sized cells, so each step only has to look
+    at the cells around the current point"""
+
+    grid = TileGrid(tiles, window)
 
     def xy(t):
         return t[2:]
 
     target = None
-    while tiles:
+    while len(grid):
         if not target:
             # pick a random starting point
-            target = u.rand_elem(tiles)
+            target = grid.tile_at(random.randint(0, len(grid) - 1))
         else:
             # pick the as-yet-unvisited tile closest to the previous active point
-            metric = lambda t: u.manhattan_dist(xy(target), xy(t))
-            closest = min(metric(t) for t in tiles)
-            candidates = [t for t in tiles if metric(t) == closest]
-            target = random.choice(candidates)
+            target = random.choice(grid.nearest(xy(target)))
 
         # determine the current 'screen view' centered around the active point (width 'window'),
         # and download in random order
         (xmin, ymin) = [f - window / 2 for f in xy(target)]
         (xmax, ymax) = [f + window - 1 for f in (xmin, ymin)]
 
-        swatch = list(u.set_filter(tiles, lambda (lyr, z, x, y): x >= xmin and x <= xmax and y >= ymin and y <= ymax))
+        swatch = grid.pop_box(xmin, ymin, xmax, ymax)
         random.shuffle(swatch)
         for t in swatch:
             yield t
 
 def random_walk(tiles):
-    """iterate through all tiles in a random-walk fashion, but proceeding through
-    zoom levels in order (download 'bigger' tiles first)"""
-    zooms = sorted(set(z for lyr, z, x, y in tiles))
-    for zoom in zooms:
-        for t in random_walk_level(u.set_filter(tiles, lambda (lyr, z, x, y): z == zoom)):
+    """iterate through all tiles (a TileSet) in a random-walk fashion, but proceeding
+    through zoom levels in order (download 'bigger' tiles first). consumes 'tiles'"""
+    for zoom in tiles.zooms():
+        for t in random_walk_level(tiles.pop_zoom(zoom)):
             yield t
 
 def register_tile(sess, tile, data, hashfunc):
@@ -181,6 +486,7 @@ def commit_tile(sess, t):
         if existing.uuid != t.uuid:
             old_uuid = existing.uuid
             existing.uuid = t.uuid
+        existing.synthetic = t.synthetic or False
     else:
         sess.add(t)
 
@@ -192,6 +498,47 @@ def commit_tile(sess, t):
 
     sess.commit()
 
+def register_tiles(sess, tiles, hashfunc):
+    """batched equivalent of register_tile; 'tiles' is a list of (tile, data)"""
+    mt.Tile.save_all(tiles, hashfunc, sess)
+    commit_tiles(sess, [t for t, data in tiles])
+
+def commit_tiles(sess, tiles):
+    """batched equivalent of commit_tile: resolve existing tiles and orphaned image
+    data with set-based queries, and write all tiles in a single transaction"""
+    by_pk = dict((t.pk(), t) for t in tiles)
+
+    existing = {}
+    by_layer = u.map_reduce(by_pk.keys(), lambda (layer, z, x, y): [(layer, (z, x, y))])
+    for layer, pks in by_layer.iteritems():
+        for chunk in u.chunker(pks, CULL_RESOLUTION):
+            q = sess.query(mt.Tile).filter_by(layer=layer).filter(tuple_(mt.Tile.z, mt.Tile.x, mt.Tile.y).in_(chunk))
+            existing.update((t.pk(), t) for t in q)
+
+    old_uuids = set()
+    for pk, t in by_pk.iteritems():
+        if pk in existing:
+            # if tile exists, update the existing tile object
+            if existing[pk].uuid != t.uuid:
+                old_uuids.add(existing[pk].uuid)
+                existing[pk].uuid = t.uuid
+            existing[pk].synthetic = t.synthetic or False
+        else:
+            sess.add(t)
+
+    # if updated existing tiles, possibly delete the old tile image data
+    old_uuids.discard(null_digest())
+    if old_uuids:
+        sess.flush()
+        referenced = set()
+        for chunk in u.chunker(list(old_uuids), CULL_RESOLUTION):
+            referenced.update(r[0] for r in sess.query(mt.Tile.uuid).filter(mt.Tile.uuid.in_(chunk)).distinct())
+        for uuid in old_uuids - referenced:
+            # no tile references this file uuid anymore; delete
+            mt.TileData(uuid=uuid).remove(sess)
+
+    sess.commit()
+
 def digest(data):
     if data is not None:
         return hashlib.sha1(data).hexdigest()[:HASH_LENGTH*2]
@@ -206,13 +553,15 @@ def normdata(status, data):
 
 def _process_tile(sess, tile, status, data):
     """process a tile download result, accounting for some common errors"""
+    check_status(tile, status, data)
+    try:
+        register_tile(sess, tile, normdata(status, data), digest)
+    except IOError:
+        raise Exception('%s: could not write file' % str(tile.pk()))
 
-    if status in (httplib.OK, httplib.NOT_FOUND, httplib.FOUND):
-        try:
-            register_tile(sess, tile, normdata(status, data), digest)
-        except IOError:
-            raise Exception('%s: could not write file' % str(tile.pk()))
-    else:
+def check_status(tile, status, data):
+    """raise an error if the tile download result can't be processed"""
+    if status not in (httplib.OK, httplib.NOT_FOUND, httplib.FOUND):
         if status == None:
             raise Exception('Tile %s: download error %s' % (str(tile.pk()), data))
         elif status == httplib.FORBIDDEN:
@@ -227,39 +576,156 @@ def process_tile(sess, tile, status, data):
     except Exception, e:
         return (False, str(e))
 
+def process_tiles(sess, items):
+    """batched equivalent of process_tile; 'items' is a list of (tile, status, data).
+    return a list of (success, error message) for each item"""
+    results = [None] * len(items)
+    valid = []
+    for i, (tile, status, data) in enumerate(items):
+        try:
+            check_status(tile, status, data)
+            valid.append(i)
+        except Exception, e:
+            results[i] = (False, str(e))
+
+    try:
+        register_tiles(sess, [(items[i][0], normdata(*items[i][1:])) for i in valid], digest)
+        for i in valid:
+            results[i] = (True, None)
+    except Exception:
+        # fall back to processing one at a time, to isolate the failing tile(s)
+        logging.exception('batch commit failed; retrying tiles individually')
+        sess.rollback()
+        for i in valid:
+            results[i] = process_tile(sess, *items[i])
+    return results
+
 def tile_counts(tiles, max_depth=None):
-    """determine how many tiles to be downloaded at each zoom level"""
-    totals = collections.defaultdict(lambda: 0, u.map_reduce(tiles, lambda (layer, z, x, y): [(z,)], len))
-    max_tile_zoom = max(totals.keys()) if totals else -1
+    """determine how many tiles (a TileSet) to be downloaded at each zoom level"""
+    totals = tiles.zoom_counts()
     max_depth = max_depth if max_depth is not None else -1
-    return [totals[z] for z in range(max(max_tile_zoom, max_depth) + 1)]
+    return [totals[z] if z < len(totals) else 0 for z in range(max(len(totals) - 1, max_depth) + 1)]
+
+def sample_tile_size(sess, layer, num_probes=SIZE_SAMPLE_PROBES, probe_size=SIZE_SAMPLE_PROBE_SIZE):
+    """estimate the average size (bytes) of a tile for 'layer', from a sample of the
+    tiles already downloaded; None if there are none. missing tiles count as 0 bytes
+
+    tiles are sampled as runs of consecutive tiles starting from random points in
+    the quadtree key index, so sampling never scans the whole table
+    """
+    sample = {}
+    for i in range(num_probes):
+        start = random.randint(0, 2**(2 * u.QTKEY_MAX_ZOOM + 1))
+        q = sess.query(mt.Tile).filter_by(layer=layer, synthetic=False).filter(mt.Tile.qtkey >= start).order_by(mt.Tile.qtkey).limit(probe_size)
+        sample.update((t.pk(), t) for t in q)
+
+    sizes = []
+    for t in sample.values():
+        if t.is_null():
+            sizes.append(0)
+        else:
+            data = t.load(sess)
+            if data is not None:
+                sizes.append(len(data))
+    return float(sum(sizes)) / len(sizes) if sizes else None
+
+def plan(region, layers, sess):
+    """count exactly the tiles in the region for each layer, and estimate the total
+    download size; return a list of (layer name, list[zoom] = # tiles, expected
+    bytes or None if unknown). counts don't account for tiles that already exist"""
+    def layer_plan(layer):
+        counts = layer_tessellation(region, layer).zoom_counts()
+        avg_size = sample_tile_size(sess, layer['name'])
+        return (layer['name'], counts, int(sum(counts) * avg_size) if avg_size is not None else None)
+    return [layer_plan(L) for L in layers]
 
 # monitor threads below must have a function:
 #   status() => (# processed, total # to process, # error occurred thus far)
 
+def layer_tessellation(region, layer):
+    """tessellation of the region to the download depth for the layer"""
+    return mt.ScanlineTessellation(region, layer['zoom'], min_zoom=u.layer_property(layer['name'], 'min_depth', 0))
+
+def enumerate_part((tess, root)):
+    """enumerate part of a tessellation: the tiles in the subtree at 'root' (at
+    ENUMERATE_SPLIT_ZOOM), or all tiles shallower than that if 'root' is None.
+    return [(zoom, array of packed keys)]. run in a worker process"""
+    if root is None:
+        zooms = range(tess.min_zoom, min(tess.max_zoom, ENUMERATE_SPLIT_ZOOM - 1) + 1)
+        spans = tess.zoom_spans
+    else:
+        zooms = range(max(tess.min_zoom, ENUMERATE_SPLIT_ZOOM), tess.max_zoom + 1)
+        spans = lambda z: tess.subtree_spans(z, root)
+    return [(z, tileset.pack(*mt.spans_to_tiles(spans(z)))) for z in zooms]
+
 class TileEnumerator(threading.Thread):
-    """a monitorable thread to enumerate all tiles in a download region"""
+    """a monitorable thread to enumerate all tiles in a download region. the work is
+    split by layer and by quadtree subtree across a pool of processes"""
 
-    def __init__(self, region, layers):
+    def __init__(self, region, layers, processes=settings.ENUMERATE_PROCESSES):
         threading.Thread.__init__(self)
 
-        def mk_tess(layer, depth):
-            return mt.RegionTessellation(region, depth, min_zoom=u.layer_property(layer, 'min_depth', 0))
-        self.tesss = dict((L['name'], mk_tess(L['name'], L['zoom'])) for L in layers)
-        self.est_num_tiles = sum(tess.size_estimate() for tess in self.tesss.values())
-        self.tiles = set()
+        self.tesss = dict((L['name'], layer_tessellation(region, L)) for L in layers)
+        self.num_tiles = sum(tess.size() for tess in self.tesss.values())
+        self.processes = processes
+        self.tiles = TileSet()
         self.count = 0
 
+    def parts(self):
+        """[(layer, (tessellation, subtree root))]; see enumerate_part()"""
+        def roots(tess):
+            if tess.max_zoom < ENUMERATE_SPLIT_ZOOM:
+                return []
+            xs, ys = tess.subtrees(ENUMERATE_SPLIT_ZOOM)
+            return [(ENUMERATE_SPLIT_ZOOM, x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+        return [(layer, (tess, root)) for layer, tess in sorted(self.tesss.iteritems()) for root in [None] + roots(tess)]
+
     def run(self):
-        for layer, tess in self.tesss.iteritems():
-            for t in tess:
-                z, x, y = t
-                self.tiles.add((layer, z, x, y))
-                self.count += 1
-        self.est_num_tiles = self.count
+        parts = self.parts()
+        pool = multiprocessing.Pool(self.processes) if self.processes != 1 else None
+        try:
+            results = (pool.imap if pool else itertools.imap)(enumerate_part, [part for layer, part in parts])
+
+            pieces = collections.defaultdict(list)
+            for (layer, _), result in itertools.izip(parts, results):
+                for z, keys in result:
+                    pieces[(layer, z)].append(keys)
+                    self.count += len(keys)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        for (layer, z), keys in sorted(pieces.iteritems()):
+            self.tiles.add_array(layer, z, np.concatenate(keys))
 
     def status(self):
-        return (self.count, self.est_num_tiles, 0)
+        return (self.count, self.num_tiles, 0)
+
+def cull_existing(sess, tiles, layer, onprogress=lambda n: None):
+    """return the tiles (as a TileSet) among the tiles for 'layer' in 'tiles' (a
+    TileSet) that already exist and don't need to be downloaded, per the layer's
+    refresh settings
+
+    onprogress -- called with the # of tiles checked, as culling proceeds
+    """
+    refr_window = timedelta(days=layer['refr']) if layer['refr'] is not None else None
+    refresh_window = refresh_window_missing = refr_window
+
+    if refresh_window == timedelta(0) and refresh_window_missing == timedelta(0):
+        # we must (re-)download all; don't bother checking existing
+        existing_tile_stream = None
+    else:
+        existing_tile_stream = find_existing_tiles(sess, tiles, layer['name'], refresh_window, refresh_window_missing)
+
+    existing_tiles = TileSet()
+    if existing_tile_stream:
+        for z, existing, num_queried in existing_tile_stream:
+            existing_tiles.add_array(layer['name'], z, existing)
+            onprogress(num_queried)
+    else:
+        onprogress(tiles.count(layer['name']))
+    return existing_tiles
 
 class TileCuller(threading.Thread):
     """a monitorable thread to enumerate which tiles must be downloaded (i.e., do not
@@ -276,29 +742,13 @@ class TileCuller(threading.Thread):
         self.num_processed = 0
 
     def run(self):
-        tiles_by_layer = u.map_reduce(self.tiles, lambda (layer, z, x, y): [(layer, (z, x, y))])
-        for layername, layer_tiles in tiles_by_layer.iteritems():
-            self.cull_layer(self.layers[layername], layer_tiles)
-
-    def cull_layer(self, layer, tiles):
-        refr_window = timedelta(days=layer['refr']) if layer['refr'] is not None else None
-        refresh_window = refresh_window_missing = refr_window
-
-        if refresh_window == timedelta(0) and refresh_window_missing == timedelta(0):
-            # we must (re-)download all; don't bother checking existing
-            existing_tile_stream = None
-        else:
-            existing_tile_stream = find_existing_tiles(self.sess, tiles, layer['name'], refresh_window, refresh_window_missing)
-
-        existing_tiles = set()
-        if existing_tile_stream:
-            for existing, num_queried in existing_tile_stream:
-                existing_tiles |= existing
-                self.num_processed += num_queried
-        else:
-            self.num_processed += len(tiles)
+        for layername in self.tiles.layers():
+            self.cull_layer(self.layers[layername])
 
-        self.tiles -= existing_tiles
+    def cull_layer(self, layer):
+        def progress(num_queried):
+            self.num_processed += num_queried
+        self.tiles -= cull_existing(self.sess, self.tiles, layer, progress)
 
     def status(self):
         return (self.num_processed, self.num_tiles, 0)
@@ -316,11 +766,11 @@ class TileDownloader(threading.Thread):
         self.error_count = 0
         self.last_error = None
 
-        self.dlmgr = DownloadManager(limit=100)
+        self.dlmgr = download_manager(limit=100)
 
-        def process(key, status, data):
-            return process_tile(sess, key, status, data)
-        self.dlpxr = DownloadProcessor(self.dlmgr, process, self.num_tiles, self.onerror)
+        def process(items):
+            return process_tiles(sess, items)
+        self.dlpxr = BatchDownloadProcessor(self.dlmgr, process, self.num_tiles, self.onerror)
 
     def run(self):
         self.dlmgr.start()
@@ -342,6 +792,215 @@ class TileDownloader(threading.Thread):
     def status(self):
         return (self.dlpxr.count, self.num_tiles, self.error_count)
 
+    def status_detail(self):
+        return '%s %s' % (self.dlpxr.batch_status(), self.dlmgr.limiters.status())
+
+class JobJournal(object):
+    """records the progress of a resumable download job (see mt.DownloadJob) in the
+    db as it streams. tiles are handled in chunks of whole rows for each layer and
+    zoom level; the cursor for that layer and zoom advances past a chunk once every
+    tile in it (and in all chunks before it) is done, i.e., already existed, or was
+    downloaded and committed. a chunk with a failed tile holds its cursor back, so
+    the chunk is redone on resume. thread-safe"""
+
+    def __init__(self, sess, job_id):
+        """
+        sess -- db session for the journal's exclusive use
+        """
+        self.sess = sess
+        self.job_id = job_id
+        self.lock = threading.Lock()
+
+        self.progress = dict(((p.layer, p.z), p) for p in sess.query(mt.JobProgress).filter_by(job_id=job_id))
+        self.chunks = collections.defaultdict(collections.deque) # (layer, z) => chunks not yet journaled, in order
+        self.pending = {} # tile pk => chunk
+        self.dirty = False
+
+    def cursor(self, layer, z):
+        """return (first row not done, # tiles done) for the layer and zoom level"""
+        p = self.progress.get((layer, z))
+        return (p.next_row, p.num_done) if p else (0, 0)
+
+    def add_chunk(self, layer, z, last_row, num_tiles, pending):
+        """register the next chunk for the layer and zoom level
+
+        last_row -- last row in the chunk
+        num_tiles -- # tiles in the chunk
+        pending -- pks of the tiles in the chunk still to be downloaded
+        """
+        with self.lock:
+            chunk = {'layer': layer, 'z': z, 'last_row': last_row, 'num_tiles': num_tiles,
+                     'pending': len(pending), 'failed': False}
+            self.chunks[(layer, z)].append(chunk)
+            for pk in pending:
+                self.pending[pk] = chunk
+            self._advance(layer, z)
+
+    def tile_done(self, pk, success):
+        with self.lock:
+            chunk = self.pending.pop(pk, None)
+            if chunk is None:
+                return
+            chunk['pending'] -= 1
+            chunk['failed'] = chunk['failed'] or not success
+            self._advance(chunk['layer'], chunk['z'])
+
+    def _advance(self, layer, z):
+        chunks = self.chunks[(layer, z)]
+        while chunks and chunks[0]['pending'] == 0 and not chunks[0]['failed']:
+            chunk = chunks.popleft()
+            p = self.progress.get((layer, z))
+            if p is None:
+                p = mt.JobProgress(job_id=self.job_id, layer=layer, z=z, next_row=0, num_done=0)
+                self.sess.add(p)
+                self.progress[(layer, z)] = p
+            p.next_row = chunk['last_row'] + 1
+            p.num_done += chunk['num_tiles']
+            self.dirty = True
+
+    def flush(self):
+        """write the progress to the db; if that fails, the progress is kept to be
+        written on the next flush"""
+        with self.lock:
+            if not self.dirty:
+                return
+            state = dict((key, (p.next_row, p.num_done)) for key, p in self.progress.iteritems())
+            try:
+                self.sess.commit()
+                self.dirty = False
+            except Exception:
+                logging.exception('error saving progress of download job %s' % self.job_id)
+                self.sess.rollback()
+                # the rollback expired (or discarded, if new) the progress rows; set
+                # them back, so the journal doesn't need the db until the next flush
+                for key, (next_row, num_done) in state.iteritems():
+                    p = self.progress[key]
+                    p.next_row = next_row
+                    p.num_done = num_done
+                    self.sess.add(p)
+
+    def complete(self):
+        """mark the job complete, if every chunk was done successfully; return whether
+        it was"""
+        with self.lock:
+            if any(self.chunks.values()):
+                self.sess.commit()
+                return False
+            self.sess.query(mt.DownloadJob).get(self.job_id).completed_on = datetime.now()
+            self.sess.commit()
+            return True
+
+class TileStreamer(threading.Thread):
+    """a monitorable thread that enumerates, culls, and downloads tiles in a single
+    streaming pass. the region is tessellated in chunks (of whole rows of tiles, for
+    each layer and zoom level); each chunk is culled and the remaining tiles are
+    queued for download right away, so memory use is bounded by the chunk size rather
+    than the size of the region"""
+
+    def __init__(self, region, layers, cull_sess, download_sess, chunk_size=STREAM_CHUNK_SIZE, journal=None):
+        """
+        cull_sess, download_sess -- separate db sessions, as culling and processing
+          downloaded tiles happen in different threads
+        journal -- a JobJournal to record progress in and resume from, if any
+        """
+        threading.Thread.__init__(self)
+
+        self.layers = layers
+        self.sess = cull_sess
+        self.chunk_size = chunk_size
+        self.journal = journal
+
+        self.tesss = dict((L['name'], layer_tessellation(region, L)) for L in layers)
+        self.num_tiles = sum(tess.size() for tess in self.tesss.values())
+
+        # tallies per zoom level
+        self.region_counts = collections.defaultdict(lambda: 0)
+        self.download_counts = collections.defaultdict(lambda: 0)
+        self.num_enumerated = 0
+        self.num_existing = 0
+        self.num_resumed = 0 # tiles done in a previous run of the job
+
+        self.error_count = 0
+        self.last_error = None
+
+        self.dlmgr = download_manager(limit=100)
+
+        def process(items):
+            results = process_tiles(download_sess, items)
+            if self.journal:
+                try:
+                    for (tile, _, _), (success, _) in zip(items, results):
+                        self.journal.tile_done(tile.pk(), success)
+                    self.journal.flush()
+                except Exception:
+                    # the tiles are saved; the job just resumes from an earlier point
+                    logging.exception('error journaling download progress')
+            return results
+        self.dlpxr = BatchDownloadProcessor(self.dlmgr, process, None, self.onerror)
+
+    def run(self):
+        self.dlmgr.start()
+        self.dlpxr.start()
+
+        num_queued = 0
+        for layer in self.layers:
+            name = layer['name']
+            tess = self.tesss[name]
+            for z in range(tess.min_zoom, tess.max_zoom + 1):
+                start_row, num_done = self.journal.cursor(name, z) if self.journal else (0, 0)
+                self.region_counts[z] += num_done
+                self.num_resumed += num_done
+
+                for spans in tess.zoom_span_chunks(z, self.chunk_size, start_row):
+                    xs, ys = mt.spans_to_tiles(spans)
+                    self.region_counts[z] += len(xs)
+                    self.num_enumerated += len(xs)
+
+                    tiles = TileSet()
+                    tiles.add_array(name, z, tileset.pack(xs, ys))
+                    existing = cull_existing(self.sess, tiles, layer)
+                    self.num_existing += len(existing)
+                    tiles -= existing
+
+                    if self.journal:
+                        rows = spans[0]
+                        self.journal.add_chunk(name, z, int(rows[-1]), len(xs), list(tiles))
+                        self.journal.flush()
+
+                    walk = list(random_walk(tiles))
+                    urls = tile_urls(name, z, [t[2] for t in walk], [t[3] for t in walk])
+                    for (_, _, x, y), url in zip(walk, urls):
+                        self.download_counts[z] += 1
+                        self.dlmgr.enqueue((mt.Tile(layer=name, z=z, x=x, y=y), url))
+                        num_queued += 1
+
+        self.dlpxr.num_expected = num_queued
+
+        self.dlpxr.join()
+        self.dlmgr.terminate()
+        self.dlmgr.join()
+
+        if self.journal:
+            self.journal.complete()
+
+    def onerror(self, msg):
+        self.error_count += 1
+        self.last_error = msg
+
+    def status(self):
+        return (self.num_resumed + self.num_existing + self.dlpxr.count, self.num_tiles, self.error_count)
+
+    def status_detail(self):
+        resumed = '[Resumed: %d] ' % self.num_resumed if self.num_resumed else ''
+        return '%s[Existing: %d] %s %s' % (resumed, self.num_existing, self.dlpxr.batch_status(), self.dlmgr.limiters.status())
+
+    def tile_counts(self, max_depth=None):
+        """see tile_counts(); (# in region, # to download)"""
+        def counts(tally):
+            max_zoom = max(tally.keys() + [max_depth if max_depth is not None else -1])
+            return [tally[z] for z in range(max_zoom + 1)]
+        return (counts(self.region_counts), counts(self.download_counts))
+
 class DownloadProcessor(threading.Thread):
     """thread that consumed the download output queue and processes the resultant tile data"""
 
@@ -376,6 +1035,65 @@ class DownloadProcessor(threading.Thread):
     def done(self):
         return self.count == (self.num_expected if self.num_expected is not None else -1)
 
+class BatchDownloadProcessor(DownloadProcessor):
+    """download processor that gathers downloaded items into batches, to be processed
+    (i.e., committed to the db) all at once"""
+
+    def __init__(self, dlmgr, processfunc, num_expected=None, onerror=lambda m: None,
+                 batch_size=COMMIT_BATCH_SIZE, batch_interval=COMMIT_BATCH_INTERVAL):
+        """
+        processfunc -- function([(key, status, data), ...]) => [(success, error msg), ...]
+        batch_size -- max # items per batch
+        batch_interval -- max seconds to wait on a partial batch before processing it
+        """
+        DownloadProcessor.__init__(self, dlmgr, processfunc, num_expected, onerror)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        # size and processing time of the most recent batch
+        self.last_batch = None
+
+    def run(self):
+        try:
+            batch = []
+            batch_start = None
+            while self.up and not self.done():
+                item = self.dlmgr.fetch()
+                if item:
+                    if not batch:
+                        batch_start = time.time()
+                    batch.append(item)
+
+                if batch and (len(batch) >= self.batch_size or
+                              time.time() - batch_start >= self.batch_interval or
+                              self.count + len(batch) == self.num_expected):
+                    self.process_batch(batch)
+                    batch = []
+        except:
+            logging.exception('unexpected exception in download processor thread')
+
+    def process_batch(self, batch):
+        start = time.time()
+        try:
+            results = self.process(batch)
+        except Exception, e:
+            # keep going, so the download manager's queue keeps draining
+            logging.exception('error processing batch of downloaded tiles')
+            results = [(False, 'error processing batch: %s' % e)] * len(batch)
+        self.last_batch = (len(batch), time.time() - start)
+
+        self.count += len(batch)
+        for success, msg in results:
+            if not success:
+                self.onerror(msg)
+
+    def batch_status(self):
+        """description of throughput of the most recent batch"""
+        if not self.last_batch:
+            return ''
+        size, elapsed = self.last_batch
+        return '[Batch: %3d tiles, %4dms, %5.0f tiles/s]' % (size, 1000. * elapsed, size / max(elapsed, 1e-3))
+
 class DownloadService(object):
 
     def __init__(self, process, sess=None):
@@ -385,7 +1103,7 @@ class DownloadService(object):
             process(meta, status, data)
             return (True, None)
 
-        self.dlmgr = DownloadManager(limit=100)
+        self.dlmgr = download_manager(limit=100)
         self.dlpxr = DownloadProcessor(self.dlmgr, _process)
         self.started = False
 
@@ -396,7 +1114,8 @@ class DownloadService(object):
 
     def cache_tile(self, t, status, data, cache, overwrite):
         if cache:
-            if overwrite or not self.sess.query(mt.Tile).get(t.pk()):
+            existing = self.sess.query(mt.Tile).get(t.pk())
+            if overwrite or not existing or existing.synthetic:
                 try:
                     _process_tile(self.sess, t, status, data)
                 except:
@@ -1,4 +1,5 @@
 import math
+import threading
 from Polygon import *
 import bisect
 import util.util as u
@@ -7,18 +8,21 @@ import settings
 import os.path
 from glob import glob
 from StringIO import StringIO
+import cStringIO
 from contextlib import closing
 try:
     import Image
 except ImportError:
     from PIL import Image
-import collections
+import json
+import numpy as np
 import mapdownload # argh circular import
+import tilepack
 
-from sqlalchemy import create_engine, Column, DateTime, Integer, String, LargeBinary, ForeignKey, CheckConstraint, Index
+from sqlalchemy import create_engine, Column, DateTime, Integer, BigInteger, Boolean, String, LargeBinary, ForeignKey, CheckConstraint, Index, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import func
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.sql.expression import func, false
 
 Base = declarative_base()
 class Tile(Base):
@@ -29,19 +33,22 @@ class Tile(Base):
     x = Column(Integer, primary_key=True)
     y = Column(Integer, primary_key=True)
 
-    qt = Column(String, nullable=False)
+    qtkey = Column(BigInteger, nullable=False)
     uuid = Column(String, nullable=False, index=True)
 
     fetched_on = Column(DateTime, default=func.now(), onupdate=func.now())
+    # generated locally from other tiles (see mapcache.pyramid) rather than downloaded;
+    # not considered present when culling downloads
+    synthetic = Column(Boolean, nullable=False, default=False, server_default=false())
 
     __table_args__ = (
         CheckConstraint('x >= 0 and x < 2^z'),
         CheckConstraint('y >= 0 and y < 2^z'),
-        Index('qt', layer, qt),
+        Index('qtkey', layer, qtkey),
     )
 
     def __init__(self, **kw):
-        kw['qt'] = u.to_quadindex(kw['z'], kw['x'], kw['y'])
+        kw['qtkey'] = u.to_qtkey(kw['z'], kw['x'], kw['y'])
         super(Tile, self).__init__(**kw)
 
     def pk(self):
@@ -62,6 +69,16 @@ class Tile(Base):
         self.uuid = hashfunc(data)
         self._data(data, file_type).save(sess)
 
+    @staticmethod
+    def save_all(tiles, hashfunc, sess=None):
+        """batched equivalent of save()
+
+        tiles -- list of (tile, raw image data)
+        """
+        for t, data in tiles:
+            t.uuid = hashfunc(data)
+        TileData.save_all([t._data(data) for t, data in tiles], sess)
+
     def is_null(self):
         return self.uuid == mapdownload.null_digest()
 
@@ -77,8 +94,8 @@ class Tile(Base):
 
         f = self.open(sess)
         if f:
-            with f:
-                img_ = Image.open(f)
+            with f as _f:
+                img_ = Image.open(_f)
                 return img_.convert('RGBA' if transparent else 'RGB')
 
     def _layer_property(self, prop):
@@ -91,7 +108,8 @@ class Tile(Base):
     def get_descendants(self, sess, max_depth=None, min_depth=None):
         """query all descendant tiles from this tile (i.e., tiles at deeper zooms
         that overlap this tile's area"""
-        q = sess.query(Tile).filter_by(layer=self.layer).filter(Tile.qt > self.qt).filter(Tile.qt < (self.qt + '4'))
+        lo, hi = u.qtkey_range(self.qtkey)
+        q = sess.query(Tile).filter_by(layer=self.layer).filter(Tile.qtkey.between(lo, hi)).filter(Tile.qtkey != self.qtkey)
         if min_depth:
             q = q.filter(Tile.z >= self.z + min_depth)
         if max_depth:
@@ -99,19 +117,27 @@ class Tile(Base):
         return q
 
     def get_ancestors(self, sess, lookback):
-        def qt_ancestor(k):
-            return self.qt[:-k or None]
-
-        ancestor_ix = [qt_ancestor(i) for i in range(lookback + 1) if i <= self.z]
-        q = sess.query(Tile).filter_by(layer=self.layer).filter(Tile.qt.in_(ancestor_ix))
-        ancestors = collections.defaultdict(lambda: None, ((t.z, t) for t in q))
-        return [ancestors[self.z - i] for i in range(lookback + 1)]
+        found = find_tiles(sess, self.layer, [(self.z, self.x, self.y)], lookback)
+        return [found.get((self.z - i, self.x >> i, self.y >> i)) for i in range(lookback + 1)]
 
     # TODO not passing 'sess' causes error on 'null' tiles
     # should i assume we should never call these funcs on tiles we don't expect data to exist for?
     # ie, if no data for tile, we must show the 'broken' tile?
     # i definitely don't think we should be doing lookups on uuids we know don't exist (null, etc.)
 
+def find_tiles(sess, layer, tiles, lookback=0):
+    """look up many tiles of a layer at once, along with each one's ancestors up to
+    'lookback' levels up, with a single query (per 1000 distinct tiles); return
+    {(z, x, y): Tile} for those that exist
+
+    tiles -- [(z, x, y), ...]
+    """
+    qtkeys = set(u.qtkey_ancestor(u.to_qtkey(z, x, y), i) for z, x, y in tiles for i in range(min(lookback, z) + 1))
+    found = {}
+    for chunk in u.chunker(qtkeys, 1000):
+        found.update(((t.z, t.x, t.y), t) for t in sess.query(Tile).filter_by(layer=layer).filter(Tile.qtkey.in_(chunk)))
+    return found
+
 class TileData(Base):
     __tablename__ = 'tdata'
 
@@ -147,7 +173,9 @@ class TileData(Base):
         if not self.data:
             return
 
-        if settings.TILE_STORE_BLOB:
+        if settings.TILE_STORE_PACK:
+            self.save_pack()
+        elif settings.TILE_STORE_BLOB:
             self.save_blob(sess)
         else:
             self.save_file()
@@ -157,6 +185,20 @@ class TileData(Base):
         if not sess.query(TileData).get(self.uuid):
             sess.add(self)
 
+    @staticmethod
+    def save_all(tds, sess=None):
+        """save many tile datas at once; when storing as blobs, check for existing
+        entries with a single query"""
+        tds = dict((td.uuid, td) for td in tds if td.data).values()
+        if not settings.TILE_STORE_PACK and settings.TILE_STORE_BLOB:
+            existing = set()
+            for chunk in u.chunker([td.uuid for td in tds], 1000):
+                existing.update(r[0] for r in sess.query(TileData.uuid).filter(TileData.uuid.in_(chunk)))
+            sess.add_all(td for td in tds if td.uuid not in existing)
+        else:
+            for td in tds:
+                td.save(sess)
+
     def save_file(self):
         """save tile data to file"""
         for ipath in self.path_intermediary():
@@ -168,11 +210,16 @@ class TileData(Base):
             with open(path, 'w') as f:
                 f.write(self.data)
 
+    def save_pack(self):
+        """save tile data to tile pack"""
+        tilepack.store().put(self.uuid, self.data)
+
     def remove(self, sess=None):
         """remove tile data from all sources"""
         if sess:
             self.remove_blob(sess)
         self.remove_file()
+        self.remove_pack()
 
     def remove_blob(self, sess):
         """remove tile data from database -- ok if no db entry exists"""
@@ -184,11 +231,15 @@ class TileData(Base):
         if os.path.exists(path):
             os.remove(path)
 
+    def remove_pack(self):
+        """remove tile data from tile pack -- ok if not present"""
+        tilepack.store().remove(self.uuid)
+
     def open(self, sess=None):
-        return _getdata(self.open_file, lambda: self.open_blob(sess) if sess else None)
+        return _getdata(self.open_file, lambda: self.open_blob(sess) if sess else None, self.open_pack)
 
     def load(self, sess=None):
-        return _getdata(self.load_file, lambda: self.load_blob(sess) if sess else None)
+        return _getdata(self.load_file, lambda: self.load_blob(sess) if sess else None, self.load_pack)
 
     def open_blob(self, sess):
         """return file-like object for tile data from database; None if no db entry"""
@@ -202,6 +253,12 @@ class TileData(Base):
         if os.path.exists(path):
             return open(path)
 
+    def open_pack(self):
+        """return file-like object reading directly from the tile pack; None if not present"""
+        buf = self.load_pack()
+        if buf:
+            return closing(cStringIO.StringIO(buf))
+
     def load_blob(self, sess):
         """return tile data from database; None if no db entry"""
         td = sess.query(TileData).get(self.uuid)
@@ -215,12 +272,22 @@ class TileData(Base):
             with f:
                 return f.read()
 
-def _getdata(from_file, from_db):
-    """prioritize checking db or filesystem first, based on current tile storage setting"""
-    if settings.TILE_STORE_BLOB:
-        return from_db() or from_file()
+    def load_pack(self):
+        """return tile data from tile pack, as a zero-copy buffer; None if not present"""
+        return tilepack.store().get(self.uuid)
+
+def _getdata(from_file, from_db, from_pack):
+    """prioritize checking pack, db or filesystem first, based on current tile storage setting"""
+    sources = [from_db, from_file] if settings.TILE_STORE_BLOB else [from_file, from_db]
+    if settings.TILE_STORE_PACK:
+        sources.insert(0, from_pack)
     else:
-        return from_file() or from_db()
+        sources.append(from_pack)
+
+    for source in sources:
+        data = source()
+        if data:
+            return data
 
 class Region(Base):
     """named regions / tile download areas"""
@@ -312,6 +379,47 @@ class Region(Base):
 def ll_to_xy(coords):
     return [mercator_to_xy(ll_to_mercator(c)) for c in coords]
 
+class DownloadJob(Base):
+    """a resumable tile download: the region and layers to download, with progress
+    recorded in JobProgress"""
+
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    boundary = Column(String, nullable=False) # as in Region
+    layers = Column(String, nullable=False) # json list of layer download specs
+
+    created_on = Column(DateTime, default=func.now())
+    updated_on = Column(DateTime, default=func.now(), onupdate=func.now())
+    completed_on = Column(DateTime)
+
+    def __init__(self, boundary, layers):
+        """
+        boundary -- region boundary string (see Region)
+        layers -- list of layer download specs ({'name': ..., 'zoom': ..., 'refr': ...})
+        """
+        super(DownloadJob, self).__init__(boundary=boundary, layers=json.dumps(layers))
+
+    def region(self):
+        return Region('__', self.boundary)
+
+    def layer_specs(self):
+        return [dict((str(k), str(v) if isinstance(v, basestring) else v) for k, v in L.iteritems()) for L in json.loads(self.layers)]
+
+class JobProgress(Base):
+    """progress cursor for one layer and zoom level of a download job. the region's
+    tiles are downloaded row by row (see ScanlineTessellation); all tiles in rows
+    before 'next_row' are done"""
+
+    __tablename__ = 'job_progress'
+
+    job_id = Column(Integer, ForeignKey('jobs.id'), primary_key=True)
+    layer = Column(String, primary_key=True)
+    z = Column(Integer, primary_key=True)
+
+    next_row = Column(Integer, nullable=False)
+    num_done = Column(BigInteger, nullable=False) # tiles in the rows done
+
 #class RegionOverlay(Base):
 #    """record which regions have been downloaded -- layer and depth"""
 #
@@ -323,18 +431,82 @@ def ll_to_xy(coords):
 #
 #    created_on = Column(DateTime, default=func.now())
 
+_engines = {} # (connector, echo) => (engine, session factory, scoped session registry)
+_engines_lock = threading.Lock()
+
+def _engine(connector, echo=False):
+    """the engine for a tile database, shared process-wide, with its session
+    factories. the schema is checked (and created, if new) only when the engine is
+    first set up"""
+    with _engines_lock:
+        if (connector, echo) not in _engines:
+            kw = {}
+            if not connector.startswith('sqlite'):
+                kw['pool_size'] = settings.TILE_DB_POOL_SIZE
+            engine = create_engine(connector, echo=echo, **kw)
+            if schema_outdated(engine):
+                raise RuntimeError('tile database schema is out of date; run \'mapcache.py --upgrade-db\'')
+            Base.metadata.create_all(engine)
+            factory = sessionmaker(bind=engine)
+
+            # initialize 'global' region
+            sess = factory()
+            if not sess.query(Region).filter_by(name=Region.GLOBAL_NAME).count():
+                sess.add(Region.world())
+                sess.commit()
+            sess.close()
+
+            _engines[(connector, echo)] = (engine, factory, scoped_session(factory))
+        return _engines[(connector, echo)]
+
 def dbsess(connector=settings.TILE_DB, echo=False):
-    """create a connector to the tile database"""
+    """create a session on the tile database, for the caller's exclusive use.
+    sessions share a pool of connections per database"""
+    return _engine(connector, echo)[1]()
+
+def scoped_dbsess(connector=settings.TILE_DB):
+    """the session on the tile database for the current thread; every caller in the
+    same thread gets the same session"""
+    return _engine(connector)[2]()
+
+def _tile_columns(engine):
+    """names of the columns of the existing 'tiles' table; None if table doesn't exist"""
+    if not engine.has_table(Tile.__tablename__):
+        return None
+    return set(c.name for c in Table(Tile.__tablename__, MetaData(), autoload=True, autoload_with=engine).columns)
+
+def schema_outdated(engine):
+    """return whether the tile database predates the current schema"""
+    cols = _tile_columns(engine)
+    return cols is not None and not set(['qtkey', 'synthetic']) <= cols
+
+def qtkey_sql():
+    """sql expression equivalent to util.to_qtkey, over the columns z, x, y"""
+    def bit(col, i, shift):
+        return '(((CAST(%s AS BIGINT) >> %d) & 1) << %d)' % (col, i, 2 * i + shift)
+    quad = ' | '.join(bit(col, i, shift) for i in range(u.QTKEY_MAX_ZOOM) for col, shift in (('x', 0), ('y', 1)))
+    return '((((%s) << 1) | 1) << (2 * (%d - z)))' % (quad, u.QTKEY_MAX_ZOOM)
+
+def upgrade_schema(connector=settings.TILE_DB, echo=False):
+    """migrate a tile database to the current schema: replace the old string 'qt'
+    index with the integer 'qtkey' index (the keys are computed server-side, in a
+    single pass), and add the 'synthetic' flag"""
     engine = create_engine(connector, echo=echo)
-    Base.metadata.create_all(engine)
-    sess = sessionmaker(bind=engine)()
-
-    # initialize 'global' region
-    if not sess.query(Region).filter_by(name=Region.GLOBAL_NAME).count():
-        sess.add(Region.world())
-        sess.commit()
+    if not schema_outdated(engine):
+        return False
 
-    return sess
+    cols = _tile_columns(engine)
+    with engine.begin() as conn:
+        if 'qtkey' not in cols:
+            conn.execute('ALTER TABLE tiles ADD COLUMN qtkey BIGINT')
+            conn.execute('UPDATE tiles SET qtkey = %s' % qtkey_sql())
+            conn.execute('ALTER TABLE tiles ALTER COLUMN qtkey SET NOT NULL')
+            conn.execute('DROP INDEX IF EXISTS qt')
+            conn.execute('ALTER TABLE tiles DROP COLUMN qt')
+            [ix for ix in Tile.__table__.indexes if ix.name == 'qtkey'][0].create(conn)
+        if 'synthetic' not in cols:
+            conn.execute('ALTER TABLE tiles ADD COLUMN synthetic BOOLEAN NOT NULL DEFAULT FALSE')
+    return True
 
 
 
@@ -511,27 +683,177 @@ class RegionTessellation(object):
             if t[0] >= self.min_zoom:
                 yield t
 
-    def size_estimate(self, compensate=True):
-        """estimate the number of tiles contained within"""
-        # this method is pretty kludgey. better method: generate new polygons with
-        # .5*tile radius 'fuzz' (at each zoom level), and compute/sum exact areas
-
-        ymins = [max(mercator_to_xy((0, y))[1], 0.) for y in self._z.scale_brackets]
-        base_area = self.polygon.area()
-
-        def z_areas():
-            for z in range(self.min_zoom, self.max_zoom + 1):
-                if z <= self.max_zoom - len(ymins):
-                    yield base_area
-                else:
-                    ymin = ymins[self.max_zoom - z]
-                    sub_poly = self.polygon & quadrant(0., 1., ymin, 1. - ymin)
-                    yield sub_poly.area()
-        z_tiles = (area * 4**z for (z, area) in enumerate(z_areas()))
-        total = sum(math.ceil(t) for t in z_tiles)
-
-        #compensate for underestimation
-        fudge = min(5. / math.sqrt(total), 0.75) if compensate else 0.
-        fudged_total = math.ceil(total * (1. + fudge))
-        max_possible = math.floor(4./3. * 4**self.max_zoom)
-        return int(min(fudged_total, max_possible))
+    def zoom_counts(self):
+        """exact number of tiles at each zoom level (list[zoom] = count; 0 below
+        min_zoom), counted from the rasterized region without enumerating tiles"""
+        edges = polygon_edges(self.polygon)
+        extents = self._z.extents(self.max_zoom)
+        def count(z):
+            rows, start, end = scanline_spans(edges, z, extents[z])
+            return int(np.sum(end - start))
+        return [count(z) if z >= self.min_zoom else 0 for z in range(self.max_zoom + 1)]
+
+    def size(self):
+        """exact number of tiles contained within"""
+        return sum(self.zoom_counts())
+
+def polygon_edges(polygon):
+    """return all edges of the polygon's contours as an array of rows (x0, y0, x1, y1)"""
+    edges = []
+    for contour in polygon:
+        pts = np.array(contour, dtype=float)
+        edges.append(np.hstack([pts, np.roll(pts, -1, axis=0)]))
+    return np.vstack(edges) if edges else np.zeros((0, 4))
+
+def scanline_spans(edges, zoom, (ymin, ymax)):
+    """rasterize the polygon (given by its edges) at the given zoom level. return
+    the tiles overlapping the polygon (with non-zero area) as spans of consecutive
+    tiles in each row: arrays (y, x_start, x_end), x_end exclusive. only rows
+    within [ymin, ymax] are considered
+
+    within each row, the polygon's x-extent is the union of the x-extents of each
+    edge (clipped to the row), and of the polygon's cross-section just inside the
+    top of the row
+    """
+    dim = 2**zoom
+    e = edges * dim
+    # orient all edges top to bottom
+    flip = e[:, 1] > e[:, 3]
+    e[flip] = e[flip][:, [2, 3, 0, 1]]
+    x0, y0, x1, y1 = e.T
+    sloped = y0 < y1
+    # only rows within [top, bottom] are needed
+    top, bottom = max(ymin, 0), min(ymax, dim - 1)
+
+    def x_at(ix, y):
+        return x0[ix] + (y - y0[ix]) * (x1[ix] - x0[ix]) / (y1[ix] - y0[ix])
+
+    def expand(ix, first, last):
+        """for each edge in 'ix', enumerate the integers in [first, last]; return
+        (edge index, integer) for each"""
+        n = np.maximum(last - first + 1, 0)
+        rep = np.repeat(ix, n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        return rep, np.repeat(first, n) + k
+
+    rows, lo, hi = [], [], []
+    def add(r, a, b):
+        rows.append(r.astype(np.int64))
+        lo.append(a)
+        hi.append(b)
+
+    # sloped edges, clipped to each row they pass through
+    ix = np.nonzero(sloped)[0]
+    ix, r = expand(ix, np.maximum(np.floor(y0[ix]), top).astype(np.int64),
+                   np.minimum(np.ceil(y1[ix]) - 1, bottom).astype(np.int64))
+    xa = x_at(ix, np.maximum(y0[ix], r))
+    xb = x_at(ix, np.minimum(y1[ix], r + 1))
+    add(r, np.minimum(xa, xb), np.maximum(xa, xb))
+
+    # horizontal edges strictly within a row
+    ix = np.nonzero(~sloped & (np.floor(y0) != y0) & (y0 > top) & (y0 < bottom + 1))[0]
+    add(np.floor(y0[ix]), np.minimum(x0[ix], x1[ix]), np.maximum(x0[ix], x1[ix]))
+
+    # cross-sections just below the top of each row. (the bottom isn't needed: any
+    # interior point in the row not covered by an edge above it within the row must
+    # be exposed to the top of the row)
+    ix = np.nonzero(sloped)[0]
+    cix, line = expand(ix, np.maximum(np.ceil(y0[ix]), top).astype(np.int64),
+                       np.minimum(np.ceil(y1[ix]) - 1, bottom).astype(np.int64))
+    cx = x_at(cix, line)
+    order = np.lexsort((cx, line))
+    line, cx = line[order], cx[order]
+    # every closed contour crosses each line an even number of times; consecutive
+    # pairs of crossings bound the interior
+    add(line[::2], cx[::2], cx[1::2])
+
+    r, a, b = [np.concatenate(k) for k in (rows, lo, hi)]
+    start = np.floor(a).astype(np.int64)
+    end = np.ceil(b).astype(np.int64)
+    # degenerate (vertical) extents only touch a tile's interior if not on a tile boundary
+    point = (a == b)
+    end[point] = np.where(start[point] != a[point], start[point] + 1, start[point])
+
+    start = np.clip(start, 0, dim)
+    end = np.clip(end, 0, dim)
+    keep = (end > start) & (r >= top) & (r <= bottom)
+    r, start, end = r[keep], start[keep], end[keep]
+    if not len(r):
+        return (r, start, end)
+
+    # merge overlapping spans within each row
+    stride = dim + 1
+    order = np.argsort(r * stride + start)
+    r, start, end = r[order], start[order], end[order]
+    reach = np.maximum.accumulate(r * stride + end)
+    new_span = np.ones(len(r), dtype=bool)
+    new_span[1:] = r[1:] * stride + start[1:] > reach[:-1]
+    first = np.nonzero(new_span)[0]
+    last = np.append(first[1:] - 1, len(r) - 1)
+    return (r[first], start[first], reach[last] - r[first] * stride)
+
+def spans_to_tiles((rows, start, end)):
+    """expand the spans from scanline_spans into arrays of tile (x, y)"""
+    n = end - start
+    offset = np.repeat(np.cumsum(n) - n - start, n)
+    return (np.arange(n.sum()) - offset, np.repeat(rows, n))
+
+class ScanlineTessellation(RegionTessellation):
+    """an enumerator of all the tiles within a region, giving exactly the same tiles
+    as RegionTessellation, but computed by rasterizing the polygon at each zoom
+    level in bulk, instead of testing each tile in the quadtree individually"""
+
+    def __init__(self, polygon, max_zoom, offset=1., min_zoom=0):
+        super(ScanlineTessellation, self).__init__(polygon, max_zoom, offset, min_zoom)
+        self.edges = polygon_edges(polygon)
+        self.extents = self._z.extents(max_zoom)
+
+    def next(self):
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            for xs, ys in self.zoom_tile_chunks(z):
+                for x, y in zip(xs.tolist(), ys.tolist()):
+                    yield (z, x, y)
+
+    def zoom_spans(self, z):
+        """see scanline_spans"""
+        return scanline_spans(self.edges, z, self.extents[z])
+
+    def subtree_spans(self, z, (root_z, root_x, root_y)):
+        """like zoom_spans, but only for the descendants of tile 'root'"""
+        scale = 2**(z - root_z)
+        ymin, ymax = self.extents[z]
+        rows, start, end = scanline_spans(self.edges, z, (max(ymin, root_y * scale), min(ymax, (root_y + 1) * scale - 1)))
+        start = np.maximum(start, root_x * scale)
+        end = np.minimum(end, (root_x + 1) * scale)
+        keep = (end > start)
+        return (rows[keep], start[keep], end[keep])
+
+    def subtrees(self, z):
+        """the tiles at zoom level 'z' whose subtrees contain all tiles in the region
+        at zoom 'z' and deeper, as arrays (x, y)"""
+        return spans_to_tiles(scanline_spans(self.edges, z, (0, 2**z - 1)))
+
+    def zoom_tiles(self, z):
+        """all tiles at zoom level 'z', as arrays (x, y)"""
+        return spans_to_tiles(self.zoom_spans(z))
+
+    def zoom_tile_chunks(self, z, chunk_size=2**16):
+        """like zoom_tiles, but in chunks of roughly 'chunk_size' tiles (chunks are
+        split between rows), to bound memory use"""
+        for spans in self.zoom_span_chunks(z, chunk_size):
+            yield spans_to_tiles(spans)
+
+    def zoom_span_chunks(self, z, chunk_size, start_row=0):
+        """the spans at zoom level 'z' in order of row, starting at 'start_row', in
+        chunks of whole rows with roughly 'chunk_size' tiles each"""
+        rows, start, end = self.zoom_spans(z)
+        first = np.searchsorted(rows, start_row)
+        rows, start, end = rows[first:], start[first:], end[first:]
+
+        # a row may have several spans; only split the chunks between rows
+        row_first = np.nonzero(np.append(True, rows[1:] != rows[:-1]))[0] if len(rows) else np.zeros(0, dtype=int)
+        cumulative = np.cumsum(np.add.reduceat(end - start, row_first)) if len(rows) else np.zeros(0)
+        bounds = row_first[np.searchsorted(cumulative, np.arange(chunk_size, cumulative[-1] if len(cumulative) else 0, chunk_size))]
+        for i, j in zip(np.append(0, bounds), np.append(bounds, len(rows))):
+            if j > i:
+                yield (rows[i:j], start[i:j], end[i:j])
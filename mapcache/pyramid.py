@@ -0,0 +1,100 @@
+"""build the missing lower zoom levels of a layer by downsampling the tiles below
+them, so zoomed-out views are available without synthesizing them on the fly (or
+downloading them)
+
+generated tiles are flagged 'synthetic': they're replaced by the real tile if it's
+ever downloaded, and don't count as present when culling downloads
+"""
+
+from StringIO import StringIO
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+import numpy as np
+from sqlalchemy.sql.expression import and_, select, func
+
+import maptile as mt
+import mapdownload
+import tileset
+import util.util as u
+
+TILE_DIM = 256
+CHUNK_SIZE = 256 # parent tiles generated per transaction
+# averages each 2x2 block of pixels exactly; older PILs lack it
+DOWNSAMPLE_FILTER = getattr(Image, 'BOX', Image.BILINEAR)
+
+def level_keys(sess, layer, z):
+    """sorted array of packed keys of all tiles at zoom 'z'"""
+    T = mt.Tile.__table__
+    q = select([T.c.x, T.c.y]).where(and_(T.c.layer == layer, T.c.z == z)).order_by(T.c.x, T.c.y)
+    return mapdownload.packed_keys(sess.execute(q))
+
+def missing_parents(sess, layer, z):
+    """packed keys of the tiles at zoom 'z' that don't exist, but have children"""
+    xs, ys = tileset.unpack(level_keys(sess, layer, z + 1))
+    parents = np.unique(tileset.pack(xs >> 1, ys >> 1))
+    return np.setdiff1d(parents, level_keys(sess, layer, z), assume_unique=True)
+
+def downsample(children, mode):
+    """compose the child tile images {(dx, dy): image} (up to four) into their parent
+    tile; quadrants without a child are left blank (transparent, for overlays)"""
+    img = Image.new(mode, (2 * TILE_DIM, 2 * TILE_DIM))
+    for (dx, dy), child in children.iteritems():
+        if child.size != (TILE_DIM, TILE_DIM):
+            child = child.resize((TILE_DIM, TILE_DIM), Image.BILINEAR)
+        img.paste(child, (TILE_DIM * dx, TILE_DIM * dy))
+    return img.resize((TILE_DIM, TILE_DIM), DOWNSAMPLE_FILTER)
+
+def encode(img, file_type):
+    buf = StringIO()
+    img.save(buf, {'jpg': 'jpeg'}.get(file_type, file_type))
+    return buf.getvalue()
+
+def build_level(sess, layer, z, onprogress=lambda n: None):
+    """generate the missing tiles at zoom 'z' from their children at z + 1; return the
+    number of tiles generated"""
+    overlay = u.layer_property(layer, 'overlay', False)
+    file_type = u.layer_property(layer, 'file_type', 'png')
+
+    count = 0
+    parents = missing_parents(sess, layer, z)
+    for i in range(0, len(parents), CHUNK_SIZE):
+        xs, ys = tileset.unpack(parents[i:i + CHUNK_SIZE])
+        qtkeys = [u.to_qtkey(z + 1, 2 * x + dx, 2 * y + dy) for x, y in zip(xs.tolist(), ys.tolist())
+                  for dx in (0, 1) for dy in (0, 1)]
+
+        children = u.map_reduce(sess.query(mt.Tile).filter_by(layer=layer).filter(mt.Tile.qtkey.in_(qtkeys)),
+                                lambda t: [((t.x >> 1, t.y >> 1), t)])
+        tiles = []
+        for (x, y), kids in children.iteritems():
+            imgs = dict(((t.x & 1, t.y & 1), t.img(sess, overlay)) for t in kids if not t.is_null())
+            imgs = dict((k, img) for k, img in imgs.iteritems() if img is not None)
+            if not imgs:
+                continue
+
+            data = encode(downsample(imgs, 'RGBA' if overlay else 'RGB'), file_type)
+            tiles.append((mt.Tile(layer=layer, z=z, x=x, y=y, synthetic=True), data))
+
+        mapdownload.register_tiles(sess, tiles, mapdownload.digest)
+        sess.expunge_all()
+        count += len(tiles)
+        onprogress(count)
+    return count
+
+def build(sess, layer, min_zoom=0, max_zoom=None, onprogress=lambda z, n: None):
+    """generate the missing tiles of a layer at each zoom level from 'max_zoom' - 1
+    (default: the deepest level with tiles) up to 'min_zoom', each level from the
+    (real or generated) tiles of the level below
+
+    onprogress -- called with the zoom level and running count of tiles generated
+    """
+    if max_zoom is None:
+        max_zoom = sess.query(func.max(mt.Tile.z)).filter_by(layer=layer).scalar()
+        if max_zoom is None:
+            return 0
+
+    count = 0
+    for z in range(max_zoom - 1, min_zoom - 1, -1):
+        count += build_level(sess, layer, z, lambda n: onprogress(z, count + n))
+    return count
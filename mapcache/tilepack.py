@@ -0,0 +1,340 @@
+import os
+import os.path
+import time
+import mmap
+import struct
+import threading
+import fcntl
+import binascii
+import logging
+from glob import glob
+import numpy as np
+import util.util as u
+import settings
+
+INDEX_MAGIC = 'BEPKIDX1'
+INDEX_HEADER = struct.Struct('<8sQQI') # magic, capacity, # slots used, current pack #
+INDEX_ENTRY = struct.Struct('<8sIQI') # key, pack #, offset, length
+INDEX_DTYPE = np.dtype([('key', 'S8'), ('pack', '<u4'), ('offset', '<u8'), ('length', '<u4')]) # same layout
+INITIAL_CAPACITY = 2**16 # entries; must be a power of 2
+MAX_LOAD = 0.7
+INDEX_CHECK_INTERVAL = 1. # seconds between checks for an index replaced by another process
+WRITE_CHUNK = 2**20 # index slots written at a time
+
+# pack # 0 marks an empty index slot; this marks a deleted entry
+TOMBSTONE = 2**32 - 1
+
+class TilePack(object):
+    """append-only storage of tile data in large 'pack' files, with an on-disk
+    hash index mapping uuid => (pack file, offset, length). both the index and
+    the pack files are read via mmap, so lookups require no db round-trip or
+    per-tile file access, and data is returned as a zero-copy buffer (which stays
+    valid as long as it's referenced, even as the pack grows)
+
+    data is never overwritten in place; removing tile data just marks its index
+    entry as deleted. safe for one writer and many readers across processes
+    (writers are serialized with a lock file)
+    """
+
+    def __init__(self, root, max_pack_size=settings.TILE_PACK_MAX_SIZE):
+        self.root = root
+        self.max_pack_size = max_pack_size
+        self.lock = threading.RLock()
+
+        self.index = None
+        self.index_ino = None
+        self.index_checked = 0.
+        self.capacity = None
+        self.packs = {} # pack # => mmap
+
+    def index_path(self):
+        return os.path.join(self.root, 'index')
+
+    def pack_path(self, num):
+        return os.path.join(self.root, 'pack-%05d.dat' % num)
+
+    def exists(self):
+        return os.path.exists(self.index_path())
+
+    @staticmethod
+    def _key(uuid):
+        return binascii.unhexlify(uuid)
+
+    def _slot(self, key):
+        return struct.unpack('<Q', key)[0] & (self.capacity - 1)
+
+    def _entry_offset(self, slot):
+        return INDEX_HEADER.size + slot * INDEX_ENTRY.size
+
+    def _open_index(self, force=False, fresh=True):
+        """map the index file, re-mapping if it has been replaced since we last
+        opened it (i.e., resized by a writer in another process); return whether
+        the index exists
+
+        force -- create the index if it doesn't exist
+        fresh -- check the file even if it was checked within INDEX_CHECK_INTERVAL
+        """
+        now = time.time()
+        if not fresh and not force and now < self.index_checked + INDEX_CHECK_INTERVAL:
+            return self.index is not None
+
+        path = self.index_path()
+        try:
+            ino = os.stat(path).st_ino
+        except OSError:
+            if not force:
+                self.index_checked = now
+                return False
+            self._write_index(path, INITIAL_CAPACITY, np.zeros(0, dtype=INDEX_DTYPE))
+            ino = os.stat(path).st_ino
+        self.index_checked = now
+
+        if self.index is not None and ino == self.index_ino:
+            return True
+
+        with open(path, 'r+b') as f:
+            index = mmap.mmap(f.fileno(), 0)
+        magic, capacity, _, _ = INDEX_HEADER.unpack_from(index, 0)
+        if magic != INDEX_MAGIC:
+            raise IOError('%s is not a tile pack index' % path)
+
+        if self.index is not None:
+            self.index.close()
+        self.index = index
+        self.index_ino = ino
+        self.capacity = capacity
+        return True
+
+    def _write_index(self, path, capacity, entries, cur_pack=1):
+        """write a fresh index file containing 'entries' (array of INDEX_DTYPE),
+        atomically replacing any existing index"""
+        slots = place(entries, capacity)
+        order = np.argsort(slots)
+        entries, slots = entries[order], slots[order]
+
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, len(entries), cur_pack))
+            # stream the index in slot order, so only a chunk of empty slots is in
+            # memory at once
+            for start in range(0, capacity, WRITE_CHUNK):
+                end = min(start + WRITE_CHUNK, capacity)
+                lo, hi = np.searchsorted(slots, [start, end])
+                chunk = np.zeros(end - start, dtype=INDEX_DTYPE)
+                chunk[slots[lo:hi] - start] = entries[lo:hi]
+                chunk.tofile(f)
+        os.rename(tmppath, path)
+
+    def _probe(self, key):
+        """find the slot for 'key' in the index; return (slot, entry), where entry
+        is None if the key is not present (slot is then the first free slot)"""
+        i = self._slot(key)
+        free = None
+        while True:
+            entry = INDEX_ENTRY.unpack_from(self.index, self._entry_offset(i))
+            if entry[1] == 0:
+                return (free if free is not None else i, None)
+            elif entry[1] == TOMBSTONE:
+                if free is None:
+                    free = i
+            elif entry[0] == key:
+                return (i, entry)
+            i = (i + 1) % self.capacity
+
+    def _lookup(self, uuid):
+        key = self._key(uuid)
+        entry = self._probe(key)[1] if self.index is not None else None
+        if entry is None:
+            # index may have been created or resized by another process
+            if self._open_index(fresh=False):
+                entry = self._probe(key)[1]
+        return entry
+
+    def _pack_map(self, num, end):
+        """mmap of pack file 'num', guaranteed to extend to at least offset 'end'"""
+        mm = self.packs.get(num)
+        if mm is None or len(mm) < end:
+            # the superseded map is not closed: buffers already handed out still
+            # point into it. it's unmapped once the last of them is released
+            with open(self.pack_path(num), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.packs[num] = mm
+        return mm
+
+    def get(self, uuid):
+        """return tile data as a read-only buffer into the pack file; None if
+        not present"""
+        with self.lock:
+            entry = self._lookup(uuid)
+            if entry is None:
+                return None
+
+            _, num, offset, length = entry
+            return buffer(self._pack_map(num, offset + length), offset, length)
+
+    def __contains__(self, uuid):
+        with self.lock:
+            return self._lookup(uuid) is not None
+
+    def put(self, uuid, data):
+        """append tile data to the current pack file and index it; no-op if data
+        for this uuid is already stored"""
+        with self.lock, self._writelock():
+            self._open_index(True)
+            key = self._key(uuid)
+            slot, entry = self._probe(key)
+            if entry is not None:
+                return
+
+            num, offset = self._append(data)
+            INDEX_ENTRY.pack_into(self.index, self._entry_offset(slot), key, num, offset, len(data))
+            used, _ = self._header()
+            self._set_header(used + 1, num)
+
+            # deleted entries still occupy their slot until the index is rebuilt
+            if used + 1 > MAX_LOAD * self.capacity:
+                self._resize(2 * self.capacity if len(self) > MAX_LOAD / 2 * self.capacity else self.capacity)
+
+    def remove(self, uuid):
+        """mark tile data as deleted -- ok if not present. space in the pack file is
+        not reclaimed"""
+        with self.lock:
+            if not self.exists():
+                return
+
+            with self._writelock():
+                self._open_index()
+                slot, entry = self._probe(self._key(uuid))
+                if entry is not None:
+                    INDEX_ENTRY.pack_into(self.index, self._entry_offset(slot), entry[0], TOMBSTONE, 0, 0)
+
+    def _append(self, data):
+        """write data to the end of the current pack file, starting a new pack file
+        if the current one is full; return (pack #, offset)"""
+        _, num = self._header()
+        while True:
+            with open(self.pack_path(num), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                if offset > 0 and offset + len(data) > self.max_pack_size:
+                    num += 1
+                    continue
+
+                f.write(data)
+                return (num, offset)
+
+    def _header(self):
+        """return (# slots used, current pack #)"""
+        return INDEX_HEADER.unpack_from(self.index, 0)[2:]
+
+    def _set_header(self, used, cur_pack):
+        INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, self.capacity, used, cur_pack)
+
+    def __len__(self):
+        """number of stored tiles"""
+        with self.lock:
+            return len(self._entries()) if self._open_index() else 0
+
+    def _entries(self):
+        """array (of INDEX_DTYPE) of the stored entries"""
+        slots = np.frombuffer(self.index, dtype=INDEX_DTYPE, count=self.capacity, offset=INDEX_HEADER.size)
+        return slots[(slots['pack'] != 0) & (slots['pack'] != TOMBSTONE)]
+
+    def _resize(self, capacity):
+        logging.info('resizing tile pack index to %d entries' % capacity)
+        self.index.flush()
+        self._write_index(self.index_path(), capacity, self._entries(), self._header()[1])
+        self._open_index()
+
+    def _writelock(self):
+        return _FileLock(os.path.join(self.root, 'lock'))
+
+    def uuids(self):
+        """iterate the uuids of all stored tile data"""
+        with self.lock:
+            if not self._open_index():
+                return
+            keys = self._entries()['key'].tobytes() # (not tolist(), which strips trailing nuls)
+        for i in range(0, len(keys), 8):
+            yield binascii.hexlify(keys[i:i + 8])
+
+def place(entries, capacity):
+    """index slots for 'entries' in a linear-probing table of 'capacity' slots
+    (a power of 2), as if inserted one at a time"""
+    home = np.frombuffer(entries['key'].tobytes(), dtype='<u8') & np.uint64(capacity - 1)
+    order = np.argsort(home, kind='mergesort')
+    # in order of home slot, each entry goes in its home slot or right after the
+    # previous entry, whichever is later
+    n = len(entries)
+    steps = np.arange(n, dtype=np.int64)
+    slots = np.empty(n, dtype=np.int64)
+    slots[order] = steps + np.maximum.accumulate(home[order].astype(np.int64) - steps) if n else steps
+
+    # entries probing past the end wrap around to the first free slots
+    wrapped = np.nonzero(slots >= capacity)[0]
+    if len(wrapped):
+        taken = np.zeros(capacity, dtype=bool)
+        taken[slots[slots < capacity]] = True
+        free = np.nonzero(~taken)[0]
+        slots[wrapped[np.argsort(slots[wrapped])]] = free[:len(wrapped)]
+    return slots
+
+class _FileLock(object):
+    """exclusive inter-process lock on a file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, type, value, tb):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+_store = None
+_store_lock = threading.Lock()
+def store():
+    """the tile pack for this process"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            path = u.tilepack_path()
+            if not os.path.exists(path):
+                os.makedirs(path)
+            _store = TilePack(path)
+        return _store
+
+def migrate(sess, remove=False, onprogress=lambda n: None):
+    """copy all tile data stored as database blobs or as files into the tile pack
+
+    remove -- delete the original blob/file once copied
+    onprogress -- called with the running count of tiles migrated
+    """
+    import maptile as mt
+
+    pack = store()
+    count = 0
+
+    uuids = [r[0] for r in sess.query(mt.TileData.uuid)]
+    for chunk in u.chunker(uuids, 1000):
+        for td in sess.query(mt.TileData).filter(mt.TileData.uuid.in_(chunk)):
+            pack.put(td.uuid, td.data)
+            if remove:
+                sess.delete(td)
+            count += 1
+        sess.commit()
+        sess.expunge_all()
+        onprogress(count)
+
+    for path in glob(os.path.join(u.tiles_path(), *(['*'] * (len(settings.TILE_BUCKETS) + 1)))):
+        uuid, _ = os.path.splitext(os.path.basename(path))
+        with open(path, 'rb') as f:
+            pack.put(uuid, f.read())
+        if remove:
+            os.remove(path)
+        count += 1
+        onprogress(count)
+
+    return count
@@ -0,0 +1,143 @@
+"""a stand-in tile server, for exercising the downloader without hitting real
+mapservers
+
+run standalone with 'python -m mapcache.tileserver [port]' and point a layer's
+tile_url at 'http://localhost:<port>/{z}/{x}/{y}.png'; or run in-process:
+
+  server = TileServer(latency=.05)
+  server.start()
+  ... download from server.url_template() ...
+  server.terminate()
+"""
+
+import sys
+import time
+import random
+import threading
+import hashlib
+from StringIO import StringIO
+from optparse import OptionParser
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+import tornado.web as web
+
+TILE_DIM = 256
+NUM_COLORS = 16
+
+def tile_hash(z, x, y):
+    return int(hashlib.md5('%d/%d/%d' % (z, x, y)).hexdigest()[:8], 16)
+
+class TileHandler(web.RequestHandler):
+
+    def initialize(self, server):
+        self.server = server
+
+    @web.asynchronous
+    def get(self, z, x, y):
+        self.server.on_request()
+        if self.server.latency:
+            IOLoop.current().add_timeout(time.time() + self.server.latency, lambda: self.respond(int(z), int(x), int(y)))
+        else:
+            self.respond(int(z), int(x), int(y))
+
+    def respond(self, z, x, y):
+        status, data = self.server.tile(z, x, y)
+        self.set_status(status)
+        if data:
+            self.set_header('Content-Type', 'image/png')
+            self.write(data)
+        self.finish()
+        self.server.on_response()
+
+class TileServer(threading.Thread):
+    """a tile server running on its own event loop thread. every tile is a solid
+    color image
+
+    latency -- delay before responding to each request (seconds)
+    missing -- fraction of tiles that don't exist (404); always the same tiles
+    errors -- fraction of requests that fail with a transient server error (503)
+    """
+
+    def __init__(self, port=0, latency=0., missing=0., errors=0.):
+        threading.Thread.__init__(self)
+        self.latency = latency
+        self.missing = missing
+        self.errors = errors
+
+        self.sockets = bind_sockets(port, '127.0.0.1')
+        self.port = self.sockets[0].getsockname()[1]
+        self.ioloop = IOLoop(make_current=False)
+
+        self.images = {} # color => png data
+        self.num_requests = 0
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+
+    def url_template(self):
+        return 'http://127.0.0.1:%d/{z}/{x}/{y}.png' % self.port
+
+    def run(self):
+        self.ioloop.make_current()
+        app = web.Application([(r'/(\d+)/(\d+)/(\d+)\.png', TileHandler, {'server': self})],
+                              log_function=lambda handler: None)
+        server = HTTPServer(app)
+        server.add_sockets(self.sockets)
+        self.ioloop.start()
+        server.stop()
+        self.ioloop.close()
+
+    def terminate(self):
+        self.ioloop.add_callback(self.ioloop.stop)
+
+    def on_request(self):
+        self.num_requests += 1
+        self.num_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+
+    def on_response(self):
+        self.num_in_flight -= 1
+
+    def tile(self, z, x, y):
+        """return (http status, data)"""
+        if random.random() < self.errors:
+            return (503, None)
+
+        h = tile_hash(z, x, y)
+        if (h % 1000) < 1000 * self.missing:
+            return (404, None)
+        return (200, self.image(h % NUM_COLORS))
+
+    def image(self, color):
+        if color not in self.images:
+            level = 255 * color // (NUM_COLORS - 1)
+            buf = StringIO()
+            Image.new('RGB', (TILE_DIM, TILE_DIM), (level, level, 255 - level)).save(buf, 'png')
+            self.images[color] = buf.getvalue()
+        return self.images[color]
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options] [port]')
+    parser.add_option('--latency', dest='latency', type='float', default=0.,
+                      help='delay before each response (seconds)')
+    parser.add_option('--missing', dest='missing', type='float', default=0.,
+                      help='fraction of tiles that return 404')
+    parser.add_option('--errors', dest='errors', type='float', default=0.,
+                      help='fraction of requests that return 503')
+    (options, args) = parser.parse_args()
+
+    server = TileServer(int(args[0]) if args else 8001, options.latency, options.missing, options.errors)
+    print 'serving tiles at %s' % server.url_template()
+    server.start()
+    try:
+        while server.isAlive():
+            time.sleep(.1)
+    except KeyboardInterrupt:
+        pass
+    server.terminate()
+    server.join()
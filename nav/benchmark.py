@@ -0,0 +1,236 @@
+"""headless benchmark of the moving-map display pipeline. drives the tile atlas
+loader, decode pool, fallback tiles, prefetcher and overlay text batching along a
+synthetic (dead-reckoned) or recorded track, against the configured tile database,
+without gl or a window; reports the frame rate, mosaic build latency and memory
+
+usage: python -m nav.benchmark -l <layer> [options]
+
+run it against a fixed tile database (TILE_DB in localsettings) and compare runs
+with --json
+"""
+
+import sys
+import time
+import math
+import json
+import resource
+from datetime import datetime
+from optparse import OptionParser
+try:
+    import ImageFont
+except ImportError:
+    from PIL import ImageFont
+from sqlalchemy import func
+
+import settings
+import util.util as u
+from util import metrics
+from util import geodesy
+from mapcache import maptile
+from nav import texture
+from nav import overlay
+from nav.prefetch import Prefetcher
+from nav.tracker import Tracker, dead_reckoning_stream, tracklog_stream
+
+def default_pos(layer, zoom):
+    """the center of the layer's tiles at the deepest zoom level up to 'zoom'"""
+    sess = maptile.dbsess()
+    z = sess.query(func.max(maptile.Tile.z)).filter_by(layer=layer).filter(maptile.Tile.z <= zoom).scalar()
+    if z is None:
+        return None
+    x, y = sess.query(func.avg(maptile.Tile.x), func.avg(maptile.Tile.y)).filter_by(layer=layer, z=z).one()
+    return maptile.mercator_to_ll(maptile.xy_to_mercator(maptile.tilef_to_xy((float(x) + .5, float(y) + .5), z)))
+
+def load_font():
+    try:
+        return ImageFont.truetype(overlay.FONT, overlay.FONT_SIZE)
+    except IOError:
+        return ImageFont.load_default()
+
+class Bench(object):
+    """the per-frame work of birdseye's DrawGLScene, minus the gl calls"""
+
+    def __init__(self, tracker, layer, zoom, width, height, prefetch=True):
+        self.tracker = tracker
+        self.layer = layer
+        self.zoom = zoom
+
+        self.loader = texture.AtlasLoader(width, height)
+        self.prefetcher = Prefetcher(tracker, width, height) if prefetch else None
+        self.hud = overlay.TextBatch(None, overlay.render_glyphs(load_font())[1])
+        self.num_frames = 0
+        self.num_views = 0
+        self.tile = None
+
+    def start(self):
+        self.loader.start()
+        if self.prefetcher:
+            self.prefetcher.start()
+
+    def terminate(self):
+        """stop the loader (and its decode pool) and prefetcher threads, and wait for
+        them to exit"""
+        self.loader.terminate()
+        if self.prefetcher:
+            self.prefetcher.terminate()
+        self.loader.join()
+        if self.prefetcher:
+            self.prefetcher.join()
+
+    def frame(self):
+        start = time.time()
+        with metrics.timer('frame.get_loc'):
+            k = self.tracker.get_loc()
+        pos = k['p'][:2]
+        xy = maptile.mercator_to_xy(maptile.ll_to_mercator(pos))
+        tile = maptile.xy_to_tile(xy, self.zoom)
+
+        if tile != self.tile:
+            self.loader.set(self.layer, self.zoom, tile)
+            self.tile = tile
+            self.num_views += 1
+        if self.prefetcher:
+            self.prefetcher.set_view(self.layer, self.zoom)
+        with metrics.timer('frame.tex_updates'):
+            while not self.loader.out.empty():
+                self.loader.out.get()()
+        self.loader.texcoords()
+
+        with metrics.timer('frame.text'):
+            inst = datetime.now()
+            meters_per_pixel = 2 * math.pi * geodesy.EARTH_MEAN_RAD * math.cos(math.radians(pos[0])) / (256 * 2.**self.zoom)
+            self.hud.add('%04d-%s-%02d %s' % (inst.year, inst.strftime('%b'), inst.day, inst.strftime('%a')), (1.35, -1.17), (.5, .5))
+            self.hud.add('%02d:%02d:%02d.%02d' % (inst.hour, inst.minute, inst.second, inst.microsecond / 10000), (1.35, -1.12))
+            self.hud.add('%d m' % (100 * meters_per_pixel), (1.7, 1.04), (.5, .5))
+            self.hud.add(u'%08.5f\xb0' % abs(pos[0]), (-1.8, 1.015), (.7, .7))
+            self.hud.add(u'%09.5f\xb0' % abs(pos[1]), (-1.8, 1.085), (.7, .7))
+            self.hud.arrays()
+
+        metrics.record('frame', time.time() - start)
+        self.num_frames += 1
+
+def time_mosaic(layer, zoom, pos, width, height):
+    """time assembling a full texture with texture.get_texture_image, from a cold and
+    a warm tile cache"""
+    tile = maptile.xy_to_tile(maptile.mercator_to_xy(maptile.ll_to_mercator(pos)), zoom)
+    args = (layer, zoom, tile[0] - width / 2, tile[1] - height / 2, width, height)
+
+    texture.cache.clear()
+    with metrics.timer('mosaic.cold'):
+        texture.get_texture_image(*args)
+    with metrics.timer('mosaic.warm'):
+        texture.get_texture_image(*args)
+    texture.cache.clear()
+
+def run(tracker, layer, zoom, pos, duration, fps, (width, height), prefetch=True):
+    metrics.reset()
+    time_mosaic(layer, zoom, pos, width, height)
+
+    bench = Bench(tracker, layer, zoom, width, height, prefetch)
+    bench.start()
+    start = time.time()
+    while time.time() - start < duration:
+        frame_start = time.time()
+        bench.frame()
+        # give the loader threads a chance, as the gl wait in a real frame would
+        time.sleep(max(1. / fps - (time.time() - frame_start), 0.) if fps else 0.)
+    elapsed = time.time() - start
+    bench.terminate()
+
+    snap = metrics.snapshot()
+    t = lambda name: snap['timers'].get(name)
+    hits, misses, _, cache_bytes = texture.cache.stats()
+    return {
+        'layer': layer,
+        'zoom': zoom,
+        'duration': elapsed,
+        'frames': bench.num_frames,
+        'fps': bench.num_frames / elapsed,
+        'frame_ms': t('frame'),
+        'get_loc_ms': t('frame.get_loc'),
+        'tex_updates_ms': t('frame.tex_updates'),
+        'text_ms': t('frame.text'),
+        'views': bench.num_views,
+        'build_ms': t('texture.build'),
+        'complete_ms': t('texture.complete'),
+        'tile_latency_ms': t('texture.tile_latency'),
+        'decode_ms': t('tile.decode'),
+        'fallback_ms': t('tile.fallback'),
+        'mosaic_cold_ms': t('mosaic.cold')['max'],
+        'mosaic_warm_ms': t('mosaic.warm')['max'],
+        'uploads': snap['counters'].get('texture.uploads', 0),
+        'prefetched': snap['counters'].get('prefetch.tiles', 0),
+        'cache_hit_rate': float(hits) / (hits + misses) if hits + misses else None,
+        'cache_mb': cache_bytes / 2.**20,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    }
+
+def print_report(r):
+    def dist(name):
+        st = r[name]
+        return 'p50 %7.2f  p90 %7.2f  p99 %7.2f  max %7.2f ms  (n=%d)' % (st['p50'], st['p90'], st['p99'], st['max'], st['n']) if st else '-'
+
+    print '%s z%d, %.1fs' % (r['layer'], r['zoom'], r['duration'])
+    print '  frames            %d (%.1f fps)' % (r['frames'], r['fps'])
+    print '  frame             %s' % dist('frame_ms')
+    print '    get_loc         %s' % dist('get_loc_ms')
+    print '    texture updates %s' % dist('tex_updates_ms')
+    print '    text            %s' % dist('text_ms')
+    print '  view changes      %d' % r['views']
+    print '  stand-in pass     %s' % dist('build_ms')
+    print '  view complete     %s' % dist('complete_ms')
+    print '  tile latency      %s' % dist('tile_latency_ms')
+    print '  tile decode       %s' % dist('decode_ms')
+    print '  fallback tile     %s' % dist('fallback_ms')
+    print '  full mosaic       cold %.1f ms, warm %.1f ms' % (r['mosaic_cold_ms'], r['mosaic_warm_ms'])
+    print '  uploads           %d tiles, %d prefetched' % (r['uploads'], r['prefetched'])
+    print '  tile cache        %s hit rate, %.1f MB' % ('%.2f' % r['cache_hit_rate'] if r['cache_hit_rate'] is not None else '-', r['cache_mb'])
+    print '  max rss           %.1f MB' % r['max_rss_mb']
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog -l LAYER [options]')
+    parser.add_option('-l', '--layer', dest='layer', help='map layer to render')
+    parser.add_option('-z', '--zoom', dest='zoom', type='int', default=12)
+    parser.add_option('--dp', dest='demopos',
+                      help='starting position (default: the center of the layer\'s tiles)')
+    parser.add_option('--dv', dest='demovel', default='300,90',
+                      help='speed (m/s) and heading for a dead-reckoned track')
+    parser.add_option('--hist', dest='hist', help='replay a recorded track: start[:speedup], as for birdseye')
+    parser.add_option('-t', '--duration', dest='duration', type='float', default=20., help='seconds')
+    parser.add_option('--fps', dest='fps', type='float', default=settings.RENDER_FPS,
+                      help='frame rate to pace at (0: as fast as possible)')
+    parser.add_option('--no-prefetch', dest='prefetch', action='store_false', default=True)
+    parser.add_option('--json', dest='json', action='store_true', help='print the results as json')
+    (options, args) = parser.parse_args()
+
+    if not options.layer:
+        parser.error('layer required')
+
+    if options.hist:
+        x = options.hist.split(':')
+        start = datetime.strptime(x[0], '%Y%m%d%H%M%S')
+        fixstream = tracklog_stream(settings.GPS_LOG_DB, start, float(x[1]) if len(x) > 1 else 1.)
+        pos = None
+    else:
+        pos = u.parse_ll(options.demopos) if options.demopos else default_pos(options.layer, options.zoom)
+        if pos is None:
+            sys.exit('no tiles for layer %s' % options.layer)
+        speed, heading = [float(k) for k in options.demovel.split(',')]
+        fixstream = dead_reckoning_stream(pos, (speed, heading))
+
+    tracker = Tracker(fixstream)
+    tracker.start()
+    while tracker.get_loc() is None:
+        time.sleep(.1)
+    if pos is None:
+        pos = tracker.get_loc()['p'][:2]
+
+    results = run(tracker, options.layer, options.zoom, pos, options.duration, options.fps,
+                  texture.atlas_size(settings.SCREEN_DIM), options.prefetch)
+    tracker.terminate()
+    tracker.join()
+
+    if options.json:
+        print json.dumps(results, sort_keys=True)
+    else:
+        print_report(results)
@@ -0,0 +1,167 @@
+"""batched drawing for the map overlays (text, markers, lines). instead of a
+glBegin/glEnd per quad, geometry is built as vertex arrays and each layer is drawn
+with a single call; fixed geometry is compiled into display lists once"""
+
+import collections
+import numpy as np
+from OpenGL.GL import *
+try:
+    import Image
+    import ImageDraw
+except ImportError:
+    from PIL import Image, ImageDraw
+
+FONT = '/usr/share/fonts/truetype/freefont/FreeSansBold.ttf'
+FONT_SIZE = 30
+
+# printable ascii, and the degree sign
+GLYPHS = u''.join(unichr(c) for c in range(32, 127)) + u'\xb0'
+
+def draw_arrays(mode, vertices, texcoords=None):
+    """draw primitives from arrays of 2d vertices (and texture coordinates)"""
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, vertices)
+    if texcoords is not None:
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glTexCoordPointer(2, GL_FLOAT, 0, texcoords)
+    glDrawArrays(mode, 0, len(vertices))
+    if texcoords is not None:
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+
+def draw_line(points, color, width):
+    """draw a line strip through [(x, y), ...] (untextured)"""
+    if len(points) < 2:
+        return
+    glLineWidth(width)
+    glColor4f(*color)
+    draw_arrays(GL_LINE_STRIP, np.asarray(points, dtype=np.float32))
+
+class DisplayList(object):
+    """fixed geometry, compiled into a gl display list the first time it's drawn.
+    state that varies between draws (color, texture, transform) is set by the caller"""
+
+    def __init__(self, build):
+        """build -- function issuing the gl calls to compile"""
+        self.build = build
+        self.id = None
+
+    def draw(self):
+        if self.id is None:
+            self.id = glGenLists(1)
+            glNewList(self.id, GL_COMPILE)
+            self.build()
+            glEndList()
+        glCallList(self.id)
+
+def quad(corners, texcoords):
+    """display list for a textured quad; corners and texcoords are [(x, y), ...] in
+    drawing order"""
+    def build():
+        glBegin(GL_QUADS)
+        for (s, t), (x, y) in zip(texcoords, corners):
+            glTexCoord2f(s, t)
+            glVertex3f(x, y, 0.)
+        glEnd()
+    return DisplayList(build)
+
+def render_glyphs(font, chars=GLYPHS, dim=1024):
+    """render each of 'chars' into a dim x dim glyph texture image, packed in rows;
+    return (image, {char: (x, y, width, height)}) as for TextBatch"""
+    img = Image.new('RGBA', (dim, dim))
+    draw = ImageDraw.Draw(img)
+    row_height = max(font.getsize(c)[1] for c in chars) + 1
+
+    glyphs = {}
+    x, y = 0, 0
+    for c in chars:
+        w, h = font.getsize(c)
+        if x + w > dim:
+            x, y = 0, y + row_height
+        if y + row_height > dim:
+            raise ValueError('glyphs don\'t fit in a %dx%d texture' % (dim, dim))
+        draw.text((x, y), c, font=font)
+        glyphs[c] = (x, y, w, h)
+        x += w + 1 # keep neighboring glyphs from bleeding in when filtered
+    return (img, glyphs)
+
+class TextBatch(object):
+    """text drawn from a texture of pre-rendered glyphs. strings are laid out once
+    into quad vertex arrays (and cached, as most strings are the same from frame to
+    frame), queued with add(), and all drawn with a single call by draw()"""
+
+    CACHE_SIZE = 256 # strings
+
+    def __init__(self, tex_id, glyphs, tex_dim=1024, unit=256.):
+        """
+        tex_id -- glyph texture
+        glyphs -- {char: (x, y, width, height)} in texels, from the top-left corner
+          of the texture; unknown chars are drawn as '?'
+        tex_dim -- size of the (square) glyph texture
+        unit -- texels per unit of model space
+        """
+        self.tex_id = tex_id
+        self.glyphs = glyphs
+        self.tex_dim = float(tex_dim)
+        self.unit = float(unit)
+
+        self.layouts = collections.OrderedDict() # string => (vertices, texcoords, width)
+        self.queue = []
+
+    def layout(self, s):
+        """(vertex array, texture coordinate array, width) for a string drawn at the
+        origin"""
+        if s in self.layouts:
+            entry = self.layouts.pop(s)
+            self.layouts[s] = entry
+            return entry
+
+        metrics = np.array([self.glyphs.get(c, self.glyphs['?']) for c in s], dtype=np.float64).reshape(-1, 4)
+        xo, yo, w, h = metrics.T
+        x0 = np.cumsum(w) - w
+        zero = np.zeros(len(s))
+
+        def corners(left, right, bottom, top):
+            return np.dstack([np.column_stack([left, right, right, left]),
+                              np.column_stack([bottom, bottom, top, top])]).reshape(-1, 2).astype(np.float32)
+        vertices = corners(x0, x0 + w, zero, h) / np.float32(self.unit)
+        texcoords = corners(xo / self.tex_dim, (xo + w) / self.tex_dim, 1. - yo / self.tex_dim, 1. - (yo + h) / self.tex_dim)
+
+        entry = (vertices, texcoords, w.sum() / self.unit)
+        self.layouts[s] = entry
+        if len(self.layouts) > self.CACHE_SIZE:
+            self.layouts.popitem(last=False)
+        return entry
+
+    def width(self, s):
+        """width of a string at unit scale"""
+        return self.layout(s)[2]
+
+    def add(self, s, (x, y), scale=(1., 1.)):
+        """queue a string to be drawn with its origin at (x, y)"""
+        self.queue.append((s, (x, y), scale))
+
+    def arrays(self):
+        """(vertex array, texture coordinate array) of all queued strings, or None if
+        none; clears the queue"""
+        if not self.queue:
+            return None
+
+        vertices, texcoords = [], []
+        for s, offset, scale in self.queue:
+            v, t, _ = self.layout(s)
+            vertices.append(v * np.array(scale, dtype=np.float32) + np.array(offset, dtype=np.float32))
+            texcoords.append(t)
+        self.queue = []
+        return (np.concatenate(vertices), np.concatenate(texcoords))
+
+    def draw(self, color):
+        """draw all queued strings and clear the queue"""
+        batch = self.arrays()
+        if batch is None:
+            return
+
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.tex_id)
+        glColor4f(*color)
+        draw_arrays(GL_QUADS, *batch)
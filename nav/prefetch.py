@@ -0,0 +1,116 @@
+import threading
+import heapq
+import math
+import time
+import logging
+from util import geodesy
+from mapcache import maptile
+from nav import texture
+import util.util as u
+from util import metrics
+import settings
+
+PLAN_INTERVAL = 0.5 # seconds between re-planning from the latest position
+MAX_STEPS = 200 # positions sampled along the projected path
+# tiles of the adjacent zoom levels (for the zoom keys) are prefetched as if they
+# would come into view this many seconds from now
+ADJACENT_ZOOM_DELAY = 2. # seconds
+
+class Prefetcher(threading.Thread):
+    """warm the decoded-tile cache (see texture.cache) with the tiles likely to be
+    needed soon: the position is projected forward along the current velocity for
+    the next 'lookahead' seconds, and the tiles that will come into view are loaded
+    in order of when they will become visible. the views at the adjacent zoom levels
+    are prefetched as well"""
+
+    def __init__(self, tracker, width, height, lookahead=None):
+        """
+        tracker -- Tracker providing position and velocity
+        width, height -- size of the view, in tiles (as for texture.TileAtlas)
+        lookahead -- how far ahead to prefetch (seconds)
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.up = True
+        self.lock = threading.Lock()
+
+        self.tracker = tracker
+        self.width = width
+        self.height = height
+        self.lookahead = lookahead if lookahead is not None else settings.PREFETCH_LOOKAHEAD
+
+        self.view = None # (layer, zoom)
+        self.count = 0 # tiles loaded into the cache
+
+    def set_view(self, layer, zoom):
+        with self.lock:
+            self.view = (layer, zoom)
+
+    def terminate(self):
+        self.up = False
+
+    def run(self):
+        while self.up:
+            deadline = time.time() + PLAN_INTERVAL
+            try:
+                with self.lock:
+                    view = self.view
+                loc = self.tracker.get_loc()
+                queue = self.plan(view, loc) if view and loc else []
+                self.index(queue)
+                while queue and self.up and time.time() < deadline:
+                    _, key = heapq.heappop(queue)
+                    self.fetch(*key)
+            except:
+                logging.exception('unexpected exception in prefetch thread')
+            time.sleep(max(deadline - time.time(), 0.))
+
+    def index(self, queue):
+        """look up the db entries for all planned tiles at once (see texture.index_tiles)"""
+        by_zoom = u.map_reduce([key for _, key in queue], lambda (layer, z, x, y): [((layer, z), (x, y))])
+        for (layer, z), tiles in by_zoom.iteritems():
+            texture.index_tiles(layer, z, tiles)
+
+    def fetch(self, layer, zoom, x, y):
+        if not texture.cache.contains((layer, zoom, x % 2**zoom, y, 'RGB')):
+            texture.get_img_chunk(layer, zoom, x % 2**zoom, y)
+            self.count += 1
+            metrics.incr('prefetch.tiles')
+
+    def plan(self, (layer, zoom), loc):
+        """return a heap of (expected seconds until visible, (layer, z, x, y)) for the
+        tiles to prefetch"""
+        pos = loc['p'][:2]
+        speed, heading = loc['v'][:2] if loc['v'] else (None, None)
+
+        eta = {}
+        def visible(p, z, t):
+            cx, cy = maptile.xy_to_tile(maptile.mercator_to_xy(maptile.ll_to_mercator(p)), z)
+            xmin = cx - self.width / 2
+            ymin = cy - self.height / 2
+            for x in range(xmin, xmin + self.width):
+                for y in range(ymin, ymin + self.height):
+                    if y >= 0 and y < 2**z:
+                        key = (layer, z, x, y)
+                        eta[key] = min(eta.get(key, t), t)
+
+        for p, t in self.path(pos, speed, heading, zoom):
+            visible(p, zoom, t)
+        for z in (zoom - 1, zoom + 1):
+            if z >= 0:
+                visible(pos, z, ADJACENT_ZOOM_DELAY)
+
+        queue = [(t, key) for key, t in eta.iteritems()]
+        heapq.heapify(queue)
+        return queue
+
+    def path(self, pos, speed, heading, zoom):
+        """sample the projected path as [(position, seconds from now), ...], about
+        every half tile"""
+        if not speed or heading is None:
+            return [(pos, 0.)]
+
+        tile_size = 2 * math.pi * geodesy.EARTH_MEAN_RAD * math.cos(math.radians(pos[0])) / 2**zoom
+        num_steps = min(int(speed * self.lookahead / (.5 * tile_size)) + 1, MAX_STEPS)
+        times = [float(self.lookahead) * i / num_steps for i in range(num_steps + 1)]
+        return [(p, t) for (p, _), t in zip(geodesy.plot_dv(pos, heading, [speed * t for t in times]), times)]
@@ -0,0 +1,113 @@
+import os
+import math
+import collections
+import logging
+import settings
+
+STATS_WINDOW = 5. # seconds of frames averaged for stats()
+STATS_LOG_INTERVAL = 60. # seconds
+
+def cpu_time():
+    """cpu time used by this process (user + system), in seconds"""
+    t = os.times()
+    return t[0] + t[1]
+
+class FrameScheduler(object):
+    """decides when the display needs redrawing: at most 'fps' frames/sec, and only
+    when something visible has changed since the last frame drawn -- the position
+    moved at least 'min_move' pixels, some other visible state changed (the view,
+    the clock, texture updates, ...), or continuous animations are on screen. in
+    low-power mode animations are turned off and the frame rate is capped lower
+
+    call should_draw() from the idle handler, and drawn() once the frame is drawn
+    """
+
+    def __init__(self, fps=None, low_power_fps=None, min_move=None, low_power=None):
+        self.fps = fps or settings.RENDER_FPS
+        self.low_power_fps = low_power_fps or settings.RENDER_LOW_POWER_FPS
+        self.min_move = min_move if min_move is not None else settings.RENDER_MIN_MOVE
+        self.low_power = low_power if low_power is not None else settings.RENDER_LOW_POWER
+
+        self.next_frame = 0.
+        self.last = None # (position, state) of the last frame drawn
+        self.pending = None # (position, state) of the frame requested
+
+        self.frames = collections.deque() # (time drawn, seconds to draw, cpu time)
+        self.num_drawn = 0
+        self.num_skipped = 0
+        self.next_report = None
+
+    def target_fps(self):
+        return self.low_power_fps if self.low_power else self.fps
+
+    def animating(self):
+        """whether continuous animations (pulsing cursor, rotating markers) are on"""
+        return not self.low_power
+
+    def toggle_low_power(self):
+        self.low_power = not self.low_power
+        self.last = None # redraw with animations on/off
+
+    def should_draw(self, now, pos, state):
+        """whether a frame should be drawn now
+
+        pos -- position at the center of the view, in screen pixels
+        state -- everything else visible, compared by equality
+        """
+        if now < self.next_frame:
+            return False
+
+        if self.last is None or self.animating() or state != self.last[1] or \
+                math.hypot(pos[0] - self.last[0][0], pos[1] - self.last[0][1]) >= self.min_move:
+            self.pending = (pos, state)
+            return True
+
+        self.num_skipped += 1
+        return False
+
+    def idle_time(self, now):
+        """how long the idle handler can sleep before checking again"""
+        return max(self.next_frame - now, .5 / self.target_fps())
+
+    def drawn(self, start, end):
+        """record a frame drawn from 'start' to 'end' (time.time())"""
+        self.last = self.pending
+        self.next_frame = max(self.next_frame + 1. / self.target_fps(), start)
+        self.num_drawn += 1
+
+        self.frames.append((end, end - start, cpu_time()))
+        while self.frames and self.frames[0][0] < end - STATS_WINDOW:
+            self.frames.popleft()
+
+    def stats(self):
+        """measured display performance over the last STATS_WINDOW seconds:
+        {'fps': frames/sec, 'frame_ms': avg. time to draw a frame, 'cpu': fraction of a
+        core used by the whole process, 'drawn': total frames drawn, 'skipped': total
+        idle checks that found nothing to redraw, 'low_power': ...}"""
+        frames = list(self.frames)
+        if len(frames) > 1:
+            elapsed = frames[-1][0] - frames[0][0]
+            fps = (len(frames) - 1) / elapsed if elapsed > 0 else None
+            cpu = (frames[-1][2] - frames[0][2]) / elapsed if elapsed > 0 else None
+        else:
+            fps, cpu = None, None
+        return {
+            'fps': fps,
+            'frame_ms': 1000. * sum(f[1] for f in frames) / len(frames) if frames else None,
+            'cpu': cpu,
+            'drawn': self.num_drawn,
+            'skipped': self.num_skipped,
+            'low_power': self.low_power,
+        }
+
+    def report(self, now):
+        """log stats() every STATS_LOG_INTERVAL seconds"""
+        if self.next_report is not None and now < self.next_report:
+            return
+        if self.next_report is not None:
+            st = self.stats()
+            fmt = lambda f, v: f % v if v is not None else '-'
+            logging.info('display: %s fps, %s ms/frame, %s cpu, %d drawn, %d skipped%s' % (
+                fmt('%.1f', st['fps']), fmt('%.1f', st['frame_ms']), fmt('%.0f%%', 100. * st['cpu'] if st['cpu'] is not None else None),
+                st['drawn'], st['skipped'], ' (low power)' if st['low_power'] else ''))
+        self.next_report = now + STATS_LOG_INTERVAL
@@ -6,15 +6,119 @@ except ImportError:
   from PIL.Image import *
   from PIL import ImageEnhance
 import os
+import collections
+import threading
+import itertools
+import Queue
+import time
+import math
 from mapcache import mapdownload
 from mapcache import maptile
 import settings
 import sys
+import logging
 import util.util as u
+from util import metrics
 
 blocksize = 256
 fallback = settings.LOOKBACK
 
+class TileCache(object):
+  """memory-bounded lru cache of decoded tile images, keyed by (layer, z, x, y,
+  variant). None (no tile) is cached too, but only for 'miss_ttl' seconds, as are
+  the tiles' db entries (variant 'uuid'). entries can be given an expiry of their
+  own. thread-safe"""
+
+  ENTRY_OVERHEAD = 1024 # bytes charged per entry on top of the image data
+
+  def __init__(self, max_bytes, miss_ttl=None):
+    self.max_bytes = max_bytes
+    self.miss_ttl = miss_ttl
+    self.entries = collections.OrderedDict() # key => (image, size, expiry time or None)
+    self.size = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+
+  def _live(self, key):
+    """the unexpired entry for 'key', or None; call with the lock held"""
+    entry = self.entries.get(key)
+    if entry is not None and entry[2] is not None and entry[2] <= time.time():
+      return None
+    return entry
+
+  def get(self, key, load, ttl=None):
+    """return the cached image for 'key', or call 'load()' to produce and cache it
+    (see put())"""
+    with self.lock:
+      entry = self._live(key)
+      if entry is not None:
+        self.hits += 1
+        self.entries[key] = self.entries.pop(key)
+        return entry[0]
+      self.misses += 1
+
+    img = load()
+    self.put(key, img, ttl)
+    return img
+
+  def put(self, key, img, ttl=None):
+    """cache 'img' for 'key', for 'ttl' seconds if given (miss_ttl if img is None),
+    otherwise until evicted"""
+    size = self.ENTRY_OVERHEAD + (img.size[0] * img.size[1] * len(img.getbands()) if hasattr(img, 'getbands') else 0)
+    if ttl is None and img is None:
+      ttl = self.miss_ttl
+    with self.lock:
+      if key in self.entries:
+        self.size -= self.entries.pop(key)[1]
+      self.entries[key] = (img, size, time.time() + ttl if ttl else None)
+      self.size += size
+      while self.size > self.max_bytes and self.entries:
+        self.size -= self.entries.popitem(last=False)[1][1]
+
+  def peek(self, key):
+    """return (whether 'key' is cached, cached image); doesn't count as a hit or
+    refresh the entry"""
+    with self.lock:
+      entry = self._live(key)
+      return (entry is not None, entry[0] if entry else None)
+
+  def contains(self, key):
+    """whether 'key' is cached; doesn't count as a hit or refresh the entry"""
+    with self.lock:
+      return self._live(key) is not None
+
+  def discard(self, key):
+    with self.lock:
+      if key in self.entries:
+        self.size -= self.entries.pop(key)[1]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+  def stats(self):
+    """(hits, misses, # entries, bytes used)"""
+    return (self.hits, self.misses, len(self.entries), self.size)
+
+cache = TileCache(settings.TEXTURE_CACHE_MEMORY * 2**20, settings.TEXTURE_CACHE_MISS_TTL)
+
+def cache_hit_rate():
+  hits, misses, _, _ = cache.stats()
+  return float(hits) / (hits + misses) if hits + misses else None
+metrics.gauge('tile_cache.hit_rate', cache_hit_rate)
+metrics.gauge('tile_cache.mb', lambda: cache.stats()[3] / 2.**20)
+
+static_images = {}
+def static_image (name):
+  if name not in static_images:
+    img = open(u.pixmap_path(name))
+    img.load()
+    static_images[name] = img
+  return static_images[name]
+
 def get_texture_image (mode, zoom, xmin, ymin, width, height, alpha=False):
   tx = new("RGBA" if alpha else "RGB", (blocksize * width, blocksize * height))
 
@@ -28,29 +132,310 @@ def get_texture_image (mode, zoom, xmin, ymin, width, height, alpha=False):
 
   return tx
 
+class TileAtlas(object):
+  """bookkeeping for a toroidal texture atlas of width x height tile slots. tile
+  (x, y) always lives in slot (x mod width, y mod height), so when the view scrolls
+  only the slots of newly exposed tiles need to be loaded, and the atlas is drawn
+  with wrapping texture coordinates. doesn't touch gl; the caller uploads the
+  changed slots"""
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    self.slots = {} # (sx, sy) => (layer, z, x, y) of the tile in the slot
+    self.lock = threading.Lock()
+
+  def assign(self, mode, zoom, xmin, ymin):
+    """assign the tiles of the view whose top-left tile is (xmin, ymin) to their
+    slots; return [((sx, sy), (layer, z, x, y)), ...] for the slots whose tile
+    changed, those nearest the center of the view first. x is not wrapped around the
+    world (see load_slot)"""
+    changes = []
+    with self.lock:
+      for bx in range(0, self.width):
+        for by in range(0, self.height):
+          x = xmin + bx
+          y = ymin + by
+          slot = (x % self.width, y % self.height)
+          key = (mode, zoom, x, y)
+          if self.slots.get(slot) != key:
+            changes.append((slot, key))
+            self.slots[slot] = key
+    center = (xmin + .5 * (self.width - 1), ymin + .5 * (self.height - 1))
+    return sorted(changes, key=lambda (slot, (_, _z, x, y)): abs(x - center[0]) + abs(y - center[1]))
+
+  def update(self, mode, zoom, xmin, ymin, alpha=False):
+    """bring the atlas up to date for the view whose top-left tile is (xmin, ymin);
+    return [((sx, sy), image), ...] for the slots whose tile changed"""
+    return [(slot, load_slot(key, alpha)) for slot, key in self.assign(mode, zoom, xmin, ymin)]
+
+  def holds(self, slot, key):
+    """whether the slot is (still) assigned the tile 'key'"""
+    with self.lock:
+      return self.slots.get(slot) == key
+
+  def texcoords(self, xmin, ymin):
+    """texture coordinates (u0, v0) of the view's top-left corner; the view spans
+    (u0, v0) to (u0 + 1, v0 - 1), with texture rows stored bottom-up. reduced so
+    they stay precise as floats at deep zooms"""
+    return (float(xmin % self.width) / self.width, 1. - float(ymin % self.height) / self.height)
+
+  def invalidate(self):
+    with self.lock:
+      self.slots.clear()
+
+def load_slot ((mode, zoom, x, y), alpha=False):
+  """image for a tile assigned to an atlas slot"""
+  return get_img_chunk(mode, zoom, x % 2**zoom, y, alpha)
+
+class DecodePool(object):
+  """worker threads that load tiles (db lookup, decode, fallback synthesis) into the
+  cache, several at a time. jobs are run newest generation (e.g., view) first, and
+  by priority within a generation; a job is dropped if it's no longer wanted by the
+  time a worker gets to it"""
+
+  def __init__(self, num_workers):
+    self.queue = Queue.PriorityQueue()
+    self.seq = itertools.count()
+    self.workers = [threading.Thread(target=self.work) for i in range(num_workers)]
+    for w in self.workers:
+      w.daemon = True
+      w.start()
+
+  def submit(self, generation, priority, key, wanted, done, alpha=False):
+    """load atlas tile 'key' (see load_slot), then call done(image) from the worker
+    thread. wanted() is checked before loading and before calling done()"""
+    self.queue.put(((-generation, priority, self.seq.next()), (key, alpha, wanted, done)))
+
+  def work(self):
+    while True:
+      _, job = self.queue.get()
+      if job is None:
+        return
+      key, alpha, wanted, done = job
+      try:
+        if wanted():
+          img = load_slot(key, alpha)
+          if wanted():
+            done(img)
+      except:
+        logging.exception('error loading tile %s' % (key,))
+
+  def terminate(self):
+    for w in self.workers:
+      self.queue.put(((float('-inf'), 0, self.seq.next()), None))
+
+  def join(self):
+    """wait for the workers to exit after terminate() (each finishes its current job)"""
+    for w in self.workers:
+      w.join()
+
+def atlas_size ((screen_width, screen_height)):
+  """(width, height) in tiles of an atlas big enough to cover the screen while
+  scrolling"""
+  # hack
+  def round_up_even(k):
+    return max(int(2. * math.floor(.5 * (k + 1))), 6)
+  return (round_up_even(screen_width // 256 + 2), round_up_even(screen_height // 256 + 2))
+
+def tile_pixels (img):
+  """raw pixel data of a tile image for uploading, rows bottom-up"""
+  if img.mode != 'RGB':
+    img = img.convert('RGB')
+  return img.tobytes("raw", "RGBX", 0, -1)
+
+class AtlasLoader(threading.Thread):
+  """keeps a toroidal atlas of tiles (see TileAtlas) loaded for the current view.
+  when the view changes, the newly exposed slots are filled right away from the
+  tile cache (with an enlarged ancestor tile standing in for tiles not cached yet),
+  and the rest are loaded by a pool of workers (see DecodePool) as each finishes
+
+  doesn't touch gl: each batch of tiles loaded is queued on 'out' as a callback
+  (see uploader()) for the gl thread to run"""
+
+  def __init__(self, width, height, num_workers=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.up = True
+    self.lock = threading.Lock()
+    self.in_ = Queue.Queue()
+    self.out = Queue.Queue()
+
+    self.width = width
+    self.height = height
+    self.atlas = TileAtlas(width, height)
+    self.pool = DecodePool(num_workers or settings.TEXTURE_DECODE_WORKERS)
+    self.generation = 0
+    self.outstanding = 0 # pool jobs of the current generation not yet delivered
+    self.blank = tile_pixels(new('RGB', (256, 256)))
+    self.curview = None # view most recently loaded
+    self.drawn = None # view currently uploaded to the texture
+
+  def terminate(self):
+    self.up = False
+    self.pool.terminate()
+
+  def join(self, timeout=None):
+    threading.Thread.join(self, timeout)
+    self.pool.join()
+
+  def set(self, view, zoom, tile):
+    self.in_.put((view, zoom, tile))
+
+  def run(self):
+    while self.up:
+      newview = None
+      try:
+        newview = self.in_.get(True, 0.05)
+        # skip ahead to the most recent view
+        while True:
+          newview = self.in_.get(False)
+      except Queue.Empty:
+        pass
+
+      if newview and newview != self.curview:
+        self.load(newview)
+
+  def load(self, newview):
+    view, zoom, tile = newview
+    xmin = tile[0] - self.width / 2
+    ymin = tile[1] - self.height / 2
+
+    build_start = time.time()
+    uploads = []
+    pending = []
+    for slot, key in self.atlas.assign(view, zoom, xmin, ymin):
+      img, final = peek_img_chunk(view, zoom, key[2] % 2**zoom, key[3])
+      uploads.append((slot, key, tile_pixels(img) if img is not None else self.blank))
+      if not final:
+        pending.append((slot, key))
+
+    with self.lock:
+      self.generation += 1
+      self.outstanding = len(pending)
+    generation = self.generation
+    self.curview = newview
+    self.out.put(self.uploader(uploads, newview))
+    metrics.record('texture.build', time.time() - build_start)
+    metrics.incr('texture.pending', len(pending))
+    if not pending:
+      metrics.record('texture.complete', time.time() - build_start)
+
+    # one query for everything the workers will need from the db
+    index_tiles(view, zoom, [key[2:] for slot, key in pending])
+
+    # queued after the stand-ins above, so they can't overwrite the real tiles
+    for i, (slot, key) in enumerate(pending):
+      self.pool.submit(generation, i, key,
+                       lambda slot=slot, key=key: self.atlas.holds(slot, key),
+                       lambda img, slot=slot, key=key: self.deliver(generation, slot, key, img, build_start))
+
+  def deliver(self, generation, slot, key, img, requested):
+    """queue the upload of a tile loaded by the pool (from a worker thread)"""
+    now = time.time()
+    metrics.record('texture.tile_latency', now - requested)
+    self.out.put(self.uploader([(slot, key, tile_pixels(img))]))
+
+    with self.lock:
+      if generation != self.generation:
+        return
+      self.outstanding -= 1
+      complete = (self.outstanding == 0)
+    if complete:
+      # every tile of the view is loaded
+      metrics.record('texture.complete', now - requested)
+
+  def uploader(self, uploads, view=None):
+    """return a callback for the gl thread to upload [(slot, tile key, pixels), ...]
+    (skipping slots reassigned since), then mark 'view' as drawn. this one only
+    does the bookkeeping; override to upload"""
+    def update_texture():
+      for slot, key, pixels in uploads:
+        if self.atlas.holds(slot, key):
+          metrics.incr('texture.uploads')
+      self.mark_drawn(view)
+    return update_texture
+
+  def mark_drawn(self, view):
+    if view:
+      with self.lock:
+        self.drawn = view
+
+  def drawn_tile(self):
+    """center tile of the view currently uploaded; None if none yet"""
+    with self.lock:
+      return self.drawn[2] if self.drawn else None
+
+  def texcoords(self):
+    """texture coordinates of the top-left corner of the drawn view"""
+    tile = self.drawn_tile()
+    if not tile:
+      return (0., 1.)
+    return self.atlas.texcoords(tile[0] - self.width / 2, tile[1] - self.height / 2)
+
 def get_img_chunk (mode, zoom, x, y, alpha=False):
   if x < 0 or y < 0 or x >= 2**zoom or y >= 2**zoom:
-    return open(u.pixmap_path('space.jpg'))
+    return static_image('space.jpg')
 
 
   tile = get_zoom_tile(mode, zoom, x, y, alpha)
   if tile == None:
     tile = get_fallback_tile(mode, zoom, x, y)
   if tile == None:
-    missing = u.pixmap_path('missing.jpg')
-    tile = open(missing)
+    tile = static_image('missing.jpg')
   return tile
 
+def peek_img_chunk (mode, zoom, x, y, alpha=False):
+  """like get_img_chunk, but only from what's already cached, never the db. return
+  (image or None, whether it's the final image); a tile that isn't cached is
+  approximated from a cached ancestor, if there is one"""
+  if x < 0 or y < 0 or x >= 2**zoom or y >= 2**zoom:
+    return (static_image('space.jpg'), True)
+
+  found, tile = cache.peek((mode, zoom, x, y, "RGBA" if alpha else "RGB"))
+  if tile is not None:
+    return (tile, True)
+  if found:
+    found, tile = cache.peek((mode, zoom, x, y, 'fallback'))
+    if found:
+      return (tile or static_image('missing.jpg'), True)
+
+  for zdiff in range(1, zoom + 1):
+    zx = x >> zdiff
+    zy = y >> zdiff
+    for variant in ("RGB", 'fallback'):
+      found, tile = cache.peek((mode, zoom - zdiff, zx, zy, variant))
+      if tile is not None:
+        return (zoom_crop(tile, zdiff, x - (zx << zdiff), y - (zy << zdiff), BILINEAR), False)
+  return (None, False)
+
+def zoom_crop (tile, zdiff, diffx, diffy, resample=BICUBIC):
+  """the part of an ancestor tile 'zdiff' levels up covering the descendant at offset
+  (diffx, diffy) within it, scaled up to a full tile"""
+  cropbounds = [int(256. * b / 2.**zdiff) for b in [diffx, diffy, diffx + 1, diffy + 1]]
+  return tile.crop(cropbounds).resize((256, 256), resample)
+
 def get_zoom_tile (mode, zoom, x, y, alpha=False):
-  file = tile_file(mode, zoom, x, y)
+  return cache.get((mode, zoom, x, y, "RGBA" if alpha else "RGB"), lambda: load_zoom_tile(mode, zoom, x, y, alpha))
+
+def load_zoom_tile (mode, zoom, x, y, alpha=False):
+  with metrics.timer('tile.read'):
+    file = tile_file(mode, zoom, x, y)
   if file != None:
-    with file as _f:
+    with file as _f, metrics.timer('tile.decode'):
       img = open(_f)
       return img.convert("RGBA" if alpha else "RGB")
   else:
     return None
 
 def get_fallback_tile (mode, zoom, x, y):
+  def make():
+    with metrics.timer('tile.fallback'):
+      return make_fallback_tile(mode, zoom, x, y)
+  # stands in for a missing tile, so expires like one
+  return cache.get((mode, zoom, x, y, 'fallback'), make, settings.TEXTURE_CACHE_MISS_TTL)
+
+def make_fallback_tile (mode, zoom, x, y):
   for zdiff in range(1, fallback + 1):
     z = zoom - zdiff
     if z < 0:
@@ -65,24 +450,60 @@ def get_fallback_tile (mode, zoom, x, y):
 
     diffx = x - zx * 2**zdiff
     diffy = y - zy * 2**zdiff
-    cropbounds = [int(256. * b / 2.**zdiff) for b in [diffx, diffy, diffx + 1, diffy + 1]]
 
-    tile = tile.crop(cropbounds)
-    tile = tile.resize((256, 256), BICUBIC)
+    tile = zoom_crop(tile, zdiff, diffx, diffy)
     tile = ImageEnhance.Brightness(tile).enhance(.9**zdiff)
     return tile
 
   return None
 
 
-conn = None
+def index_tiles (mode, zoom, tiles):
+  """look up the db entries of many tiles [(x, y), ...] at once, along with their
+  ancestors used for fallback, so loading them (and synthesizing fallbacks for the
+  missing ones) doesn't need a query per tile"""
+  tiles = [(zoom, x % 2**zoom, y) for x, y in tiles if y >= 0 and y < 2**zoom]
+  tiles = [t for t in tiles if not cache.contains((mode,) + t + ('uuid',))]
+  if not tiles:
+    return
+
+  conn = maptile.scoped_dbsess()
+  try:
+    with metrics.timer('tile.index'):
+      found = dict((key, t.uuid) for key, t in maptile.find_tiles(conn, mode, tiles, fallback).iteritems())
+  finally:
+    conn.rollback()
+  for z, x, y in tiles:
+    for zdiff in range(min(fallback, z) + 1):
+      key = (z - zdiff, x >> zdiff, y >> zdiff)
+      cache.put((mode,) + key + ('uuid',), found.get(key))
+
+# tiles are loaded from several threads (texture, decode pool, prefetch); each gets
+# its own session on the shared connection pool. these threads live as long as the
+# map is up, so each lookup ends its transaction rather than leaving the connection
+# idle in one (holding locks on the tiles table)
 def tile_file (mode, zoom, x, y):
-  global conn
-  if conn == None:
-    conn = maptile.dbsess()
+  conn = maptile.scoped_dbsess()
+  try:
+    return _tile_file(conn, mode, zoom, x, y)
+  finally:
+    conn.rollback()
+
+def _tile_file (conn, mode, zoom, x, y):
+  key = (mode, zoom, x, y, 'uuid')
+
+  def lookup():
+    return conn.query(maptile.Tile.uuid).filter_by(layer=mode, z=zoom, x=x, y=y).scalar()
+  def open_uuid(uuid):
+    return maptile.Tile(layer=mode, z=zoom, x=x, y=y, uuid=uuid).open(conn) if uuid else None
 
-  t = conn.query(maptile.Tile).get((mode, zoom, x, y))
-  return t.open(conn) if t else None
+  uuid = cache.get(key, lookup)
+  f = open_uuid(uuid)
+  if f is None and uuid:
+    # the tile was replaced (and its old data deleted) since its uuid was cached
+    cache.discard(key)
+    f = open_uuid(cache.get(key, lookup))
+  return f
 
 def get_tile(sess, z, x, y, layer):
     t = sess.query(maptile.Tile).get((layer, z, x, y))
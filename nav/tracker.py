@@ -24,6 +24,7 @@ class Tracker(threading.Thread):
     def __init__(self, fixstream, vector_mode='raz'):
         threading.Thread.__init__(self)
         self.daemon = True
+        self.up = True
         self.lock = threading.Lock()
 
         self.fixstream = fixstream
@@ -32,10 +33,18 @@ class Tracker(threading.Thread):
         self.fixbuffer = []
         self.interpolants = None
 
+    def terminate(self):
+        """stop once the fix stream next yields (a fix, or None if it has none yet)"""
+        self.up = False
+
     def run(self):
         for fix in self.fixstream:
-            if self.filter_fix(fix):
+            if not self.up:
+                break
+            if fix and self.filter_fix(fix):
                 self.update(fix)
+        if hasattr(self.fixstream, 'close'):
+            self.fixstream.close()
 
     def filter_fix(self, fix):
         """determine if fix is of sufficient quality to use"""
@@ -219,8 +228,12 @@ def live_stream(gps_sub):
             yield fix
 
 def timeline_stream(stream):
-    """stream wrapper that emits fixes at the designated timestamp"""
+    """stream wrapper that emits fixes at the designated timestamp (None, meaning no
+    fix available yet, is passed through)"""
     for fix in stream:
+        if fix is None:
+            yield None
+            continue
         u.wait_until(u.to_timestamp(fix['time']))
         fix['systime'] = datetime.utcnow()
         yield fix
@@ -264,6 +277,7 @@ class TrackLogProvider(threading.Thread):
 
         threading.Thread.__init__(self)
         self.daemon = True
+        self.up = True
 
         self.timeskew = timeskew
         self.buffer_window = timedelta(seconds=buffer_window)
@@ -272,8 +286,11 @@ class TrackLogProvider(threading.Thread):
 
         self.max_fetched = None
 
+    def terminate(self):
+        self.up = False
+
     def run(self):
-        while True:
+        while self.up:
             # check if the latest buffered trackpoint covers us through 'buffer window' in real time
             if self.max_fetched is None or self.max_fetched < self.timeskew(datetime.utcnow() + self.buffer_window):
                 present = datetime.utcnow() - self.PRESENT_THRESHOLD
@@ -312,7 +329,8 @@ def tracklog_stream(dbconn, start, speedup=1., buffer_window=30.):
 
     q = Queue.Queue()
     dbsess = sessionmaker(bind=create_engine(settings.GPS_LOG_DB))()
-    TrackLogProvider(real_to_hist_time, buffer_window, dbsess, q).start()
+    provider = TrackLogProvider(real_to_hist_time, buffer_window, dbsess, q)
+    provider.start()
 
     def fix_fix(fix):
         fix['orig_time'] = fix['time']
@@ -323,8 +341,17 @@ def tracklog_stream(dbconn, start, speedup=1., buffer_window=30.):
         return fix
 
     def fixstream():
-        while True:
-            yield fix_fix(q.get())
+        try:
+            while True:
+                try:
+                    fix = q.get(True, 0.5)
+                except Queue.Empty:
+                    # let the consumer check in (e.g., to shut down) while there are no fixes
+                    yield None
+                    continue
+                yield fix_fix(fix)
+        finally:
+            provider.terminate()
     return timeline_stream(fixstream())
 
 
@@ -335,5 +362,6 @@ if __name__ == "__main__":
     fixstream = tracklog_stream('postgresql://geoloc', datetime.utcnow() - timedelta(seconds=31.), 1.)
 
     for f in fixstream:
-        print f
+        if f:
+            print f
 
@@ -7,10 +7,18 @@ import logging.handlers
 # database connector for tile info
 TILE_DB = 'postgresql:///tiles'
 
+# max connections held open to the tile database (shared by all threads in a process;
+# ignored for sqlite)
+TILE_DB_POOL_SIZE = 10
+
 # if true, store tile images in database as BLOBs
 # if false, store as files in TILE_ROOT
 TILE_STORE_BLOB = True
 
+# if true, store tile images in append-only pack files in TILE_PACK_ROOT
+# (takes precedence over TILE_STORE_BLOB). fastest for reading
+TILE_STORE_PACK = False
+
 # root directory where tiles are stored
 TILE_ROOT = '~/.birdseye/tiles'
 # how to clump tiles into directory buckets (shouldn't have too many
@@ -18,6 +26,11 @@ TILE_ROOT = '~/.birdseye/tiles'
 # [2, 4]: 53392f0a.jpg => 53/5339/53392f0a.jpg
 TILE_BUCKETS = [3]
 
+# directory where tile pack files are stored
+TILE_PACK_ROOT = '~/.birdseye/tilepack'
+# start a new pack file once the current one reaches this size
+TILE_PACK_MAX_SIZE = 2**31 # bytes
+
 # database connector for tracklog
 GPS_LOG_DB = 'postgresql:///geoloc'
 
@@ -85,8 +98,25 @@ LAYERS = {
 }
 
 TILE_DL_UA = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; en-US) Gecko/20100101 Firefox/12.0'
+# if true, download tiles from an event loop with many requests in flight; if
+# false, use a small pool of blocking worker threads. needs pycurl (for keep-alive
+# connections); without it the threaded engine is used
+TILE_DL_ASYNC = True
+# maximum concurrent tile requests overall (async only)
+TILE_DL_CONCURRENCY = 200
+TILE_DL_TIMEOUT = 30 # seconds
+# requests to each host (shard hosts of a layer count as one host) are limited
+# adaptively: concurrency and request rate ramp up while the host responds
+# promptly, and are cut back (with a pause) on 429/503 responses or timeouts
+TILE_DL_HOST_CONCURRENCY = 16 # max concurrent requests
+TILE_DL_HOST_RATE = 20 # initial requests/sec
+TILE_DL_HOST_MAX_RATE = 200 # requests/sec
 LOC_SEARCH_UA = 'GoogleEarth/5.2.1.1329(X11;Linux (2.6.35.0);en-US;kml:2.2;client:Free;type:default)'
 
+# number of processes used to enumerate the tiles in a download region (None for
+# one per cpu)
+ENUMERATE_PROCESSES = None
+
 ### MAP RENDERING AND NAVIGATION
 
 # measurement units
@@ -98,12 +128,41 @@ WAYPOINTS = '~/.birdseye/waypoints'
 # if no tile exists for current zoom level, use a tile from this many levels up
 LOOKBACK = 2
 
+# memory for caching decoded map tiles (MB), so panning only decodes the tiles
+# newly in view
+TEXTURE_CACHE_MEMORY = 64
+# how long (seconds) a missing tile is remembered as missing (and the stand-in
+# drawn from its ancestor kept) before checking the db again, so tiles downloaded
+# while the map is up show once they're scrolled back into view
+TEXTURE_CACHE_MISS_TTL = 15
+# threads loading and decoding map tiles for display
+TEXTURE_DECODE_WORKERS = 3
+
+# preload the map tiles that will come into view within this many seconds at the
+# current speed and heading
+PREFETCH_LOOKAHEAD = 30
+
 
 
 # TODO: figure these out dynamically
 SCREEN_DIM = (1024, 600)
 FULLSCREEN = True
 
+# display frame rate cap (frames/sec). frames where nothing visible has changed are
+# skipped
+RENDER_FPS = 30
+# low-power mode (toggle with 'p'): animations off, the clock ticks by the second,
+# and at most this frame rate
+RENDER_LOW_POWER = False
+RENDER_LOW_POWER_FPS = 5
+# position change that counts as a visible change (screen pixels)
+RENDER_MIN_MOVE = .25
+
+# show timing/counter metrics on the map display (toggle with 'd')
+DEBUG_OVERLAY = False
+# log a json snapshot of the metrics every this many seconds; None to disable
+METRICS_LOG_INTERVAL = None
+
 
 
 # logging config
@@ -0,0 +1,95 @@
+import unittest
+import logging
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.exc import OperationalError
+
+from mapcache import maptile as mt
+from mapcache.mapdownload import JobJournal
+
+class JobJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        mt.Base.metadata.create_all(engine, tables=[mt.DownloadJob.__table__, mt.JobProgress.__table__])
+        self.sessmaker = sessionmaker(bind=engine)
+
+        sess = self.sessmaker()
+        job = mt.DownloadJob('', [])
+        sess.add(job)
+        sess.commit()
+        self.job_id = job.id
+
+    def journal(self):
+        return JobJournal(self.sessmaker(), self.job_id)
+
+    def test_cursor_follows_completed_chunks(self):
+        j = self.journal()
+        self.assertEqual(j.cursor('a', 5), (0, 0))
+        j.add_chunk('a', 5, 9, 100, [])
+        self.assertEqual(j.cursor('a', 5), (10, 100))
+
+        j.add_chunk('a', 5, 19, 80, ['t1', 't2'])
+        j.add_chunk('a', 5, 29, 50, ['t3'])
+        j.tile_done('t3', True)
+        # the later chunk is done, but the one before it isn't
+        self.assertEqual(j.cursor('a', 5), (10, 100))
+        j.tile_done('t1', True)
+        j.tile_done('t2', True)
+        self.assertEqual(j.cursor('a', 5), (30, 230))
+        self.assertEqual(j.cursor('a', 6), (0, 0))
+
+    def test_resume_after_failed_chunk(self):
+        j = self.journal()
+        j.add_chunk('a', 5, 9, 100, [])
+        j.add_chunk('a', 5, 19, 80, ['t1', 't2'])
+        j.add_chunk('a', 5, 29, 50, [])
+        j.tile_done('t1', False)
+        j.tile_done('t2', True)
+        j.flush()
+        self.assertFalse(j.complete())
+
+        # a new run of the job resumes at the failed chunk
+        resumed = self.journal()
+        self.assertEqual(resumed.cursor('a', 5), (10, 100))
+        resumed.add_chunk('a', 5, 19, 80, [])
+        resumed.add_chunk('a', 5, 29, 50, [])
+        resumed.flush()
+        self.assertTrue(resumed.complete())
+        self.assertEqual(self.journal().cursor('a', 5), (30, 230))
+        self.assertTrue(self.sessmaker().query(mt.DownloadJob).get(self.job_id).completed_on is not None)
+
+    def test_progress_kept_when_commit_fails(self):
+        j = self.journal()
+        commit = j.sess.commit
+        fail = [True]
+        def flaky_commit():
+            if fail[0]:
+                j.sess.flush()
+                raise OperationalError('COMMIT', {}, Exception('database is locked'))
+            commit()
+        j.sess.commit = flaky_commit
+
+        logging.disable(logging.ERROR)
+        try:
+            j.add_chunk('a', 5, 9, 100, []) # new progress row
+            j.flush()
+            j.add_chunk('a', 5, 19, 80, [])
+            fail[0] = False
+            j.flush()
+            self.assertEqual(self.journal().cursor('a', 5), (20, 180))
+
+            fail[0] = True
+            j.add_chunk('a', 5, 29, 50, []) # existing progress row
+            j.flush()
+            fail[0] = False
+            j.add_chunk('a', 5, 39, 10, [])
+            j.flush()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.journal().cursor('a', 5), (40, 240))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import random
+import unittest
+
+import util.util as u
+
+# the original string implementations, as reference
+
+def old_to_quadindex(z, x, y, alphabet=None):
+    def binary(h, k):
+        return [(h / 2**i) % 2 for i in range(k - 1, -1, -1)]
+
+    def to_char(q):
+        return alphabet[q] if alphabet is not None else str(q)
+
+    quad = [2 * j + i for i, j in zip(*(binary(h, z) for h in (x, y)))]
+    return ''.join(to_char(q) for q in quad)
+
+def old_from_quadindex(ix, alphabet=None):
+    def from_char(c):
+        return alphabet.index(c) if alphabet is not None else int(c)
+
+    def unquad(ix):
+        for c in ix:
+            q = from_char(c)
+            yield (q % 2, q / 2)
+
+    def from_binary(v):
+        return reduce(lambda a, b: 2 * a + b, v, 0)
+
+    ixsp = zip(*(unquad(ix))) if ix else [[], []]
+    return (len(ix), from_binary(ixsp[0]), from_binary(ixsp[1]))
+
+def random_tiles(n, max_zoom=u.QTKEY_MAX_ZOOM, seed=1):
+    rand = random.Random(seed)
+    for i in range(n):
+        z = rand.randint(0, max_zoom)
+        yield (z, rand.randint(0, 2**z - 1), rand.randint(0, 2**z - 1))
+
+class QuadIndexTest(unittest.TestCase):
+
+    def test_matches_string_implementation(self):
+        for z, x, y in random_tiles(2000):
+            ix = old_to_quadindex(z, x, y)
+            self.assertEqual(u.to_quadindex(z, x, y), ix)
+            self.assertEqual(u.from_quadindex(ix), old_from_quadindex(ix))
+            self.assertEqual(u.from_quadindex(ix), (z, x, y))
+
+    def test_alphabet(self):
+        alphabet = 'tqrs'
+        for z, x, y in random_tiles(500, 20):
+            ix = old_to_quadindex(z, x, y, alphabet)
+            self.assertEqual(u.to_quadindex(z, x, y, alphabet), ix)
+            self.assertEqual(u.from_quadindex(ix, alphabet), (z, x, y))
+
+    def test_extremes(self):
+        for z in range(u.QTKEY_MAX_ZOOM + 1):
+            for x, y in [(0, 0), (2**z - 1, 0), (0, 2**z - 1), (2**z - 1, 2**z - 1)]:
+                self.assertEqual(u.to_quadindex(z, x, y), old_to_quadindex(z, x, y))
+
+class QtkeyTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for z, x, y in random_tiles(2000):
+            key = u.to_qtkey(z, x, y)
+            self.assertTrue(0 < key < 2**63)
+            self.assertEqual(u.from_qtkey(key), (z, x, y))
+
+    def test_too_deep(self):
+        self.assertRaises(ValueError, u.to_qtkey, u.QTKEY_MAX_ZOOM + 1, 0, 0)
+
+    def test_orders_like_quadindex(self):
+        # within a zoom level, keys sort like the quadtree index strings did
+        for z in (1, 7, 16):
+            rand = random.Random(z)
+            tiles = [(z, rand.randint(0, 2**z - 1), rand.randint(0, 2**z - 1)) for i in range(500)]
+            self.assertEqual(sorted(tiles, key=lambda t: u.to_qtkey(*t)),
+                             sorted(tiles, key=lambda t: old_to_quadindex(*t)))
+
+    def test_range_spans_descendants(self):
+        rand = random.Random(3)
+        for z, x, y in random_tiles(300, 20):
+            lo, hi = u.qtkey_range(u.to_qtkey(z, x, y))
+            for dz in (0, 1, 3):
+                dx, dy = rand.randint(0, 2**dz - 1), rand.randint(0, 2**dz - 1)
+                child = (z + dz, (x << dz) + dx, (y << dz) + dy)
+                if child[0] <= u.QTKEY_MAX_ZOOM:
+                    self.assertTrue(lo <= u.to_qtkey(*child) <= hi)
+            # a neighbor, and the parent, fall outside it
+            if x + 1 < 2**z:
+                self.assertFalse(lo <= u.to_qtkey(z, x + 1, y) <= hi)
+            if z > 0:
+                self.assertFalse(lo <= u.to_qtkey(z - 1, x >> 1, y >> 1) <= hi)
+
+    def test_ancestor(self):
+        for z, x, y in random_tiles(1000):
+            key = u.to_qtkey(z, x, y)
+            ix = old_to_quadindex(z, x, y)
+            for k in range(z + 1):
+                self.assertEqual(u.from_qtkey(u.qtkey_ancestor(key, k)), old_from_quadindex(ix[:z - k]))
+
+if __name__ == '__main__':
+    unittest.main()
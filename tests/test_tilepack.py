@@ -0,0 +1,131 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from mapcache import tilepack
+from mapcache.tilepack import TilePack, place
+
+def random_uuid(rand):
+    return '%016x' % rand.getrandbits(64)
+
+class PlaceTest(unittest.TestCase):
+
+    def insert_one_at_a_time(self, homes, capacity):
+        slots = [None] * capacity
+        placed = []
+        for h in homes:
+            i = h
+            while slots[i] is not None:
+                i = (i + 1) % capacity
+            slots[i] = True
+            placed.append(i)
+        return placed
+
+    def test_matches_sequential_probing(self):
+        rand = random.Random(1)
+        capacity = 32
+        for trial in range(200):
+            n = rand.randint(0, int(tilepack.MAX_LOAD * capacity))
+            # crowd some keys near the end of the table, to exercise wrapping around
+            lo = capacity - 4 if trial % 2 else 0
+            homes = [rand.randint(lo, capacity - 1) for i in range(n)]
+            entries = tilepack.np.zeros(n, dtype=tilepack.INDEX_DTYPE)
+            for i, h in enumerate(homes):
+                entries[i]['key'] = chr(h) + chr(rand.randint(1, 255)) * 7
+
+            slots = place(entries, capacity).tolist()
+            self.assertEqual(len(set(slots)), n)
+            # any order of insertion is valid as long as each entry is reachable from its
+            # home slot without crossing an empty slot; in order of home slot (stable),
+            # sequential insertion gives the same slots
+            order = sorted(range(n), key=lambda i: homes[i])
+            expected = self.insert_one_at_a_time([homes[i] for i in order], capacity)
+            self.assertEqual([slots[i] for i in order], expected)
+
+class TilePackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.initial_capacity = tilepack.INITIAL_CAPACITY
+        tilepack.INITIAL_CAPACITY = 16 # resize early and often
+
+    def tearDown(self):
+        tilepack.INITIAL_CAPACITY = self.initial_capacity
+        shutil.rmtree(self.root)
+
+    def check(self, pack, model):
+        for uuid, data in model.iteritems():
+            self.assertEqual(str(pack.get(uuid)), data)
+        self.assertEqual(len(pack), len(model))
+        self.assertEqual(sorted(pack.uuids()), sorted(model))
+
+    def test_round_trip_across_resizes(self):
+        rand = random.Random(2)
+        pack = TilePack(self.root)
+        model = {}
+        removed = set()
+        for i in range(2000):
+            if model and rand.random() < .2:
+                uuid = rand.choice(model.keys())
+                pack.remove(uuid)
+                del model[uuid]
+                removed.add(uuid)
+            else:
+                uuid = random_uuid(rand)
+                model[uuid] = os.urandom(rand.randint(1, 100))
+                pack.put(uuid, model[uuid])
+
+        self.assertTrue(pack.capacity > 16)
+        self.check(pack, model)
+        for uuid in removed - set(model):
+            self.assertEqual(pack.get(uuid), None)
+            self.assertFalse(uuid in pack)
+
+    def test_keys_with_nul_bytes(self):
+        pack = TilePack(self.root)
+        model = {'00' * 8: 'a', 'ab' + '00' * 7: 'b', '00' * 7 + 'ab': 'c'}
+        for uuid, data in model.iteritems():
+            pack.put(uuid, data)
+        self.check(pack, model)
+
+    def test_put_existing_is_noop(self):
+        pack = TilePack(self.root)
+        pack.put('01' * 8, 'first')
+        pack.put('01' * 8, 'second')
+        self.assertEqual(str(pack.get('01' * 8)), 'first')
+        self.assertEqual(len(pack), 1)
+
+    def test_buffers_survive_pack_growth(self):
+        pack = TilePack(self.root)
+        pack.put('01' * 8, 'x' * 1000)
+        buf = pack.get('01' * 8)
+        for i in range(100):
+            pack.put('%016x' % (i + 2), os.urandom(5000))
+        pack.get('%016x' % 2) # remaps the grown pack file
+        self.assertEqual(str(buf), 'x' * 1000)
+
+    def test_new_pack_file_when_full(self):
+        pack = TilePack(self.root, max_pack_size=1000)
+        model = dict(('%016x' % (i + 1), chr(65 + i) * 400) for i in range(6))
+        for uuid, data in sorted(model.iteritems()):
+            pack.put(uuid, data)
+        self.assertTrue(os.path.exists(pack.pack_path(3)))
+        self.check(pack, model)
+
+    def test_sees_resize_by_other_instance(self):
+        reader = TilePack(self.root)
+        writer = TilePack(self.root)
+        writer.put('01' * 8, 'a')
+        self.assertEqual(str(reader.get('01' * 8)), 'a')
+
+        model = dict(('%016x' % (i + 2), 'z') for i in range(100))
+        for uuid, data in model.iteritems():
+            writer.put(uuid, data)
+        reader.index_checked = 0. # as if INDEX_CHECK_INTERVAL has passed
+        model['01' * 8] = 'a'
+        self.check(reader, model)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import random
+import unittest
+
+import numpy as np
+import util.util as u
+from mapcache import tileset
+from mapcache.tileset import TileSet
+
+def random_tiles(n, layers=('a', 'b'), max_zoom=22, seed=1):
+    rand = random.Random(seed)
+    for i in range(n):
+        z = rand.randint(0, max_zoom)
+        yield (rand.choice(layers), z, rand.randint(0, 2**z - 1), rand.randint(0, 2**z - 1))
+
+class TileSetTest(unittest.TestCase):
+
+    def make(self, tiles, buffer_size=100):
+        ts = TileSet()
+        ts.BUFFER_SIZE = buffer_size # flush partway through
+        ts.update(tiles)
+        return ts
+
+    def test_matches_set(self):
+        model = set(random_tiles(3000))
+        ts = self.make(list(model) * 2)
+        self.assertEqual(len(ts), len(model))
+        self.assertEqual(set(ts), model)
+        self.assertEqual(ts.layers(), ['a', 'b'])
+        self.assertEqual(ts.zooms(), sorted(set(t[1] for t in model)))
+        for t in model:
+            self.assertTrue(t in ts)
+        self.assertFalse(('a', 23, 1, 1) in ts)
+        self.assertFalse(('c', 3, 1, 1) in ts)
+
+    def test_full_width_coordinates(self):
+        # x and y each take up to 32 bits of the packed key
+        tiles = [('a', 31, 2**31 - 1, 0), ('a', 31, 0, 2**31 - 1), ('a', 32, 2**32 - 1, 2**32 - 1)]
+        ts = self.make(tiles)
+        self.assertEqual(set(ts), set(tiles))
+
+    def test_tiles_in_order(self):
+        model = set(random_tiles(1000, ('a',)))
+        ts = self.make(model)
+        self.assertEqual(list(ts.tiles('a')), sorted(t[1:] for t in model))
+        chunks = list(ts.chunks('a', 7))
+        self.assertTrue(all(0 < len(c) <= 7 and len(set(t[0] for t in c)) == 1 for c in chunks))
+        self.assertEqual(sum(chunks, []), sorted(t[1:] for t in model))
+
+    def test_subtract(self):
+        model = set(random_tiles(2000))
+        removed = set(random.Random(2).sample(sorted(model), 500)) | set(random_tiles(100, seed=3))
+        ts = self.make(model)
+        ts -= self.make(removed)
+        self.assertEqual(set(ts), model - removed)
+        ts -= list(model)[:10]
+        self.assertEqual(set(ts), model - removed - set(list(model)[:10]))
+
+    def test_zoom_counts_and_pop(self):
+        model = set(random_tiles(2000, max_zoom=8))
+        ts = self.make(model)
+        counts = ts.zoom_counts()
+        for z in range(9):
+            self.assertEqual(counts[z], len([t for t in model if t[1] == z]))
+
+        popped = ts.pop_zoom(5)
+        self.assertEqual(set(popped), set(t for t in model if t[1] == 5))
+        self.assertEqual(set(ts), set(t for t in model if t[1] != 5))
+
+    def test_add_array(self):
+        ts = self.make([('a', 10, 1, 2)])
+        ts.add_array('a', 10, tileset.pack([5, 1], [6, 2]))
+        self.assertEqual(list(ts.tiles('a')), [(10, 1, 2), (10, 5, 6)])
+
+class ArrayFunctionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tiles = list(random_tiles(2000, ('a',)))
+        self.z, self.x, self.y = [np.array(v) for v in zip(*[t[1:] for t in self.tiles])]
+
+    def test_pack(self):
+        xs, ys = tileset.unpack(tileset.pack(self.x, self.y))
+        self.assertEqual((xs.tolist(), ys.tolist()), (self.x.tolist(), self.y.tolist()))
+
+    def test_quadindices(self):
+        ixs = tileset.quadindices(self.z, self.x, self.y)
+        self.assertEqual(ixs, [u.to_quadindex(*t[1:]) for t in self.tiles])
+        self.assertEqual([v.tolist() for v in tileset.from_quadindices(ixs)],
+                         [self.z.tolist(), self.x.tolist(), self.y.tolist()])
+
+    def test_qtkeys(self):
+        keys = tileset.to_qtkeys(self.z, self.x, self.y)
+        self.assertEqual(keys.tolist(), [u.to_qtkey(*t[1:]) for t in self.tiles])
+        self.assertEqual([v.tolist() for v in tileset.from_qtkeys(keys)],
+                         [self.z.tolist(), self.x.tolist(), self.y.tolist()])
+
+if __name__ == '__main__':
+    unittest.main()
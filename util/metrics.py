@@ -0,0 +1,119 @@
+"""lightweight process-wide instrumentation: named timers (distribution of recent
+durations), counters, and gauges (values computed on demand). cheap enough to
+leave in hot paths; recording is thread-safe
+
+  with metrics.timer('tile.decode'):
+      ...
+  metrics.incr('tile.uploads')
+  metrics.gauge('cache.hit_rate', lambda: ...)
+  metrics.snapshot()
+"""
+
+import time
+import json
+import threading
+import collections
+import logging
+from contextlib import contextmanager
+
+TIMER_SAMPLES = 1000 # most recent durations kept per timer
+
+timers = {} # name => deque of durations (seconds)
+counters = collections.defaultdict(lambda: 0)
+gauges = {} # name => function returning the current value
+lock = threading.Lock()
+
+def record(name, seconds):
+    """add a duration to a timer"""
+    samples = timers.get(name)
+    if samples is None:
+        with lock:
+            samples = timers.setdefault(name, collections.deque(maxlen=TIMER_SAMPLES))
+    samples.append(seconds)
+
+@contextmanager
+def timer(name):
+    """time the enclosed block"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+def incr(name, n=1):
+    with lock:
+        counters[name] += n
+
+def gauge(name, func):
+    """register a value to be computed at snapshot time (None if not available)"""
+    gauges[name] = func
+
+def reset():
+    """clear all timers and counters"""
+    with lock:
+        timers.clear()
+        counters.clear()
+
+def percentile(sorted_samples, p):
+    return sorted_samples[min(int(p / 100. * len(sorted_samples)), len(sorted_samples) - 1)]
+
+def timer_stats(name):
+    """{'n', 'mean', 'p50', 'p90', 'p99', 'max'} over the recent samples, in ms; None
+    if nothing recorded"""
+    samples = sorted(timers.get(name, []))
+    if not samples:
+        return None
+    stats = dict(('p%d' % p, 1000. * percentile(samples, p)) for p in (50, 90, 99))
+    stats.update({'n': len(samples), 'mean': 1000. * sum(samples) / len(samples), 'max': 1000. * samples[-1]})
+    return stats
+
+def snapshot():
+    """current state of all metrics: {'timers': {name: timer_stats}, 'counters':
+    {name: count}, 'gauges': {name: value}}"""
+    def evaluate(func):
+        try:
+            return func()
+        except Exception:
+            return None
+
+    with lock:
+        names = timers.keys()
+        counts = dict(counters)
+    return {
+        'timers': dict((name, timer_stats(name)) for name in names),
+        'counters': counts,
+        'gauges': dict((name, evaluate(func)) for name, func in gauges.items()),
+    }
+
+def summary():
+    """snapshot() as short lines of text, for display"""
+    snap = snapshot()
+    lines = []
+    for name, st in sorted(snap['timers'].iteritems()):
+        if st:
+            lines.append('%s %.1f %.1f %.1f ms' % (name, st['p50'], st['p90'], st['p99']))
+    for name, val in sorted(snap['counters'].iteritems()):
+        lines.append('%s %d' % (name, val))
+    for name, val in sorted(snap['gauges'].iteritems()):
+        lines.append('%s %s' % (name, ('%.2f' % val if isinstance(val, float) else val) if val is not None else '-'))
+    return lines
+
+class Dumper(threading.Thread):
+    """log a json snapshot of all metrics every 'interval' seconds"""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.up = True
+        self.interval = interval
+
+    def terminate(self):
+        self.up = False
+
+    def run(self):
+        while self.up:
+            time.sleep(self.interval)
+            try:
+                logging.info('metrics: %s' % json.dumps(snapshot(), sort_keys=True))
+            except:
+                logging.exception('error dumping metrics')
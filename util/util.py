@@ -8,8 +8,10 @@ import settings
 import logging
 import os.path
 import shutil
+import string
 import tempfile
 from contextlib import contextmanager
+import metrics
 
 EPSILON = 1.0e-9
 
@@ -175,32 +177,106 @@ class AggregationIndex(object):
             except KeyError:
                 return None
 
-def to_quadindex(z, x, y, alphabet=None):
-    def binary(h, k):
-        return [(h / 2**i) % 2 for i in range(k - 1, -1, -1)]
-
-    def to_char(q):
-        return alphabet[q] if alphabet is not None else str(q)
+def _spread_bits(v):
+    """spread the low 32 bits of v out to the even bits of a 64-bit value"""
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+def _compact_bits(v):
+    """inverse of _spread_bits: gather the even bits of v"""
+    v &= 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    return (v | (v >> 16)) & 0x00000000FFFFFFFF
+
+def interleave(x, y):
+    """morton code of a tile: bits of x and y interleaved, x in the even bits; in
+    base 4, the digits of the tile's quadtree index"""
+    return _spread_bits(x) | (_spread_bits(y) << 1)
+
+def deinterleave(m):
+    """inverse of interleave; return (x, y)"""
+    return (_compact_bits(m), _compact_bits(m >> 1))
+
+def quadindex_formatter(alphabet=None):
+    """return a function (z, x, y) => quadtree index, equivalent to to_quadindex with
+    the given alphabet. digits are looked up 4 at a time, from a table indexed by a
+    4-bit slice of both x and y"""
+    digits = alphabet or '0123'
+    def entry(b):
+        m = interleave(b & 0xf, b >> 4)
+        return ''.join(digits[(m >> k) & 3] for k in (6, 4, 2, 0))
+    table = [entry(b) for b in range(256)]
+
+    def quadindex(z, x, y):
+        s = 4 * ((z + 3) >> 2)
+        ix = ''
+        while s:
+            s -= 4
+            ix += table[((x >> s) & 0xf) | (((y >> s) & 0xf) << 4)]
+        return ix[len(ix) - z:]
+    return quadindex
+
+_quadindex_formatters = {None: quadindex_formatter()} # alphabet => quadindex_formatter
+_quadindex_tables = {} # alphabet => translation table to '0123'
 
-    quad = [2 * j + i for i, j in zip(*(binary(h, z) for h in (x, y)))]
-    return ''.join(to_char(q) for q in quad)
+def to_quadindex(z, x, y, alphabet=None):
+    if alphabet is None:
+        return _quadindex_formatters[None](z, x, y)
+    key = alphabet if isinstance(alphabet, basestring) else tuple(alphabet)
+    if key not in _quadindex_formatters:
+        _quadindex_formatters[key] = quadindex_formatter(alphabet)
+    return _quadindex_formatters[key](z, x, y)
 
 def from_quadindex(ix, alphabet=None):
-    def from_char(c):
-        return alphabet.index(c) if alphabet is not None else int(c)
-
-    def unquad(ix):
-        for c in ix:
-            q = from_char(c)
-            yield (q % 2, q / 2)
-
-    def from_binary(v):
-        return reduce(lambda a, b: 2 * a + b, v, 0)
-
-    ixsp = zip(*(unquad(ix))) if ix else [[], []]
-    x, y = [from_binary(v) for v in ixsp]
+    if not ix:
+        return (0, 0, 0)
+    if alphabet is not None:
+        alphabet = ''.join(alphabet)
+        if alphabet not in _quadindex_tables:
+            _quadindex_tables[alphabet] = string.maketrans(alphabet, '0123')
+        ix = str(ix).translate(_quadindex_tables[alphabet])
+    x, y = deinterleave(int(ix, 4))
     return (len(ix), x, y)
 
+# deepest zoom level representable by a quadtree key (2 bits per level, plus a
+# terminating bit, must fit in a signed 64-bit integer)
+QTKEY_MAX_ZOOM = 30
+
+def to_qtkey(z, x, y):
+    """pack a tile into a 64-bit integer quadtree key. the quadtree index bits are
+    left-aligned, followed by a single terminating '1' bit that encodes the zoom
+    level. all descendants of a tile fall into a contiguous key range around the
+    tile's own key (see qtkey_range)"""
+    if z > QTKEY_MAX_ZOOM:
+        raise ValueError('zoom level too deep for quadtree key')
+
+    key = interleave(x, y) & ((1 << (2 * z)) - 1)
+    return ((key << 1) | 1) << (2 * (QTKEY_MAX_ZOOM - z))
+
+def from_qtkey(key):
+    """inverse of to_qtkey; return (z, x, y)"""
+    lsb = key & -key
+    z = QTKEY_MAX_ZOOM - (lsb.bit_length() - 1) // 2
+    x, y = deinterleave(key >> (2 * (QTKEY_MAX_ZOOM - z) + 1))
+    return (z, x, y)
+
+def qtkey_range(key):
+    """return the (inclusive) range of keys spanned by this tile and all its
+    descendants"""
+    lsb = key & -key
+    return (key - (lsb - 1), key + (lsb - 1))
+
+def qtkey_ancestor(key, k):
+    """return the key of the tile's ancestor 'k' levels up"""
+    lsb = (key & -key) << (2 * k)
+    return (key & -lsb) | lsb
+
 def format_interval(interval, expand=True, max_unit=None, sep='', labels={}, pad=True, colons=False, show_secs=True):
     fields = ['d', 'h', 'm', 's']
     _labels = dict(zip(fields, fields))
@@ -297,6 +373,9 @@ def waypoints_path():
 def tiles_path():
     return os.path.expanduser(settings.TILE_ROOT)
 
+def tilepack_path():
+    return os.path.expanduser(settings.TILE_PACK_ROOT)
+
 def pixmap_path(pixmap):
     return proj_path('pixmap', pixmap)
 
@@ -421,9 +500,12 @@ def store_waypoint(waypoint, lns):
 
 @contextmanager
 def profile(key='-'):
+    """log the time taken by the enclosed block, and record it to the timer 'key'
+    (see metrics)"""
     start = time.time()
     yield
     end = time.time()
+    metrics.record(key, end - start)
     logging.debug('profiling: %s %.03f' % (key, end - start))
 
 def setup():
@@ -30,21 +30,33 @@ from sqlalchemy import func
 def web_path(*args):
     return u.proj_path('web', *args)
 
-class LayersHandler(web.RequestHandler):
+class DbSessionMixin(object):
+    """a tile database session for the duration of a single request, drawn from the
+    shared connection pool on first use"""
+
+    @property
+    def sess(self):
+        if not hasattr(self, '_sess'):
+            self._sess = mt.dbsess()
+        return self._sess
+
+    def on_finish(self):
+        if hasattr(self, '_sess'):
+            self._sess.close()
+
+class LayersHandler(DbSessionMixin, web.RequestHandler):
     """information about available layers"""
 
-    def initialize(self, dbsess=None, custom=[]):
-        self.sess = dbsess
+    def initialize(self, custom=[]):
         self.custom_urls = custom
 
     def get(self):
         deflayer = None
-        if self.sess:
-            # set the layer with the most tiles at the initial zoom level as the default layer
-            defzoom = int(self.get_argument('default_zoom', '0'))
-            tallies = list(self.sess.query(func.count('*'), mt.Tile.layer).filter(mt.Tile.z == defzoom).group_by(mt.Tile.layer))
-            if tallies:
-                deflayer = max(tallies)[1]
+        # set the layer with the most tiles at the initial zoom level as the default layer
+        defzoom = int(self.get_argument('default_zoom', '0'))
+        tallies = list(self.sess.query(func.count('*'), mt.Tile.layer).filter(mt.Tile.z == defzoom).group_by(mt.Tile.layer))
+        if tallies:
+            deflayer = max(tallies)[1]
 
         def mk_layer(key):
             L = settings.LAYERS[key]
@@ -110,18 +122,15 @@ class TileRequestHandler(web.RequestHandler):
             file_type = settings.LAYERS[layer]['file_type']
             self.set_header('Content-Type', 'image/' + file_type)
             self.set_header('Content-Length', len(content))
-            self.write(content)
+            self.write(str(content))
         else:
             self.set_status(404)
 
-class TileHandler(TileRequestHandler):
+class TileHandler(DbSessionMixin, TileRequestHandler):
     """return tile images"""
 
-    def initialize(self, dbsess):
-        self.sess = dbsess
-
     def _get(self, tile):
-        t = sess.query(mt.Tile).get(tile.pk())
+        t = self.sess.query(mt.Tile).get(tile.pk())
         if not t:
             self.set_status(404)
             return
@@ -168,12 +177,9 @@ class TileProxyHandler(TileRequestHandler):
         )
         self.finish()
 
-class TileCoverHandler(TileRequestHandler):
+class TileCoverHandler(DbSessionMixin, TileRequestHandler):
     """return metadata describing the coverage over this tile at other zoom levels"""
 
-    def initialize(self, dbsess):
-        self.sess = dbsess
-
     def _get(self, tile):
         lookback = int(self.get_argument('lookback', settings.LOOKBACK))
 
@@ -186,7 +192,7 @@ class TileCoverHandler(TileRequestHandler):
             payload = [rel_tile(t) for t in desc]
         else:
             # search current and ancestor levels
-            ancestors = tile.get_ancestors(sess, lookback)
+            ancestors = tile.get_ancestors(self.sess, lookback)
             payload = []
             for i, t in enumerate(ancestors):
                 if t:
@@ -196,10 +202,7 @@ class TileCoverHandler(TileRequestHandler):
         self.set_header('Content-Type', 'text/json')
         self.write(json.dumps(payload))
 
-class RegionsHandler(web.RequestHandler):
-
-    def initialize(self, dbsess):
-        self.sess = dbsess
+class RegionsHandler(DbSessionMixin, web.RequestHandler):
 
     def get(self):
         def mk_layer(r):
@@ -209,7 +212,7 @@ class RegionsHandler(web.RequestHandler):
                 'readonly': r.name == mt.Region.GLOBAL_NAME
             }
 
-        payload = [mk_layer(r) for r in sess.query(mt.Region)]
+        payload = [mk_layer(r) for r in self.sess.query(mt.Region)]
         self.set_header('Content-Type', 'text/json')
         self.write(json.dumps(payload))
 
@@ -308,8 +311,8 @@ def tile_fetch_callback(meta, status, data):
     IOLoop.instance().add_callback(lambda: meta['callback'](md.normdata(status, data)))
 
 
-sess = mt.dbsess()
-tiledl = md.DownloadService(tile_fetch_callback, sess)
+# the download service commits fetched tiles from its own thread, so it keeps its own session
+tiledl = md.DownloadService(tile_fetch_callback, mt.dbsess())
 
 if __name__ == "__main__":
 
@@ -330,12 +333,12 @@ if __name__ == "__main__":
     ssl = {'certfile': web_path('ssl.crt')} if options.ssl else None
 
     application = web.Application([
-        (r'/layers', LayersHandler, {'dbsess': sess, 'custom': options.urls or []}),
-        (r'/tile/' + TileRequestHandler.PATTERN, TileHandler, {'dbsess': sess}),
+        (r'/layers', LayersHandler, {'custom': options.urls or []}),
+        (r'/tile/' + TileRequestHandler.PATTERN, TileHandler),
         (r'/tileproxy/' + TileRequestHandler.PATTERN, TileProxyHandler, {'tiledl': tiledl}),
         (r'/tileurl/' + TileRequestHandler.PATTERN, TileURLHandler),
-        (r'/tilecover/' + TileRequestHandler.PATTERN, TileCoverHandler, {'dbsess': sess}),
-        (r'/regions', RegionsHandler, {'dbsess': sess}),
+        (r'/tilecover/' + TileRequestHandler.PATTERN, TileCoverHandler),
+        (r'/regions', RegionsHandler),
         (r'/waypoints', WaypointsHandler),
         (r'/saveprofile', SaveProfileHandler),
         (r'/savewaypoint', SaveWaypointHandler),